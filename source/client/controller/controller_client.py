@@ -15,6 +15,11 @@ import json
 import time
 from datetime import datetime
 import sys
+import struct
+import hmac
+import queue
+import zlib
+from collections import deque
 
 try:
     from PIL import Image
@@ -24,6 +29,366 @@ except ImportError:
     print("Install with: pip install Pillow")
     Image = None
 
+try:
+    import numpy as np
+except ImportError:
+    print("Warning: numpy not installed. Delta codec streams cannot be decoded.")
+    print("Install with: pip install numpy")
+    np = None
+
+# UDP packet header - phải khớp với StreamerClient. Áp dụng cho mọi datagram (frame chunk và gói điều khiển):
+# magic (uint16), version (uint8), type (uint8), seq (uint32, đếm theo từng frame chunk gửi đi),
+# capture_us (uint64, thời điểm capture của frame; 0 với gói điều khiển), payload_len (uint16)
+# Bên nhận phân loại gói bằng struct, không thử json.loads trên từng datagram
+PACKET_HEADER = struct.Struct('!HBBIQH')
+PACKET_MAGIC = 0x5244  # 'RD'
+PACKET_VERSION = 1
+PACKET_FRAME = 1  # Payload: CHUNK_HEADER + dữ liệu frame
+PACKET_CONTROL = 2  # Payload: JSON (đăng ký địa chỉ UDP, báo P2P)
+PACKET_PROBE = 3  # Payload: PROBE_MESSAGE + session_id - đo RTT / đục lỗ NAT
+
+# Probe - phải khớp với StreamerClient: kind, target (server hoặc peer), server_rtt_us của bên gửi
+# seq/capture_us của header là id và thời điểm gửi probe, bên trả lời giữ nguyên
+PROBE_MESSAGE = struct.Struct('!BBI')
+PROBE_REQUEST = 1
+PROBE_REPLY = 2
+PROBE_TARGET_SERVER = 0
+PROBE_TARGET_PEER = 1
+
+# Fragmented frame transport - phải khớp với StreamerClient
+# Header mỗi chunk (ngay sau PACKET_HEADER): frame_id (uint32), chunk_index (uint16), chunk_count (uint16)
+CHUNK_HEADER = struct.Struct('!IHH')
+
+# Frame metadata - phải khớp với StreamerClient
+# codec id, stream_id (chỉ số monitor, 0 = toàn bộ desktop ảo), width, height của frame,
+# source_width, source_height của màn hình gốc,
+# capture_us (đồng hồ monotonic của Streamer, micro giây), input_seq của input cuối đã thực thi
+FRAME_HEADER = struct.Struct('!BBHHHHQI')
+CODEC_TILES = 1
+CODEC_DELTA = 2
+
+# Codec tile JPEG: sequence (theo stream), tile_count; mỗi tile: x, y, w, h, jpeg_length + JPEG bytes
+TILE_FRAME_HEADER = struct.Struct('!IH')
+TILE_HEADER = struct.Struct('!HHHHI')
+
+# Codec XOR-delta + zlib: frame_type, sequence + dữ liệu nén zlib
+DELTA_FRAME_HEADER = struct.Struct('!BI')
+DELTA_KEYFRAME = 0
+DELTA_INTERFRAME = 1
+
+# TCP command channel: mỗi message = length (uint32, big-endian) + payload
+# Payload JSON luôn bắt đầu bằng '{'; message nhị phân bắt đầu bằng type (uint8)
+MESSAGE_HEADER = struct.Struct('!I')
+MAX_MESSAGE_SIZE = 1024 * 1024
+
+# Mouse move nhị phân - phải khớp với StreamerClient: type, stream_id, x, y, width, height của frame
+MSG_MOUSE_MOVE = 0x01
+MOUSE_MOVE_MESSAGE = struct.Struct('!BBHHHH')
+NO_STREAM = 0xFF  # Chưa biết stream đang xem: Streamer dùng stream đầu tiên
+
+# Đánh thức sender thread khi có mouse move mới (không phải lệnh)
+MOVE_WAKEUP = object()
+
+
+def encode_packet(packet_type, payload, seq=0, capture_us=0):
+    """Đóng gói payload thành datagram có PACKET_HEADER"""
+    return PACKET_HEADER.pack(PACKET_MAGIC, PACKET_VERSION, packet_type, seq, capture_us,
+                              len(payload)) + payload
+
+
+def encode_message(message):
+    """Đóng gói một dict thành message JSON có length prefix"""
+    payload = json.dumps(message).encode('utf-8')
+    return MESSAGE_HEADER.pack(len(payload)) + payload
+
+
+def recv_exact(sock, size):
+    """Nhận đúng size byte từ TCP socket (None nếu kết nối đóng)"""
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def read_message(sock):
+    """Đọc một message có length prefix từ TCP socket (blocking)"""
+    header = recv_exact(sock, MESSAGE_HEADER.size)
+    if header is None:
+        return None
+    (length,) = MESSAGE_HEADER.unpack(header)
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message too large: {length} bytes")
+    return recv_exact(sock, length)
+
+
+def percentile(samples, fraction):
+    """Percentile của list mẫu (None nếu chưa có mẫu)"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class FrameMailbox:
+    """
+    Hộp thư giữa receive thread và decode worker.
+    Frame tile/delta phụ thuộc frame trước nên không được bỏ; decode worker lấy hết một lượt.
+    """
+    def __init__(self, max_backlog=32):
+        self.condition = threading.Condition()
+        self.frames = []
+        self.max_backlog = max_backlog
+    
+    def post(self, frame_data):
+        """Thêm frame. Returns: False nếu backlog đầy và frame bị bỏ"""
+        with self.condition:
+            if len(self.frames) >= self.max_backlog:
+                return False
+            self.frames.append(frame_data)
+            self.condition.notify()
+            return True
+    
+    def collect(self, timeout):
+        """Chờ có frame rồi lấy toàn bộ frame đang chờ (list rỗng nếu hết timeout)"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.frames, timeout)
+            frames, self.frames = self.frames, []
+            return frames
+
+
+class LatestFrameSlot:
+    """
+    Slot một chỗ cho frame đã giải mã: frame mới ghi đè frame cũ, người đọc chờ bằng Condition.
+    Vùng thay đổi (x, y, w, h) của các frame bị ghi đè được gộp lại để người đọc không bỏ sót;
+    regions = None nghĩa là cần vẽ lại toàn bộ.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.frame = None
+        self.regions = None
+        self.seq = 0
+    
+    def put(self, frame, regions=None):
+        with self.condition:
+            if (regions is None or self.regions is None
+                    or self.frame is None or self.frame.size != frame.size):
+                self.regions = None
+            else:
+                self.regions = self.regions + regions
+            self.frame = frame
+            self.seq += 1
+            self.condition.notify_all()
+    
+    def wait(self, last_seq, timeout):
+        """
+        Chờ frame mới hơn last_seq.
+        Returns: (seq, frame, regions); seq == last_seq nếu hết timeout
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.seq != last_seq, timeout):
+                return last_seq, None, None
+            regions = self.regions
+            self.regions = []  # Người đọc đã nhận các vùng này
+            return self.seq, self.frame, regions
+
+
+class PresentationScheduler:
+    """
+    Jitter buffer: giữ frame đã giải mã và trình chiếu theo capture timestamp.
+    Thời điểm trình chiếu = capture_time + clock_offset + buffer_delay, với clock_offset là
+    độ lệch nhỏ nhất (arrival - capture) trong cửa sổ gần đây (frame đi nhanh nhất).
+    Frame đã quá hạn khi có frame mới hơn cũng đến hạn thì bị bỏ (vùng thay đổi được gộp sang frame sau).
+    """
+    def __init__(self, output_slot, buffer_delay=0.05, on_present=None):
+        self.output_slot = output_slot
+        self.on_present = on_present  # Callback(frame) ngay khi frame được trình chiếu
+        self.buffer_delay = buffer_delay  # Giây; tăng để mượt hơn, giảm để trễ ít hơn
+        self.condition = threading.Condition()
+        self.frames = deque()  # [present_at, ready_at, frame, regions] theo thứ tự capture
+        self.offsets = deque()  # (arrival, arrival - capture)
+        self.offset_window = 10.0
+        self.late_threshold = 0.1  # Đến trễ hơn hạn quá 100ms thì tính là frame trễ
+        
+        # Thống kê
+        self.frames_presented = 0
+        self.frames_skipped = 0  # Bỏ vì frame mới hơn đã đến hạn
+        self.frames_late = 0  # Đến sau thời điểm trình chiếu của chính nó
+        self.added_latency = deque(maxlen=200)  # Thời gian frame nằm trong buffer (giây)
+    
+    def push(self, capture_time, arrival_time, frame, regions):
+        """Đưa frame đã giải mã vào buffer"""
+        now = time.monotonic()
+        offset = arrival_time - capture_time
+        with self.condition:
+            self.offsets.append((arrival_time, offset))
+            while self.offsets and arrival_time - self.offsets[0][0] > self.offset_window:
+                self.offsets.popleft()
+            base_offset = min(sample for _, sample in self.offsets)
+            
+            present_at = capture_time + base_offset + self.buffer_delay
+            if now - present_at > self.late_threshold:
+                self.frames_late += 1
+            self.frames.append([present_at, now, frame, regions])
+            self.condition.notify()
+    
+    def run(self, is_running):
+        """Scheduler loop: trình chiếu frame khi đến hạn (chạy trên thread riêng)"""
+        while is_running():
+            with self.condition:
+                if not self.frames:
+                    self.condition.wait(0.5)
+                    continue
+                delay = self.frames[0][0] - time.monotonic()
+                if delay > 0:
+                    # Chờ đến hạn; frame mới đến cũng đánh thức để tính lại
+                    self.condition.wait(delay)
+                    continue
+                
+                now = time.monotonic()
+                due = []
+                while self.frames and self.frames[0][0] <= now:
+                    due.append(self.frames.popleft())
+            
+            # Chỉ trình chiếu frame mới nhất đã đến hạn, các frame trễ hơn bị bỏ
+            present_at, ready_at, frame, regions = due[-1]
+            for skipped in due[:-1]:
+                regions = None if (regions is None or skipped[3] is None) else skipped[3] + regions
+            self.frames_skipped += len(due) - 1
+            self.frames_presented += 1
+            self.added_latency.append(max(0.0, now - ready_at))
+            self.output_slot.put(frame, regions)
+            if self.on_present:
+                self.on_present(frame)
+    
+    def clear(self):
+        with self.condition:
+            self.frames.clear()
+            self.offsets.clear()
+    
+    def stats(self):
+        """Độ trễ do jitter buffer thêm vào (ms) và số frame bỏ/trễ"""
+        samples = list(self.added_latency)
+        if samples:
+            average = sum(samples) / len(samples) * 1000
+            p95 = percentile(samples, 0.95) * 1000
+        else:
+            average = p95 = 0.0
+        return {
+            'buffer_ms': self.buffer_delay * 1000,
+            'added_avg_ms': average,
+            'added_p95_ms': p95,
+            'presented': self.frames_presented,
+            'skipped': self.frames_skipped,
+            'late': self.frames_late
+        }
+
+
+class StreamDecoder:
+    """
+    Trạng thái giải mã của một stream (một monitor của Streamer):
+    framebuffer của codec tile, frame tham chiếu của codec delta.
+    """
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        self.codec = None  # Codec của frame giải mã gần nhất
+        # Persistent framebuffer: các tile thay đổi được ghép lên frame trước
+        self.framebuffer = None
+        # Tile codec: sequence của frame gần nhất; hụt sequence thì tile của frame mất đã cũ
+        self.tile_sequence = None
+        self.missed_frame = False
+        # Delta codec: frame tham chiếu (numpy) và sequence của frame đã giải mã
+        self.delta_reference = None
+        self.delta_sequence = None
+    
+    def apply(self, codec, frame_data, offset, width, height):
+        """
+        Giải mã payload của codec vào framebuffer.
+        Returns: list vùng đã cập nhật (x, y, w, h), None nếu mất frame tham chiếu (cần keyframe)
+        """
+        if codec == CODEC_TILES:
+            regions = self.apply_tile_frame(frame_data, offset, width, height)
+        elif codec == CODEC_DELTA:
+            regions = self.apply_delta_frame(frame_data, offset, width, height)
+        else:
+            raise ValueError(f"Unknown codec: {codec}")
+        if regions:
+            self.codec = codec
+        return regions
+    
+    def snapshot(self):
+        """Chụp framebuffer hiện tại thành ảnh độc lập"""
+        if self.codec == CODEC_DELTA:
+            # fromarray copy pixel nên frame đã publish không bị frame sau ghi đè
+            return Image.fromarray(self.delta_reference)
+        return self.framebuffer.copy()
+    
+    def apply_tile_frame(self, frame_data, offset, width, height):
+        """
+        Giải mã các tile JPEG và ghép lên framebuffer.
+        Returns: list tile đã cập nhật (x, y, w, h)
+        """
+        sequence, tile_count = TILE_FRAME_HEADER.unpack_from(frame_data, offset)
+        missed = self.tile_sequence is not None and sequence != (self.tile_sequence + 1) & 0xFFFFFFFF
+        self.tile_sequence = sequence
+        if self.framebuffer is None or self.framebuffer.size != (width, height):
+            self.framebuffer = Image.new('RGB', (width, height))
+        
+        offset += TILE_FRAME_HEADER.size
+        regions = []
+        for _ in range(tile_count):
+            x, y, w, h, length = TILE_HEADER.unpack_from(frame_data, offset)
+            offset += TILE_HEADER.size
+            tile = Image.open(io.BytesIO(frame_data[offset:offset + length]))
+            offset += length
+            self.framebuffer.paste(tile, (x, y))
+            regions.append((x, y, w, h))
+        
+        # Frame phủ toàn bộ màn hình (full refresh) đã bù mọi frame mất trước đó
+        if missed and sum(w * h for _, _, w, h in regions) < width * height:
+            self.missed_frame = True
+        return regions
+    
+    def apply_delta_frame(self, frame_data, offset, width, height):
+        """
+        Giải mã keyframe hoặc XOR delta lên frame tham chiếu.
+        Delta không nối tiếp frame đã giải mã (mất gói) thì bỏ.
+        Returns: [vùng bao quanh pixel thay đổi], None nếu cần keyframe
+        """
+        if np is None:
+            raise RuntimeError("numpy is required to decode delta codec frames")
+        
+        frame_type, sequence = DELTA_FRAME_HEADER.unpack_from(frame_data, offset)
+        offset += DELTA_FRAME_HEADER.size
+        shape = (height, width, 3)
+        
+        if frame_type == DELTA_KEYFRAME:
+            pixels = np.frombuffer(zlib.decompress(frame_data[offset:]), dtype=np.uint8)
+            self.delta_reference = pixels.reshape(shape).copy()
+            region = (0, 0, width, height)
+        else:
+            if (self.delta_reference is None or self.delta_reference.shape != shape
+                    or sequence != (self.delta_sequence + 1) & 0xFFFFFFFF):
+                return None
+            delta = np.frombuffer(zlib.decompress(frame_data[offset:]), dtype=np.uint8).reshape(shape)
+            np.bitwise_xor(self.delta_reference, delta, out=self.delta_reference)
+            
+            # Vùng bao quanh các pixel khác 0 của delta
+            changed = delta.any(axis=2)
+            rows = np.flatnonzero(changed.any(axis=1))
+            cols = np.flatnonzero(changed.any(axis=0))
+            if rows.size:
+                region = (int(cols[0]), int(rows[0]),
+                          int(cols[-1] - cols[0]) + 1, int(rows[-1] - rows[0]) + 1)
+            else:
+                region = (0, 0, 0, 0)
+        
+        self.delta_sequence = sequence
+        return [region]
+
+
 class ControllerClient:
     def __init__(self, server_ip, server_port=5555, udp_port=5556):
         self.server_ip = server_ip
@@ -33,12 +398,105 @@ class ControllerClient:
         self.udp_socket = None
         self.connected = False
         self.running = False
+        self.session_id = None
         self.screen_data = None
         
-        # P2P UPGRADE
-        self.p2p_enabled = False
-        self.streamer_ip = None
-        self.p2p_receive_count = 0
+        # Outgoing command queue: sender thread gộp các lệnh đang chờ thành một lần ghi
+        self.send_queue = queue.Queue()
+        self.sender_thread = None
+        self.max_batch_size = 64
+        
+        # Mouse move gộp: chỉ giữ vị trí mới nhất, gửi nhị phân tối đa một lần mỗi tick
+        self.pending_move = None  # (stream_id, x, y, width, height)
+        self.move_lock = threading.Lock()
+        self.move_interval = 1.0 / 60
+        self.last_move_sent = 0
+        
+        # Mỗi stream (monitor) của Streamer có decoder riêng; chỉ stream đang xem được giải mã
+        self.stream_decoders = {}  # stream_id -> StreamDecoder
+        self.view_stream = None  # None: xem stream đầu tiên nhận được
+        self.frame_stream = None  # Stream của frame publish gần nhất
+        self.screen_frame = None  # Bản sao framebuffer cho GUI hiển thị
+        
+        # Danh sách monitor của Streamer (trả lời LIST_MONITORS / SELECT_MONITOR)
+        self.monitors = []  # [{'id', 'left', 'top', 'width', 'height'}], id 0 = toàn bộ desktop ảo
+        self.streams = []  # stream_id đang được stream
+        self.monitors_condition = threading.Condition()
+        
+        # Decode worker: receive thread chỉ ghép chunk, giải mã trên thread riêng
+        # frame_mailbox: payload chờ giải mã; presenter: jitter buffer theo capture timestamp;
+        # frame_slot: frame đến hạn trình chiếu cho GUI
+        self.frame_mailbox = FrameMailbox()
+        self.frame_slot = LatestFrameSlot()
+        self.presenter = PresentationScheduler(self.frame_slot, on_present=self.record_presented)
+        self.decoder_thread = None
+        self.presenter_thread = None
+        self.frames_decoded = 0
+        self.frame_capture_time = None  # Capture timestamp (giây, đồng hồ Streamer) của frame gần nhất
+        self.frame_input_seq = 0  # input_seq mà frame gần nhất đã phản ánh
+        
+        # Đo độ trễ end-to-end (đồng hồ monotonic)
+        # PING -> Streamer -> PONG: round-trip qua server; input_seq: click/phím -> frame phản ánh nó
+        self.message_thread = None
+        self.ping_id = 0
+        self.pending_pings = {}  # ping_id -> thời điểm gửi
+        self.last_pong = None  # (ping_id, rtt)
+        self.pong_condition = threading.Condition()
+        self.rtt_samples = deque(maxlen=200)  # giây
+        self.input_seq = 0
+        self.pending_inputs = deque(maxlen=64)  # (input_seq, thời điểm gửi)
+        self.input_latency_samples = deque(maxlen=200)  # giây
+        self.input_timeout = 5.0  # Input không làm màn hình đổi thì bỏ sau 5s
+        self.frame_size = None  # Kích thước frame gần nhất (width, height)
+        self.source_size = None  # Độ phân giải màn hình gốc của Streamer
+        
+        self.keyframe_request_interval = 0.5  # Không xin keyframe dồn dập khi mất nhiều gói
+        self.last_keyframe_request = 0
+        
+        # Reassembly buffer: frame_id -> [chunks, received_count, first_seen]
+        self.pending_frames = {}
+        self.frame_timeout = 0.5  # Bỏ frame chưa đủ chunk sau 0.5s
+        self.max_pending_frames = 8  # Giới hạn bộ nhớ phía nhận
+        self.last_frame_id = None
+        self.frames_completed = 0
+        self.frames_dropped = 0
+        
+        # Feedback cho rate control của Streamer: frame đã nhận, loss, jitter
+        self.feedback_interval = 0.5
+        self.last_feedback = time.monotonic()
+        self.feedback_frames = []  # [frame_id, arrival_ms] trong chu kỳ hiện tại
+        self.max_feedback_frames = 64
+        self.feedback_last_id = None  # frame_id lớn nhất của chu kỳ trước
+        self.last_arrival = None
+        self.last_interarrival = None
+        self.jitter = 0.0  # Interarrival jitter (giây, làm mượt kiểu RFC 3550)
+        self.loss_rate = 0.0
+        
+        # Packet loss/reorder theo seq của packet header (tính lại mỗi chu kỳ feedback)
+        self.packet_seq_highest = None  # seq lớn nhất đã nhận
+        self.packet_seq_base = None  # seq lớn nhất ở đầu chu kỳ
+        self.packets_received = 0  # Số packet nhận trong chu kỳ
+        self.packets_reordered = 0  # Số packet đến sau packet có seq lớn hơn (trong chu kỳ)
+        self.packet_loss = 0.0
+        self.total_packets_reordered = 0
+        
+        # UDP registration keepalive để server route frame theo session
+        self.udp_register_interval = 5.0
+        self.last_udp_register = 0
+        self.udp_token = None  # Server cấp trong phản hồi xác thực, bắt buộc trong gói đăng ký UDP
+        self.server_udp_address = None  # Địa chỉ relay của server (IP đã resolve), nguồn frame hợp lệ
+        
+        # P2P: hole punching tới địa chỉ UDP Streamer do server gửi (PEER_INFO).
+        # Controller probe server (RTT relay, báo cho Streamer) và Streamer (mở NAT);
+        # Streamer chọn đường gửi frame, Controller nhận từ đường nào cũng được
+        self.peer_address = None
+        self.peer_nonce = None  # Nonce của server trong PEER_INFO, probe peer phải mang đúng nonce này
+        self.probe_interval = 0.5
+        self.last_probe = 0
+        self.probe_id = 0
+        self.server_rtt = None  # giây, làm mượt
+        self.direct_rtt = None
+        self.receiving_direct = False
     
     def log(self, message):
         """Log với timestamp"""
@@ -51,18 +509,21 @@ class ControllerClient:
             # TCP connection
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.connect((self.server_ip, self.server_port))
+            self.server_udp_address = (self.socket.getpeername()[0], self.udp_port)
             
             # Gửi thông tin client type với credentials
-            client_info = json.dumps({
+            client_info = {
                 'type': 'controller',
                 'session_id': session_id,
                 'password': password
-            })
-            self.socket.send(client_info.encode('utf-8'))
+            }
+            self.socket.sendall(encode_message(client_info))
             
             # Wait for authentication response
-            response_data = self.socket.recv(1024).decode('utf-8')
-            response = json.loads(response_data)
+            response_data = read_message(self.socket)
+            if response_data is None:
+                raise ConnectionError("Server closed connection during authentication")
+            response = json.loads(response_data.decode('utf-8'))
             
             if response.get('status') != 'success':
                 self.log(f"❌ Authentication failed: {response.get('message', 'Unknown error')}")
@@ -70,14 +531,8 @@ class ControllerClient:
                 return False
             
             self.log(f"✅ Authentication successful")
-            
-            # P2P: Check if peer info available
-            peer_info = response.get('peer_info')
-            if peer_info and peer_info.get('ip'):
-                self.streamer_ip = peer_info['ip']
-                self.p2p_enabled = True
-                self.log(f"🔗 P2P: Streamer IP received - {self.streamer_ip}")
-                self.log(f"✅ P2P MODE ENABLED - Will receive directly from Streamer")
+            # Tự gộp lệnh trong sender thread nên tắt Nagle để giảm độ trễ
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             
             # UDP socket để nhận screen data
             self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -86,16 +541,28 @@ class ControllerClient:
             udp_local_port = self.udp_socket.getsockname()[1]
             
             # Gửi registration packet để server biết địa chỉ UDP
-            register_msg = json.dumps({'type': 'controller_udp', 'port': udp_local_port}).encode('utf-8')
-            self.udp_socket.sendto(register_msg, (self.server_ip, self.udp_port))
+            self.session_id = session_id
+            self.udp_token = response.get('udp_token')
+            self.register_udp()
             
             self.connected = True
             self.running = True
             self.log(f"Connected to server at {self.server_ip}:{self.server_port}")
             self.log(f"UDP listening on port {udp_local_port}")
             
-            # Start thread để nhận màn hình qua UDP
+            # Start thread để nhận màn hình qua UDP và thread giải mã
             threading.Thread(target=self.receive_screen_data, daemon=True).start()
+            if Image:
+                self.decoder_thread = threading.Thread(target=self.decode_frames, daemon=True)
+                self.decoder_thread.start()
+                self.presenter_thread = threading.Thread(
+                    target=self.presenter.run, args=(lambda: self.running,), daemon=True)
+                self.presenter_thread.start()
+            # Start thread gửi lệnh và thread nhận message TCP (PONG từ Streamer)
+            self.sender_thread = threading.Thread(target=self.send_commands_loop, daemon=True)
+            self.sender_thread.start()
+            self.message_thread = threading.Thread(target=self.receive_messages, daemon=True)
+            self.message_thread.start()
             
             return True
             
@@ -103,70 +570,194 @@ class ControllerClient:
             self.log(f"Connection failed: {e}")
             return False
             
+    def register_udp(self):
+        """Gửi registration packet để server biết địa chỉ UDP của session này"""
+        register_msg = encode_packet(PACKET_CONTROL, json.dumps({
+            'type': 'controller_udp',
+            'port': self.udp_socket.getsockname()[1],
+            'session_id': self.session_id,
+            'token': self.udp_token
+        }).encode('utf-8'))
+        self.udp_socket.sendto(register_msg, (self.server_ip, self.udp_port))
+        self.last_udp_register = time.time()
+    
+    def send_probe(self, kind, target, address, probe_id=0, sent_us=None):
+        """Gửi probe (đo RTT / đục lỗ NAT) kèm RTT tới server của Controller; probe peer mang nonce"""
+        if sent_us is None:
+            sent_us = int(time.monotonic() * 1e6)
+        server_rtt_us = int((self.server_rtt or 0) * 1e6)
+        nonce = self.peer_nonce if target == PROBE_TARGET_PEER else b''
+        payload = PROBE_MESSAGE.pack(kind, target, min(server_rtt_us, 0xFFFFFFFF)) + nonce
+        self.udp_socket.sendto(encode_packet(PACKET_PROBE, payload, seq=probe_id, capture_us=sent_us), address)
+    
+    def send_probes(self):
+        """Probe định kỳ server và Streamer (probe tới Streamer giữ mapping NAT luôn mở)"""
+        self.last_probe = time.monotonic()
+        self.probe_id = (self.probe_id + 1) & 0xFFFFFFFF
+        try:
+            self.send_probe(PROBE_REQUEST, PROBE_TARGET_SERVER, (self.server_ip, self.udp_port), self.probe_id)
+            if self.peer_address:
+                self.send_probe(PROBE_REQUEST, PROBE_TARGET_PEER, self.peer_address, self.probe_id)
+        except OSError:
+            pass
+    
+    def handle_probe(self, data, address, probe_id, sent_us):
+        """Probe nhận được: reply của server/Streamer cho RTT, request của Streamer thì trả lời"""
+        probe_size = PACKET_HEADER.size + PROBE_MESSAGE.size
+        if len(data) < probe_size:
+            return
+        kind, target, _ = PROBE_MESSAGE.unpack_from(data, PACKET_HEADER.size)
+        rtt = time.monotonic() - sent_us / 1e6
+        
+        if target == PROBE_TARGET_SERVER:
+            if kind == PROBE_REPLY:
+                self.server_rtt = rtt if self.server_rtt is None else self.server_rtt * 0.75 + rtt * 0.25
+            return
+        # Chỉ nhận probe từ đúng địa chỉ Streamer server đã báo, mang đúng nonce của PEER_INFO
+        nonce = self.peer_nonce
+        if address != self.peer_address or nonce is None or not hmac.compare_digest(data[probe_size:], nonce):
+            return
+        if kind == PROBE_REQUEST:
+            try:
+                self.send_probe(PROBE_REPLY, PROBE_TARGET_PEER, address, probe_id, sent_us)
+            except OSError:
+                pass
+        elif kind == PROBE_REPLY:
+            self.direct_rtt = rtt if self.direct_rtt is None else self.direct_rtt * 0.75 + rtt * 0.25
+            
     def send_command(self, command, payload=None):
-        """Gửi lệnh điều khiển đến server"""
+        """Đưa lệnh điều khiển vào hàng đợi gửi đến server"""
         if not self.connected:
             self.log("Not connected to server")
             return False
             
-        try:
-            cmd_data = {
-                'command': command,
-                'payload': payload or {},
-                'timestamp': time.time()
-            }
+        cmd_data = {
+            'command': command,
+            'payload': payload or {},
+            'timestamp': time.monotonic()  # Đồng hồ monotonic, chỉ so sánh trong cùng máy
+        }
+        self.send_queue.put(cmd_data)
+        return True
+    
+    def send_commands_loop(self):
+        """Sender thread: gộp mọi lệnh đang chờ thành một lần sendall; mouse move gộp theo tick"""
+        stop = False
+        while not stop:
+            # Có move đang chờ thì chỉ chờ lệnh đến tick gửi move tiếp theo
+            timeout = None
+            if self.pending_move is not None:
+                timeout = max(0.0, self.last_move_sent + self.move_interval - time.monotonic())
+            try:
+                cmd_data = self.send_queue.get(timeout=timeout)
+            except queue.Empty:
+                cmd_data = MOVE_WAKEUP
+            if cmd_data is None:
+                break
             
-            json_data = json.dumps(cmd_data)
-            self.socket.send(json_data.encode('utf-8'))
-            self.log(f"Sent command: {command}")
-            return True
+            batch = [] if cmd_data is MOVE_WAKEUP else [cmd_data]
+            while len(batch) < self.max_batch_size:
+                try:
+                    cmd_data = self.send_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if cmd_data is None:
+                    stop = True
+                    break
+                if cmd_data is not MOVE_WAKEUP:
+                    batch.append(cmd_data)
             
-        except Exception as e:
-            self.log(f"Error sending command: {e}")
-            self.connected = False
-            return False
+            # Move đi trước các lệnh khác trong batch để click không bị move cũ kéo lệch
+            move = self.take_pending_move(force=bool(batch))
+            if move is None and not batch:
+                continue
             
+            data = b''.join(encode_message(cmd) for cmd in batch)
+            if move is not None:
+                data = MESSAGE_HEADER.pack(MOUSE_MOVE_MESSAGE.size) + MOUSE_MOVE_MESSAGE.pack(
+                    MSG_MOUSE_MOVE, *move) + data
+            
+            try:
+                self.socket.sendall(data)
+                for cmd in batch:
+                    if cmd['command'] not in ('FEEDBACK', 'PING'):
+                        self.log(f"Sent command: {cmd['command']}")
+            except Exception as e:
+                self.log(f"Error sending command: {e}")
+                self.connected = False
+                break
+    
+    def take_pending_move(self, force=False):
+        """Lấy vị trí move mới nhất nếu đã đến tick (hoặc force). Returns: (stream_id, x, y, w, h) hoặc None"""
+        with self.move_lock:
+            if self.pending_move is None:
+                return None
+            now = time.monotonic()
+            if not force and now - self.last_move_sent < self.move_interval:
+                return None
+            move = self.pending_move
+            self.pending_move = None
+            self.last_move_sent = now
+            return move
+    
     def receive_screen_data(self):
         """Nhận dữ liệu màn hình từ server qua UDP"""
         self.log("Screen receiver started (UDP)")
-        # Set timeout để tránh block forever
-        self.udp_socket.settimeout(1.0)
+        # Set timeout để tránh block forever (và probe đúng nhịp khi chưa có frame)
+        self.udp_socket.settimeout(self.probe_interval)
         
         while self.running:
             try:
+                # Registration keepalive (UDP có thể mất gói đăng ký)
+                if time.time() - self.last_udp_register >= self.udp_register_interval:
+                    self.register_udp()
+                
+                # Feedback định kỳ cho rate control của Streamer
+                if time.monotonic() - self.last_feedback >= self.feedback_interval:
+                    self.send_feedback()
+                
+                # Probe server/Streamer cho hole punching và đo RTT
+                if time.monotonic() - self.last_probe >= self.probe_interval:
+                    self.send_probes()
+                
                 # Nhận data qua UDP
                 data, address = self.udp_socket.recvfrom(65535)
                 
-                # P2P: Track if receiving directly from Streamer
-                if self.p2p_enabled and address[0] == self.streamer_ip:
-                    self.p2p_receive_count += 1
-                    if self.p2p_receive_count == 1:
-                        self.log(f"🎉 P2P SUCCESS! Receiving directly from Streamer {address[0]}:{address[1]}")
-                        # Notify server that P2P is working
-                        try:
-                            p2p_msg = json.dumps({'type': 'p2p_active'}).encode('utf-8')
-                            self.udp_socket.sendto(p2p_msg, (self.server_ip, self.udp_port))
-                        except:
-                            pass
-                
-                # Bỏ qua registration messages
-                try:
-                    msg = json.loads(data.decode('utf-8'))
+                # Chỉ nhận frame chunk có packet header hợp lệ (phân loại O(1), không parse JSON)
+                if len(data) < PACKET_HEADER.size:
+                    continue
+                magic, version, packet_type, seq, capture_us, length = PACKET_HEADER.unpack_from(data)
+                if (magic != PACKET_MAGIC or version != PACKET_VERSION
+                        or length != len(data) - PACKET_HEADER.size):
+                    continue
+                if packet_type == PACKET_PROBE:
+                    self.handle_probe(data, address, seq, capture_us)
+                    continue
+                if packet_type != PACKET_FRAME:
                     continue
-                except:
-                    pass
+                # Frame chỉ đến từ relay của server hoặc Streamer đã báo qua PEER_INFO (nonce),
+                # host khác không chèn được chunk hay lật trạng thái P2P
+                direct = address == self.peer_address
+                if not direct and address != self.server_udp_address:
+                    continue
+                self.record_packet(seq)
+                
+                # P2P: frame đến trực tiếp từ Streamer hay qua relay của server
+                if direct != self.receiving_direct:
+                    self.receiving_direct = direct
+                    if direct:
+                        self.log(f"🎉 P2P SUCCESS! Receiving directly from Streamer {address[0]}:{address[1]}")
+                    else:
+                        self.log("🔁 Receiving frames via server RELAY")
                 
-                # Screen data (JPEG)
-                if len(data) > 1000:  # Sanity check - JPEG phải > 1KB
-                    self.screen_data = data
+                # Screen data (frame chunk)
+                frame_data = self.reassemble_chunk(memoryview(data)[PACKET_HEADER.size:])
+                if frame_data is not None:
+                    self.screen_data = frame_data
+                    self.record_frame_arrival(self.last_frame_id)
                     
-                    if Image:
-                        try:
-                            img = Image.open(io.BytesIO(data))
-                            mode_str = "P2P" if (self.p2p_enabled and address[0] == self.streamer_ip) else "RELAY"
-                            print(f"\r[{mode_str}] Frame: {len(data)}B, {img.size}, from {address[0]}", end='')
-                        except:
-                            pass
+                    # Giải mã trên decode worker, receive thread quay lại recvfrom ngay
+                    if Image and not self.frame_mailbox.post((frame_data, time.monotonic())):
+                        self.frames_dropped += 1
                             
             except socket.timeout:
                 # Timeout bình thường, continue
@@ -178,18 +769,289 @@ class ControllerClient:
                 continue
                 
         self.log("Screen receiver stopped")
+    
+    def decode_frames(self):
+        """
+        Decode worker: giải mã mỗi frame đúng một lần, rồi đưa frame mới nhất của lượt
+        (đã giải mã sẵn) vào jitter buffer.
+        """
+        while self.running:
+            frames = self.frame_mailbox.collect(timeout=0.5)
+            regions = []
+            arrival_time = None
+            for frame_data, arrival in frames:
+                try:
+                    frame_regions = self.apply_frame(frame_data)
+                except Exception as e:
+                    self.log(f"Error decoding frame: {e}")
+                    continue
+                if frame_regions:
+                    regions += frame_regions
+                    arrival_time = arrival
+            
+            if regions:
+                self.publish_frame(regions, arrival_time)
+    
+    def publish_frame(self, regions=None, arrival_time=None):
+        """Chụp framebuffer của stream đang xem thành ảnh độc lập và đưa vào jitter buffer kèm vùng thay đổi"""
+        frame = self.stream_decoders[self.frame_stream].snapshot()
+        frame.info['input_seq'] = self.frame_input_seq
+        self.screen_frame = frame
+        self.frames_decoded += 1
+        self.presenter.push(self.frame_capture_time, arrival_time or time.monotonic(), frame, regions)
+    
+    def reassemble_chunk(self, data):
+        """
+        Ghép chunk (payload sau packet header) vào reassembly buffer.
+        Returns: bytes của frame hoàn chỉnh, hoặc None nếu frame chưa đủ chunk
+        """
+        if len(data) <= CHUNK_HEADER.size:
+            return None
+        
+        frame_id, chunk_index, chunk_count = CHUNK_HEADER.unpack_from(data)
+        if chunk_count == 0 or chunk_index >= chunk_count:
+            return None
+        
+        # Frame cũ hơn frame đã hiển thị thì không cần nữa
+        # (frame_id nhảy lùi quá xa nghĩa là Streamer đã khởi động lại)
+        if self.last_frame_id is not None and frame_id <= self.last_frame_id:
+            if self.last_frame_id - frame_id < 1000:
+                return None
+            self.last_frame_id = None
+            self.pending_frames.clear()
+            self.packet_seq_highest = None
+            # Đồng hồ capture của Streamer mới khác hẳn, tính lại clock offset
+            self.presenter.clear()
+        
+        now = time.time()
+        self.expire_pending_frames(now)
+        
+        entry = self.pending_frames.get(frame_id)
+        if entry is None:
+            if len(self.pending_frames) >= self.max_pending_frames:
+                oldest_id = min(self.pending_frames)
+                del self.pending_frames[oldest_id]
+                self.frames_dropped += 1
+            entry = [[None] * chunk_count, 0, now]
+            self.pending_frames[frame_id] = entry
         
-    def mouse_click(self, x, y, button='left'):
-        """Gửi lệnh click chuột"""
-        return self.send_command('MOUSE_CLICK', {'x': x, 'y': y, 'button': button})
+        chunks = entry[0]
+        if len(chunks) != chunk_count or chunks[chunk_index] is not None:
+            return None
+        chunks[chunk_index] = data[CHUNK_HEADER.size:]
+        entry[1] += 1
+        
+        if entry[1] < chunk_count:
+            return None
+        
+        # Frame hoàn chỉnh - bỏ luôn các frame cũ hơn còn dang dở
+        del self.pending_frames[frame_id]
+        for stale_id in [fid for fid in self.pending_frames if fid < frame_id]:
+            del self.pending_frames[stale_id]
+            self.frames_dropped += 1
+        self.last_frame_id = frame_id
+        self.frames_completed += 1
+        return b''.join(chunks)
+    
+    def apply_frame(self, frame_data):
+        """
+        Giải mã frame theo codec id vào framebuffer (publish_frame đưa kết quả cho GUI).
+        Returns: list vùng đã cập nhật (x, y, w, h), rỗng nếu frame không dùng được
+        """
+        (codec, stream_id, width, height, source_width, source_height,
+         capture_us, input_seq) = FRAME_HEADER.unpack_from(frame_data)
+        
+        # Chỉ giải mã stream đang xem; đổi stream thì xin keyframe nên không cần giữ stream khác
+        if self.view_stream is None:
+            self.view_stream = stream_id
+        if stream_id != self.view_stream:
+            return []
         
-    def mouse_move(self, x, y):
-        """Gửi lệnh di chuyển chuột"""
-        return self.send_command('MOUSE_MOVE', {'x': x, 'y': y})
+        decoder = self.stream_decoders.get(stream_id)
+        if decoder is None:
+            decoder = self.stream_decoders[stream_id] = StreamDecoder(stream_id)
+        regions = decoder.apply(codec, frame_data, FRAME_HEADER.size, width, height)
+        if regions is None:
+            self.request_keyframe(stream_id)
+            return []
+        if decoder.missed_frame:
+            # Stream này mất frame tile: tile mới vẫn ghép được nhưng vùng của frame mất đã cũ
+            decoder.missed_frame = False
+            self.request_keyframe(stream_id)
+        
+        if regions:
+            if stream_id != self.frame_stream:
+                # Vừa chuyển stream: vẽ lại toàn bộ
+                self.frame_stream = stream_id
+                regions = [(0, 0, width, height)]
+            self.frame_capture_time = capture_us / 1_000_000
+            self.frame_input_seq = input_seq
+            self.frame_size = (width, height)
+            self.source_size = (source_width, source_height)
+        return regions
+    
+    def request_keyframe(self, stream_id=None, force=False):
+        """Xin Streamer gửi frame đầy đủ của stream (giới hạn tần suất)"""
+        now = time.time()
+        if not force and now - self.last_keyframe_request < self.keyframe_request_interval:
+            return
+        self.last_keyframe_request = now
+        self.send_command('REQUEST_KEYFRAME', {} if stream_id is None else {'stream_id': stream_id})
+    
+    def record_frame_arrival(self, frame_id):
+        """Ghi nhận frame hoàn chỉnh cho feedback và cập nhật interarrival jitter"""
+        now = time.monotonic()
+        if len(self.feedback_frames) < self.max_feedback_frames:
+            self.feedback_frames.append([frame_id, int(now * 1000)])
+        
+        if self.last_arrival is not None:
+            interarrival = now - self.last_arrival
+            if self.last_interarrival is not None:
+                self.jitter += (abs(interarrival - self.last_interarrival) - self.jitter) / 16
+            self.last_interarrival = interarrival
+        self.last_arrival = now
+    
+    def record_packet(self, seq):
+        """Ghi nhận seq của frame chunk để đo packet loss và reorder (có xét wrap-around uint32)"""
+        if self.packet_seq_highest is not None:
+            delta = (seq - self.packet_seq_highest) & 0xFFFFFFFF
+            if delta == 0:
+                return  # Trùng lặp
+            if delta < 0x80000000:
+                self.packet_seq_highest = seq
+            elif 0x100000000 - delta < 0x10000:
+                # Đến muộn so với packet có seq lớn hơn
+                self.packets_reordered += 1
+                self.total_packets_reordered += 1
+            else:
+                # seq nhảy lùi quá xa: Streamer đã khởi động lại
+                self.packet_seq_highest = None
+        if self.packet_seq_highest is None:
+            self.packet_seq_highest = seq
+            self.packet_seq_base = (seq - 1) & 0xFFFFFFFF
+            self.packets_received = 0
+        self.packets_received += 1
+    
+    def send_feedback(self):
+        """Gửi FEEDBACK qua TCP: frame đã nhận (kèm thời điểm nhận), tỉ lệ mất, jitter"""
+        self.last_feedback = time.monotonic()
+        newest_id = self.last_frame_id
+        if newest_id is None:
+            return
+        
+        received = len(self.feedback_frames)
+        if self.feedback_last_id is None or newest_id < self.feedback_last_id:
+            expected = received
+        else:
+            expected = newest_id - self.feedback_last_id
+        self.loss_rate = max(0.0, 1.0 - received / expected) if expected > 0 else 0.0
+        
+        # Packet loss theo seq: số packet lẽ ra đã nhận trong chu kỳ so với số thực nhận
+        packets_expected = 0
+        if self.packet_seq_highest is not None:
+            packets_expected = (self.packet_seq_highest - self.packet_seq_base) & 0xFFFFFFFF
+            self.packet_seq_base = self.packet_seq_highest
+        self.packet_loss = (max(0.0, 1.0 - self.packets_received / packets_expected)
+                            if packets_expected > 0 else 0.0)
+        
+        self.send_command('FEEDBACK', {
+            'frames': self.feedback_frames,
+            'received': received,
+            'expected': expected,
+            'loss': round(self.loss_rate, 4),
+            'packet_loss': round(self.packet_loss, 4),
+            'reordered': self.packets_reordered,
+            'jitter': round(self.jitter * 1000, 2)  # ms
+        })
+        self.packets_received = 0
+        self.packets_reordered = 0
+        self.feedback_frames = []
+        self.feedback_last_id = newest_id
+    
+    def expire_pending_frames(self, now):
+        """Bỏ các frame không nhận đủ chunk trước deadline"""
+        expired = [fid for fid, entry in self.pending_frames.items()
+                   if now - entry[2] > self.frame_timeout]
+        for fid in expired:
+            del self.pending_frames[fid]
+            self.frames_dropped += 1
+        
+    def mouse_click(self, x, y, button='left', frame_size=None):
+        """Gửi lệnh click chuột (tọa độ trên frame có kích thước frame_size)"""
+        payload = self.pointer_payload(x, y, frame_size, button=button)
+        return self.send_command('MOUSE_CLICK', self.track_input(payload))
+        
+    def mouse_move(self, x, y, frame_size=None):
+        """Gửi lệnh di chuyển chuột: chỉ giữ vị trí mới nhất, sender thread gửi theo tick"""
+        if not self.connected:
+            return False
+        
+        width, height = frame_size or self.frame_size or (0, 0)
+        clamp = lambda value: min(max(int(value), 0), 0xFFFF)
+        with self.move_lock:
+            wake = self.pending_move is None
+            stream_id = NO_STREAM if self.view_stream is None else self.view_stream
+            self.pending_move = (stream_id, clamp(x), clamp(y), clamp(width), clamp(height))
+        if wake:
+            self.send_queue.put(MOVE_WAKEUP)
+        return True
+    
+    def pointer_payload(self, x, y, frame_size=None, **extra):
+        """Payload tọa độ chuột kèm stream và kích thước frame để Streamer scale đúng khi độ phân giải vừa đổi"""
+        payload = {'x': x, 'y': y, **extra}
+        if self.view_stream is not None:
+            payload['stream_id'] = self.view_stream
+        frame_size = frame_size or self.frame_size
+        if frame_size:
+            payload['width'], payload['height'] = frame_size
+        return payload
+    
+    def list_monitors(self, timeout=2.0):
+        """Hỏi danh sách monitor của Streamer. Returns: list monitor (rỗng nếu không trả lời)"""
+        if not self.connected:
+            return []
+        with self.monitors_condition:
+            self.monitors = []
+            self.send_command('LIST_MONITORS')
+            self.monitors_condition.wait_for(lambda: self.monitors, timeout)
+            return list(self.monitors)
+    
+    def select_monitors(self, monitors, view=None):
+        """
+        Chọn monitor để Streamer stream (mỗi monitor một stream độc lập, 0 = toàn bộ desktop ảo)
+        và xem stream view (mặc định monitor đầu tiên).
+        """
+        self.view_monitor(monitors[0] if view is None else view)
+        return self.send_command('SELECT_MONITOR', {'monitors': list(monitors)})
+    
+    def view_monitor(self, stream_id):
+        """Chuyển stream hiển thị; xin keyframe vì stream khác không được giải mã trong lúc không xem"""
+        if stream_id == self.view_stream:
+            return
+        self.view_stream = stream_id
+        self.request_keyframe(stream_id, force=True)
+    
+    def set_region(self, left=None, top=None, width=None, height=None, window=False):
+        """
+        Region of interest của stream đang xem, tọa độ tương đối với monitor của Streamer.
+        window=True: theo cửa sổ đang focus; không có vùng: capture lại cả monitor.
+        """
+        payload = {}
+        if self.view_stream is not None:
+            payload['stream_id'] = self.view_stream
+        if window:
+            payload['window'] = True
+        elif width is not None:
+            payload.update(left=left or 0, top=top or 0, width=width, height=height)
+        return self.send_command('SET_REGION', payload)
+    
+    def set_resolution(self, width, height):
+        """Yêu cầu Streamer stream ở độ phân giải tối đa width x height (giữ tỉ lệ màn hình gốc)"""
+        return self.send_command('SET_RESOLUTION', {'width': width, 'height': height})
         
     def key_press(self, key):
         """Gửi lệnh nhấn phím"""
-        return self.send_command('KEY_PRESS', {'key': key})
+        return self.send_command('KEY_PRESS', self.track_input({'key': key}))
         
     def pause_stream(self):
         """Tạm dừng stream"""
@@ -199,31 +1061,136 @@ class ControllerClient:
         """Tiếp tục stream"""
         return self.send_command('CONTINUE')
         
-    def ping_test(self):
-        """Test độ trễ"""
+    def track_input(self, payload):
+        """Gắn input_seq vào lệnh input để đo input-to-photon khi frame phản ánh nó được hiển thị"""
+        self.input_seq = (self.input_seq + 1) & 0xFFFFFFFF
+        payload['input_seq'] = self.input_seq
+        self.pending_inputs.append((self.input_seq, time.monotonic()))
+        return payload
+    
+    def record_presented(self, frame):
+        """Frame vừa được trình chiếu: ghi độ trễ cho các input mà frame đã phản ánh"""
+        input_seq = frame.info.get('input_seq', 0)
+        now = time.monotonic()
+        while self.pending_inputs:
+            seq, sent = self.pending_inputs[0]
+            # So sánh có xét wrap-around của uint32
+            if ((input_seq - seq) & 0xFFFFFFFF) < 0x80000000:
+                self.input_latency_samples.append(now - sent)
+            elif now - sent <= self.input_timeout:
+                break
+            self.pending_inputs.popleft()
+    
+    def receive_messages(self):
+        """Nhận message TCP từ server (Streamer trả lời qua server)"""
+        while self.running:
+            try:
+                message = read_message(self.socket)
+                if message is None:
+                    break
+                self.handle_message(json.loads(message.decode('utf-8')))
+            except ValueError as e:
+                self.log(f"Invalid message from server: {e}")
+            except Exception as e:
+                if self.running:
+                    self.log(f"Error receiving message: {e}")
+                break
+    
+    def handle_message(self, message):
+        """Xử lý message từ Streamer (và PEER_INFO từ server)"""
+        if message.get('command') == 'PEER_INFO':
+            # Địa chỉ UDP ngoài NAT của Streamer do server quan sát: probe ngay để đục lỗ NAT
+            payload = message.get('payload', {})
+            if payload.get('peer_ip') and payload.get('peer_port') and payload.get('nonce'):
+                self.peer_nonce = payload['nonce'].encode('utf-8')
+                self.peer_address = (payload['peer_ip'], payload['peer_port'])
+                self.log(f"🔗 P2P: Streamer UDP address {self.peer_address[0]}:{self.peer_address[1]} - hole punching")
+                self.send_probes()
+        
+        elif message.get('command') == 'MONITORS':
+            payload = message.get('payload', {})
+            with self.monitors_condition:
+                self.monitors = payload.get('monitors', [])
+                self.streams = payload.get('streams', [])
+                self.monitors_condition.notify_all()
+            # Stream đang xem không còn được stream thì chuyển sang stream đầu tiên
+            if self.streams and self.view_stream not in self.streams:
+                self.view_monitor(self.streams[0])
+        
+        elif message.get('command') == 'PONG':
+            payload = message.get('payload', {})
+            sent = self.pending_pings.pop(payload.get('ping_id'), None)
+            if sent is None:
+                return
+            rtt = time.monotonic() - sent
+            self.rtt_samples.append(rtt)
+            with self.pong_condition:
+                self.last_pong = (payload.get('ping_id'), rtt)
+                self.pong_condition.notify_all()
+    
+    def send_ping(self):
+        """Gửi PING có timestamp monotonic; Streamer trả PONG. Returns: ping_id"""
+        now = time.monotonic()
+        # Ping không được trả lời sau 5s coi như mất
+        for ping_id in [pid for pid, sent in list(self.pending_pings.items()) if now - sent > 5.0]:
+            del self.pending_pings[ping_id]
+        
+        self.ping_id += 1
+        self.pending_pings[self.ping_id] = now
+        self.send_command('PING', {'ping_id': self.ping_id, 'sent': now})
+        return self.ping_id
+    
+    def ping_test(self, timeout=2.0):
+        """Test độ trễ: round-trip Controller -> server -> Streamer -> server -> Controller"""
         if not self.connected:
             return None
-            
-        start_time = time.time()
-        success = self.send_command('PING')
         
-        if success:
-            latency = (time.time() - start_time) * 1000  # ms
-            self.log(f"Ping latency: {latency:.2f}ms")
-            return latency
-        return None
+        ping_id = self.send_ping()
+        with self.pong_condition:
+            self.pong_condition.wait_for(
+                lambda: self.last_pong is not None and self.last_pong[0] == ping_id, timeout)
+            pong = self.last_pong
         
+        if pong is None or pong[0] != ping_id:
+            self.log(f"Ping timeout ({timeout:.1f}s)")
+            return None
+        latency = pong[1] * 1000  # ms
+        self.log(f"Ping round-trip: {latency:.2f}ms")
+        return latency
+    
+    def latency_stats(self):
+        """Percentile (ms) của round-trip và input-to-photon, None nếu chưa có mẫu"""
+        def to_ms(value):
+            return None if value is None else value * 1000
+        rtt = list(self.rtt_samples)
+        inputs = list(self.input_latency_samples)
+        return {
+            'rtt_p50': to_ms(percentile(rtt, 0.5)),
+            'rtt_p95': to_ms(percentile(rtt, 0.95)),
+            'rtt_p99': to_ms(percentile(rtt, 0.99)),
+            'input_p50': to_ms(percentile(inputs, 0.5)),
+            'input_p95': to_ms(percentile(inputs, 0.95)),
+            'input_p99': to_ms(percentile(inputs, 0.99))
+        }
+    
     def disconnect(self):
         """Ngắt kết nối"""
         self.running = False
-        self.connected = False
         
         if self.socket:
             try:
-                self.send_command('DISCONNECT')
+                # send_command chỉ nhận lệnh khi còn connected: xếp DISCONNECT trước,
+                # dừng sender thread sau khi gửi nốt các lệnh đang chờ rồi mới đánh dấu ngắt
+                if self.connected:
+                    self.send_command('DISCONNECT')
+                self.send_queue.put(None)
+                if self.sender_thread:
+                    self.sender_thread.join(timeout=1.0)
+                self.connected = False
                 self.socket.close()
             except:
                 pass
+        self.connected = False
                 
         self.log("Disconnected from server")
         
@@ -239,11 +1206,17 @@ class ControllerClient:
         print("  4. pause                   - Pause stream")
         print("  5. continue                - Continue stream")
         print("  6. ping                    - Test latency")
-        print("  7. quit                    - Disconnect and quit")
+        print("  7. monitors                - List Streamer monitors")
+        print("  8. monitor <id> [id...]    - Stream monitor(s), 0 = all monitors")
+        print("  9. view <id>               - Show one of the streamed monitors")
+        print(" 10. region <x> <y> <w> <h>  - Stream only a region of the monitor")
+        print(" 11. region window|off       - Follow the focused window / full monitor")
+        print(" 12. quit                    - Disconnect and quit")
         print("\nExamples:")
         print("  click 100 200 left")
         print("  move 150 250")
         print("  key enter")
+        print("  monitor 1 2")
         print("="*60 + "\n")
         
         while self.running and self.connected:
@@ -280,6 +1253,24 @@ class ControllerClient:
                 elif action == 'ping':
                     self.ping_test()
                     
+                elif action == 'monitors':
+                    for monitor in self.list_monitors():
+                        label = 'all' if monitor['id'] == 0 else monitor['id']
+                        print(f"  [{label}] {monitor['width']}x{monitor['height']} "
+                              f"at ({monitor['left']}, {monitor['top']})")
+                    
+                elif action == 'monitor' and len(parts) >= 2:
+                    self.select_monitors([int(part) for part in parts[1:]])
+                    
+                elif action == 'view' and len(parts) >= 2:
+                    self.view_monitor(int(parts[1]))
+                    
+                elif action == 'region' and len(parts) >= 5:
+                    self.set_region(*(int(part) for part in parts[1:5]))
+                    
+                elif action == 'region' and len(parts) == 2 and parts[1] in ('window', 'off'):
+                    self.set_region(window=parts[1] == 'window')
+                    
                 elif action == 'quit':
                     print("Disconnecting...")
                     break
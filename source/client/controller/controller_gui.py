@@ -6,17 +6,13 @@ Giao diện GUI hiện đại để điều khiển máy từ xa
 """
 
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import messagebox
 import threading
-import socket
-import json
 import time
-from datetime import datetime
 from controller_client import ControllerClient
 
 try:
     from PIL import Image, ImageTk
-    import io
 except ImportError:
     Image = None
     ImageTk = None
@@ -96,6 +92,15 @@ class ControllerGUI:
         self.last_image = None
         self.remote_width = 1920
         self.remote_height = 1080
+        self.requested_resolution = None  # Kích thước canvas đã gửi cho Streamer (SET_RESOLUTION)
+        
+        # Display engine: một PhotoImage dùng lại, chỉ tạo lại khi kích thước hiển thị đổi
+        self.photo = None
+        self.canvas_size = (0, 0)  # Cập nhật từ <Configure> để thread khác đọc không cần gọi Tk
+        self.display_lock = threading.Lock()
+        self.pending_display = None  # [image, regions, frame_size] chờ Tk main thread vẽ
+        self.max_dirty_regions = 32  # Nhiều vùng hơn thì paste cả frame
+        self.exact_fit_slack = 2  # Stream lệch canvas tới chừng này px (encoder làm tròn) vẫn vẽ 1:1
         
         # Statistics
         self.frames_received = 0
@@ -278,7 +283,10 @@ class ControllerGUI:
             ("Frames Received:", "frames"),
             ("Commands Sent:", "commands"),
             ("Connection Time:", "time"),
-            ("Frame Rate:", "fps")
+            ("Frame Rate:", "fps"),
+            ("Jitter Buffer:", "buffer"),
+            ("Ping RTT p50/p95:", "rtt"),
+            ("Input Latency p50/p95:", "input")
         ]
         
         for label_text, key in stats_info:
@@ -332,6 +340,33 @@ class ControllerGUI:
         self.toggle_stream_btn.pack(padx=15, pady=5)
         self.toggle_stream_btn.set_state("disabled")
         
+        # Chuyển monitor: Streamer chỉ capture/encode monitor đang xem
+        self.monitor_btn = ModernButton(
+            left_panel,
+            "🖥️ MONITOR 1",
+            self.cycle_monitor,
+            bg_color="#666666",
+            hover_color="#555555",
+            width=270,
+            height=40
+        )
+        self.monitor_btn.pack(padx=15, pady=5)
+        self.monitor_btn.set_state("disabled")
+        
+        # Region of interest: chỉ stream cửa sổ đang focus, ở độ phân giải gốc
+        self.region_btn = ModernButton(
+            left_panel,
+            "🎯 FOLLOW WINDOW",
+            self.toggle_follow_window,
+            bg_color="#666666",
+            hover_color="#555555",
+            width=270,
+            height=40
+        )
+        self.region_btn.pack(padx=15, pady=5)
+        self.region_btn.set_state("disabled")
+        self.following_window = False
+        
         # Track streaming state
         self.is_streaming = True
         
@@ -388,7 +423,9 @@ class ControllerGUI:
         # Bind mouse and keyboard events
         self.canvas.bind("<Button-1>", self.on_canvas_left_click)
         self.canvas.bind("<Button-3>", self.on_canvas_right_click)
+        self.canvas.bind("<Motion>", self.on_canvas_motion)
         self.canvas.bind("<KeyPress>", self.on_canvas_key_press)
+        self.canvas.bind("<Configure>", self.on_canvas_configure)
         self.canvas.focus_set()
         
         # Bottom Bar
@@ -455,11 +492,16 @@ class ControllerGUI:
             self.session_entry.config(state='disabled')
             self.password_entry.config(state='disabled')
             self.toggle_stream_btn.set_state("normal")  # Enable toggle button
+            self.monitor_btn.set_state("normal")
+            self.region_btn.set_state("normal")
+            self.following_window = False
+            self.region_btn.itemconfig(self.region_btn.text_id, text="🎯 FOLLOW WINDOW")
+            self.monitor_btn.itemconfig(self.monitor_btn.text_id, text="🖥️ MONITOR 1")
+            self.client.send_command('LIST_MONITORS')  # Trả lời cập nhật client.monitors
             self.is_streaming = True  # Initially streaming
             self.canvas.delete("placeholder")
             
-            # Start receiving frames - start the receiver thread in client
-            threading.Thread(target=self.client.receive_screen_data, daemon=True).start()
+            # Receiver thread đã được ControllerClient.connect() khởi động
             # Start display thread in GUI
             threading.Thread(target=self.receive_frames, daemon=True).start()
             threading.Thread(target=self.update_statistics, daemon=True).start()
@@ -485,6 +527,8 @@ class ControllerGUI:
         self.session_entry.config(state='normal')
         self.password_entry.config(state='normal')
         self.toggle_stream_btn.set_state("disabled")  # Disable toggle button
+        self.monitor_btn.set_state("disabled")
+        self.region_btn.set_state("disabled")
         self.is_streaming = True  # Reset state
         
         # Reset canvas
@@ -497,50 +541,92 @@ class ControllerGUI:
             tags="placeholder"
         )
         self.canvas_image_id = None
+        self.requested_resolution = None
+        self.photo = None
+        self.last_image = None
         
         self.resolution_label.config(text="No signal")
     
+    def on_canvas_configure(self, event):
+        """Lưu kích thước canvas (chạy trên Tk thread)"""
+        self.canvas_size = (event.width, event.height)
+    
     def receive_frames(self):
-        """Receive and display frames - PROPER THREAD-SAFE VERSION"""
-        last_update = 0
-        frame_buffer = None
-        pending_update = False
+        """
+        Chờ frame đã giải mã từ decode worker, scale về kích thước canvas ngay trên thread này
+        rồi chuyển sang Tk main thread (Tk chỉ còn việc paste).
+        """
+        last_seq = 0
         
         while self.connected and self.client:
             try:
-                # Read screen_data from client (which is updated by receive_screen_data thread)
-                if hasattr(self.client, 'screen_data') and self.client.screen_data and Image:
-                    current_time = time.time()
-                    # Throttle updates to 15 FPS (mượt hơn nhưng vẫn không nháy)
-                    if current_time - last_update >= 0.066 and not pending_update:
-                        frame_data = self.client.screen_data
-                        
-                        # Only process if actually new data
-                        if frame_data != frame_buffer:
-                            try:
-                                data_copy = bytes(frame_data)
-                                image = Image.open(io.BytesIO(data_copy))
-                                # CRITICAL FIX: Schedule update in main thread with flag to prevent queue buildup
-                                pending_update = True
-                                def update_wrapper(img=image):
-                                    nonlocal pending_update
-                                    self.display_frame(img)
-                                    pending_update = False
-                                self.root.after(0, update_wrapper)
-                                self.frames_received += 1
-                                last_update = current_time
-                                frame_buffer = frame_data
-                            except:
-                                pending_update = False
-                                
-                time.sleep(0.03)  # Check rate - nhanh hơn để catch frames kịp
+                # Đánh thức ngay khi có frame mới (không polling)
+                frame_seq, image, regions = self.client.frame_slot.wait(last_seq, timeout=0.5)
+                if frame_seq == last_seq or image is None:
+                    continue
+                last_seq = frame_seq
+                self.frames_received += 1
+                
+                display = self.prepare_display(image, regions)
+                if display is None:
+                    continue
+                
+                # Chỉ xếp một callback vào Tk mỗi lúc; frame đến sau ghi đè và gộp vùng thay đổi
+                with self.display_lock:
+                    schedule = self.pending_display is None
+                    if not schedule:
+                        pending_regions = self.pending_display[1]
+                        if (display[1] is None or pending_regions is None
+                                or self.pending_display[0].size != display[0].size):
+                            display[1] = None
+                        else:
+                            display[1] = pending_regions + display[1]
+                    self.pending_display = display
+                if schedule:
+                    self.root.after(0, self.display_pending)
             except Exception as e:
                 # Silent error, just continue
                 time.sleep(0.1)
                 continue
     
-    def display_frame(self, image):
-        """Display frame on canvas với proper buffering (NO FLICKER)"""
+    def prepare_display(self, image, regions):
+        """
+        Scale frame vừa canvas (giữ tỉ lệ) ngoài Tk thread.
+        Returns: [display_image, regions, frame_size]; regions = None nghĩa là vẽ lại toàn bộ
+        """
+        canvas_width, canvas_height = self.canvas_size
+        if canvas_width < 10 or canvas_height < 10:
+            return None
+        
+        frame_size = image.size
+        display_size = self.get_display_size(canvas_width, canvas_height, *frame_size)
+        
+        if display_size != frame_size:
+            # Stream thường đã đúng kích thước canvas (SET_RESOLUTION); khi lệch thì
+            # BILINEAR + reduce() đủ đẹp và rẻ hơn nhiều so với LANCZOS
+            image = image.resize(display_size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+            regions = None
+        return [image, regions, frame_size]
+    
+    def get_display_size(self, canvas_width, canvas_height, img_width, img_height):
+        """Kích thước vẽ frame trên canvas: 1:1 nếu chỉ lệch vài px (canvas lẻ, stream chẵn), ngược lại scale giữ tỉ lệ"""
+        if (abs(canvas_width - img_width) <= self.exact_fit_slack and
+                abs(canvas_height - img_height) <= self.exact_fit_slack):
+            # Vẽ 1:1 ở giữa canvas (anchor CENTER) để giữ đường paste vùng thay đổi
+            return (img_width, img_height)
+        scale = min(canvas_width / img_width, canvas_height / img_height)
+        return (max(1, int(img_width * scale)), max(1, int(img_height * scale)))
+    
+    def display_pending(self):
+        """Tk main thread: vẽ frame đang chờ"""
+        with self.display_lock:
+            display = self.pending_display
+            self.pending_display = None
+        if display is not None and self.connected:
+            self.display_frame(*display)
+    
+    def display_frame(self, image, regions=None, frame_size=None):
+        """Display frame on canvas: paste vào PhotoImage có sẵn, chỉ các vùng thay đổi nếu biết"""
         try:
             canvas_width = self.canvas.winfo_width()
             canvas_height = self.canvas.winfo_height()
@@ -548,7 +634,12 @@ class ControllerGUI:
             if canvas_width < 10 or canvas_height < 10:
                 return
             
-            img_width, img_height = image.size
+            # Stream đúng độ phân giải canvas, không encode pixel chỉ để thu nhỏ ở đây
+            if self.requested_resolution != (canvas_width, canvas_height) and self.client:
+                self.requested_resolution = (canvas_width, canvas_height)
+                self.client.set_resolution(canvas_width, canvas_height)
+            
+            img_width, img_height = frame_size or image.size
             self.remote_width = img_width
             self.remote_height = img_height
             
@@ -560,36 +651,31 @@ class ControllerGUI:
                 )
                 self._last_resolution = (img_width, img_height)
             
-            # Calculate scaling
-            scale_w = canvas_width / img_width
-            scale_h = canvas_height / img_height
-            scale = min(scale_w, scale_h)
-            
-            new_width = int(img_width * scale)
-            new_height = int(img_height * scale)
-            
-            # Resize image với LANCZOS quality
-            resized_image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            photo = ImageTk.PhotoImage(resized_image)
-            
-            # Keep reference to prevent garbage collection
-            self.last_image = photo
+            if self.photo is None or (self.photo.width(), self.photo.height()) != image.size:
+                # Kích thước hiển thị đổi - tạo PhotoImage mới (hiếm khi xảy ra)
+                self.photo = ImageTk.PhotoImage(image)
+                # Keep reference to prevent garbage collection
+                self.last_image = self.photo
+                if self.canvas_image_id is not None:
+                    self.canvas.itemconfig(self.canvas_image_id, image=self.photo)
+            elif regions is None or len(regions) > self.max_dirty_regions:
+                self.photo.paste(image)
+            else:
+                for region in regions:
+                    self.paste_region(image, region)
             
             # Calculate center position
             x = canvas_width // 2
             y = canvas_height // 2
             
-            # ATOMIC UPDATE - no flicker!
             if self.canvas_image_id is None:
                 # First time - create image
                 self.canvas_image_id = self.canvas.create_image(
                     x, y, 
-                    image=photo, 
+                    image=self.photo, 
                     anchor=tk.CENTER
                 )
             else:
-                # Update existing image in single atomic operation
-                self.canvas.itemconfig(self.canvas_image_id, image=photo)
                 # Only update position if changed
                 current_coords = self.canvas.coords(self.canvas_image_id)
                 if not current_coords or current_coords[0] != x or current_coords[1] != y:
@@ -598,6 +684,14 @@ class ControllerGUI:
         except Exception as e:
             pass
     
+    def paste_region(self, image, region):
+        """Chép một vùng thay đổi vào PhotoImage hiển thị (Tk 'photo copy -to')"""
+        x, y, w, h = region
+        if w <= 0 or h <= 0:
+            return
+        patch = ImageTk.PhotoImage(image.crop((x, y, x + w, y + h)))
+        self.canvas.tk.call(str(self.photo), 'copy', str(patch), '-to', x, y)
+    
     def update_statistics(self):
         """Update statistics display"""
         while self.connected:
@@ -621,10 +715,32 @@ class ControllerGUI:
                         fps = self.frames_received / elapsed
                         self.stats_labels['fps'].config(text=f"{fps:.1f} fps")
                 
+                # Độ trễ do jitter buffer thêm vào (trung bình / p95) và số frame bị bỏ
+                client = self.client
+                if client:
+                    presenter = client.presenter.stats()
+                    self.stats_labels['buffer'].config(
+                        text=f"+{presenter['added_avg_ms']:.0f}/{presenter['added_p95_ms']:.0f} ms, "
+                             f"drop {presenter['skipped']}")
+                    
+                    # Round-trip (PING/PONG qua server) và input-to-photon dạng percentile
+                    client.send_ping()
+                    latency = client.latency_stats()
+                    self.stats_labels['rtt'].config(
+                        text=self.format_percentiles(latency['rtt_p50'], latency['rtt_p95']))
+                    self.stats_labels['input'].config(
+                        text=self.format_percentiles(latency['input_p50'], latency['input_p95']))
+                
                 time.sleep(1)
             except:
                 break
     
+    def format_percentiles(self, p50, p95):
+        """Hiển thị cặp percentile (ms)"""
+        if p50 is None:
+            return "-"
+        return f"{p50:.0f}/{p95:.0f} ms"
+    
     def on_canvas_left_click(self, event):
         """Handle left mouse click"""
         if not self.connected or not self.client:
@@ -632,7 +748,7 @@ class ControllerGUI:
         
         x, y = self.canvas_to_remote_coords(event.x, event.y)
         if x is not None and y is not None:
-            self.client.mouse_click(x, y, "left")
+            self.client.mouse_click(x, y, "left", frame_size=(self.remote_width, self.remote_height))
             self.commands_sent += 1
             self.show_click_feedback(event.x, event.y, "left")
     
@@ -643,10 +759,19 @@ class ControllerGUI:
         
         x, y = self.canvas_to_remote_coords(event.x, event.y)
         if x is not None and y is not None:
-            self.client.mouse_click(x, y, "right")
+            self.client.mouse_click(x, y, "right", frame_size=(self.remote_width, self.remote_height))
             self.commands_sent += 1
             self.show_click_feedback(event.x, event.y, "right")
     
+    def on_canvas_motion(self, event):
+        """Handle mouse move - client gộp các move, không tính vào commands_sent"""
+        if not self.connected or not self.client:
+            return
+        
+        x, y = self.canvas_to_remote_coords(event.x, event.y)
+        if x is not None and y is not None:
+            self.client.mouse_move(x, y, frame_size=(self.remote_width, self.remote_height))
+    
     def on_canvas_key_press(self, event):
         """Handle keyboard input"""
         if not self.connected or not self.client:
@@ -661,12 +786,8 @@ class ControllerGUI:
         canvas_width = self.canvas.winfo_width()
         canvas_height = self.canvas.winfo_height()
         
-        scale_w = canvas_width / self.remote_width
-        scale_h = canvas_height / self.remote_height
-        scale = min(scale_w, scale_h)
-        
-        display_width = int(self.remote_width * scale)
-        display_height = int(self.remote_height * scale)
+        display_width, display_height = self.get_display_size(
+            canvas_width, canvas_height, self.remote_width, self.remote_height)
         
         offset_x = (canvas_width - display_width) // 2
         offset_y = (canvas_height - display_height) // 2
@@ -687,6 +808,38 @@ class ControllerGUI:
         """Show visual feedback for click - disabled cho Label"""
         pass  # Không dùng visual feedback với Label
     
+    def cycle_monitor(self):
+        """Chuyển sang monitor kế tiếp của Streamer (sau monitor cuối là toàn bộ desktop)"""
+        if not self.client or not self.connected:
+            return
+        
+        # Thứ tự: 1, 2, ..., N, rồi 0 (toàn bộ desktop ảo)
+        ids = [monitor['id'] for monitor in self.client.monitors if monitor['id'] != 0]
+        if len(ids) < 2:
+            return
+        ids.append(0)
+        current = self.client.view_stream
+        next_id = ids[(ids.index(current) + 1) % len(ids)] if current in ids else ids[0]
+        
+        self.client.select_monitors([next_id])
+        self.commands_sent += 1
+        # Stream mới capture cả monitor
+        self.following_window = False
+        self.region_btn.itemconfig(self.region_btn.text_id, text="🎯 FOLLOW WINDOW")
+        label = "ALL" if next_id == 0 else next_id
+        self.monitor_btn.itemconfig(self.monitor_btn.text_id, text=f"🖥️ MONITOR {label}")
+    
+    def toggle_follow_window(self):
+        """Bật/tắt chế độ chỉ stream cửa sổ đang focus trên máy Streamer"""
+        if not self.client or not self.connected:
+            return
+        
+        self.following_window = not self.following_window
+        self.client.set_region(window=self.following_window)
+        self.commands_sent += 1
+        text = "🖥️ FULL SCREEN" if self.following_window else "🎯 FOLLOW WINDOW"
+        self.region_btn.itemconfig(self.region_btn.text_id, text=text)
+    
     def toggle_streaming(self):
         """Toggle between pause and resume streaming"""
         if not self.client or not self.connected:
@@ -19,6 +19,16 @@ import sys
 import io
 import random
 import string
+import struct
+import hmac
+import queue
+import zlib
+import ctypes
+import shutil
+import subprocess
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 try:
     import mss
@@ -50,8 +60,675 @@ except ImportError:
     pyautogui = None
 
 
+# UDP packet header cho mọi datagram (frame chunk và gói điều khiển):
+# magic (uint16), version (uint8), type (uint8), seq (uint32, đếm theo từng frame chunk gửi đi),
+# capture_us (uint64, thời điểm capture của frame; 0 với gói điều khiển), payload_len (uint16)
+# Bên nhận phân loại gói bằng struct, không thử json.loads trên từng datagram
+PACKET_HEADER = struct.Struct('!HBBIQH')
+PACKET_MAGIC = 0x5244  # 'RD'
+PACKET_VERSION = 1
+PACKET_FRAME = 1  # Payload: CHUNK_HEADER + dữ liệu frame
+PACKET_CONTROL = 2  # Payload: JSON (đăng ký địa chỉ UDP, báo P2P)
+PACKET_PROBE = 3  # Payload: PROBE_MESSAGE + session_id - đo RTT / đục lỗ NAT
+
+# Probe: kind, target (server hoặc peer), server_rtt_us (RTT tới server của bên gửi, 0 = chưa biết)
+# seq/capture_us của header là id và thời điểm gửi probe (micro giây monotonic), bên trả lời giữ nguyên
+PROBE_MESSAGE = struct.Struct('!BBI')
+PROBE_REQUEST = 1
+PROBE_REPLY = 2
+PROBE_TARGET_SERVER = 0
+PROBE_TARGET_PEER = 1
+
+# Fragmented frame transport: mỗi frame được cắt thành nhiều chunk UDP nhỏ hơn MTU
+# Header mỗi chunk (ngay sau PACKET_HEADER): frame_id (uint32), chunk_index (uint16), chunk_count (uint16)
+CHUNK_HEADER = struct.Struct('!IHH')
+CHUNK_PAYLOAD_SIZE = 1400
+
+# Frame payload bắt đầu bằng metadata chung cho mọi codec:
+# codec id (uint8), stream_id (uint8, chỉ số monitor của mss, 0 = toàn bộ desktop ảo),
+# width, height của frame, source_width, source_height của màn hình gốc (uint16),
+# capture_us: thời điểm capture theo đồng hồ monotonic của Streamer (uint64, micro giây),
+# input_seq: input_seq của lệnh chuột/phím cuối cùng đã thực thi trước khi capture (uint32)
+FRAME_HEADER = struct.Struct('!BBHHHHQI')
+CODEC_TILES = 1
+CODEC_DELTA = 2
+
+# Codec tile JPEG: chỉ gửi các tile thay đổi
+# Sau frame header: sequence (uint32, tăng theo từng frame của stream), tile_count (uint16),
+# sau đó là danh sách tile. Mỗi tile: x, y, w, h (uint16), jpeg_length (uint32) + JPEG bytes
+TILE_SIZE = 64
+TILE_FRAME_HEADER = struct.Struct('!IH')
+TILE_HEADER = struct.Struct('!HHHHI')
+
+# Codec XOR-delta + zlib: frame_type (uint8), sequence (uint32)
+# rồi đến pixel RGB (keyframe) hoặc XOR với frame trước (delta) đã nén zlib
+DELTA_FRAME_HEADER = struct.Struct('!BI')
+DELTA_KEYFRAME = 0
+DELTA_INTERFRAME = 1
+
+# TCP command channel: mỗi message = length (uint32, big-endian) + payload
+# Payload JSON luôn bắt đầu bằng '{'; message nhị phân bắt đầu bằng type (uint8)
+MESSAGE_HEADER = struct.Struct('!I')
+MAX_MESSAGE_SIZE = 1024 * 1024
+
+# Mouse move nhị phân: type, stream_id (uint8), x, y, width, height của frame (uint16)
+MSG_MOUSE_MOVE = 0x01
+MOUSE_MOVE_MESSAGE = struct.Struct('!BBHHHH')
+
+
+def encode_packet(packet_type, payload, seq=0, capture_us=0):
+    """Đóng gói payload thành datagram có PACKET_HEADER"""
+    return PACKET_HEADER.pack(PACKET_MAGIC, PACKET_VERSION, packet_type, seq, capture_us,
+                              len(payload)) + payload
+
+
+def encode_message(message):
+    """Đóng gói một dict thành message JSON có length prefix"""
+    payload = json.dumps(message).encode('utf-8')
+    return MESSAGE_HEADER.pack(len(payload)) + payload
+
+
+class MessageDecoder:
+    """Streaming decoder: ghép các đoạn byte TCP thành từng message hoàn chỉnh"""
+    def __init__(self):
+        self.buffer = bytearray()
+    
+    def feed(self, data):
+        """Thêm dữ liệu vừa nhận, trả về list payload của các message đã đủ"""
+        self.buffer += data
+        messages = []
+        offset = 0
+        while len(self.buffer) - offset >= MESSAGE_HEADER.size:
+            (length,) = MESSAGE_HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_MESSAGE_SIZE:
+                raise ValueError(f"Message too large: {length} bytes")
+            end = offset + MESSAGE_HEADER.size + length
+            if end > len(self.buffer):
+                break
+            messages.append(bytes(self.buffer[offset + MESSAGE_HEADER.size:end]))
+            offset = end
+        del self.buffer[:offset]
+        return messages
+
+
+# Shared memory đã attach trong mỗi worker process (shape -> SharedMemory, cũ nhất trước).
+# Mỗi shape chỉ giữ mapping mới nhất; tối đa SHARED_FRAMES_MAX shape như phía process chính
+SHARED_FRAMES_MAX = 8
+_worker_shared_frames = {}
+
+
+def encode_tiles_worker(shm_name, shape, tiles, quality):
+    """
+    Chạy trong worker process: đọc frame từ shared memory, nén các tile thành JPEG.
+    Chỉ tọa độ tile đi qua pickle, pixel không bị copy giữa các process.
+    """
+    shape = tuple(shape)
+    shm = _worker_shared_frames.pop(shape, None)
+    if shm is not None and shm.name != shm_name:
+        # Process chính đã tạo shm mới cho shape này, mapping cũ không còn dùng
+        shm.close()
+        shm = None
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_shared_frames[shape] = shm
+    while len(_worker_shared_frames) > SHARED_FRAMES_MAX:
+        _worker_shared_frames.pop(next(iter(_worker_shared_frames))).close()
+    pixels = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    
+    results = []
+    for x, y, w, h in tiles:
+        output = io.BytesIO()
+        Image.fromarray(pixels[y:y + h, x:x + w]).save(
+            output, format='JPEG', quality=quality, optimize=True, progressive=True)
+        results.append(output.getvalue())
+    return results
+
+
+class ProcessPoolEncoder:
+    """Encode JPEG tile trên nhiều process để thoát GIL; frame chia sẻ qua shared memory"""
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        # Ít pixel hơn mức này (vài tile khi gõ phím) thì nén trên thread gọi nhanh hơn
+        # copy shared memory + một vòng IPC cho mỗi worker
+        self.min_offload_pixels = 16 * TILE_SIZE * TILE_SIZE
+        # Một shm cho mỗi shape frame (nhiều MonitorStream, ROI, scale), dùng lại giữa các frame
+        self.frames = {}  # shape -> SharedMemory, cũ nhất trước
+    
+    def split_bands(self, width, height):
+        """Chia full frame thành các dải ngang (bội số 16px) để mỗi worker nén một dải"""
+        band_height = -(-height // self.workers)
+        band_height = -(-band_height // 16) * 16
+        return [(0, y, width, min(band_height, height - y)) for y in range(0, height, band_height)]
+    
+    def encode_tiles(self, pixels, tiles, quality):
+        """
+        Nén các tile của frame song song.
+        Returns: list JPEG bytes theo thứ tự tiles, None nếu tile quá ít - caller tự nén trên thread của nó
+        """
+        if sum(w * h for _, _, w, h in tiles) < self.min_offload_pixels:
+            return None
+        
+        shape = pixels.shape
+        shm = self.frames.pop(shape, None)
+        if shm is None:
+            shm = shared_memory.SharedMemory(create=True, size=pixels.nbytes)
+            while len(self.frames) >= SHARED_FRAMES_MAX:
+                self.release_frame(next(iter(self.frames)))
+        self.frames[shape] = shm
+        # Chỉ copy các hàng chứa tile thay đổi (hàng liên tục trong bộ nhớ), worker chỉ đọc các tile này
+        top = min(y for _, y, _, _ in tiles)
+        bottom = max(y + h for _, y, _, h in tiles)
+        np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)[top:bottom] = pixels[top:bottom]
+        
+        # Phân tile xen kẽ cho các worker để cân bằng tải
+        groups = [tiles[i::self.workers] for i in range(self.workers)]
+        futures = [self.executor.submit(encode_tiles_worker, shm.name, shape, group, quality)
+                   for group in groups if group]
+        
+        results = [None] * len(tiles)
+        for worker_index, future in enumerate(futures):
+            for group_index, jpeg_data in enumerate(future.result()):
+                results[worker_index + group_index * self.workers] = jpeg_data
+        return results
+    
+    def release_frame(self, shape):
+        """Giải phóng shared memory của một shape frame"""
+        shm = self.frames.pop(shape)
+        shm.close()
+        shm.unlink()
+    
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for shape in list(self.frames):
+            self.release_frame(shape)
+
+
+class TileJpegEncoder:
+    """
+    Codec tile JPEG: chỉ nén các tile thay đổi so với frame đã gửi.
+    Mỗi frame tự giải mã được theo từng tile, full refresh định kỳ bù UDP loss.
+    """
+    codec_id = CODEC_TILES
+    
+    def __init__(self, encoder_pool=None):
+        self.encoder_pool = encoder_pool
+        self.last_sent_pixels = None  # Pixels của frame đã gửi gần nhất (numpy)
+        self.full_frame_ratio = 0.5  # Quá 50% tile thay đổi thì gửi nguyên frame
+        self.full_refresh_interval = 2.0  # Gửi lại toàn bộ frame để bù UDP loss
+        self.last_full_refresh = 0
+        self.sequence = 0  # Controller thấy hụt sequence của stream thì xin full frame
+    
+    def request_keyframe(self):
+        """Frame tiếp theo sẽ là full frame"""
+        self.last_full_refresh = 0
+    
+    def find_dirty_tiles(self, pixels):
+        """
+        So sánh frame hiện tại với frame đã gửi theo từng tile TILE_SIZE x TILE_SIZE
+        Returns: list (x, y, w, h) của các tile thay đổi, hoặc None nếu cần gửi full frame
+        """
+        if self.last_sent_pixels is None or self.last_sent_pixels.shape != pixels.shape:
+            return None
+        
+        height, width = pixels.shape[:2]
+        changed = np.any(pixels != self.last_sent_pixels, axis=2)
+        # Gộp pixel thay đổi theo hàng tile rồi theo cột tile
+        changed = np.logical_or.reduceat(changed, np.arange(0, height, TILE_SIZE), axis=0)
+        changed = np.logical_or.reduceat(changed, np.arange(0, width, TILE_SIZE), axis=1)
+        
+        if changed.sum() > changed.size * self.full_frame_ratio:
+            return None
+        
+        tiles = []
+        for row, col in zip(*np.nonzero(changed)):
+            x = int(col) * TILE_SIZE
+            y = int(row) * TILE_SIZE
+            tiles.append((x, y, min(TILE_SIZE, width - x), min(TILE_SIZE, height - y)))
+        return tiles
+    
+    def encode(self, img, buffer, quality):
+        """
+        Encode frame thành danh sách tile JPEG đã thay đổi, ghi vào buffer (BytesIO dùng lại)
+        ngay sau frame header mà StreamerClient đã ghi.
+        Returns: memoryview của payload (phải release() trước khi dùng lại buffer),
+                 hoặc None nếu không có tile nào thay đổi
+        """
+        pixels = np.asarray(img)
+        width, height = img.size
+        
+        now = time.time()
+        tiles = None
+        if now - self.last_full_refresh < self.full_refresh_interval:
+            tiles = self.find_dirty_tiles(pixels)
+            if tiles is not None and not tiles:
+                return None
+        
+        if tiles is None:
+            # Full frame: một tile duy nhất phủ toàn bộ màn hình (hoặc mỗi worker một dải)
+            if self.encoder_pool is not None:
+                tiles = self.encoder_pool.split_bands(width, height)
+            else:
+                tiles = [(0, 0, width, height)]
+            self.last_full_refresh = now
+        
+        jpeg_tiles = None
+        if self.encoder_pool is not None:
+            jpeg_tiles = self.encoder_pool.encode_tiles(pixels, tiles, quality)
+        
+        # Ghi đè tiếp sau frame header (không truncate để giữ vùng nhớ đã cấp phát)
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        buffer.write(TILE_FRAME_HEADER.pack(self.sequence, len(tiles)))
+        for index, (x, y, w, h) in enumerate(tiles):
+            # Ghi header tạm, encode JPEG ngay sau đó rồi điền lại độ dài
+            header_pos = buffer.tell()
+            buffer.write(TILE_HEADER.pack(x, y, w, h, 0))
+            if jpeg_tiles is not None:
+                buffer.write(jpeg_tiles[index])
+            else:
+                tile_img = img if (w, h) == (width, height) else img.crop((x, y, x + w, y + h))
+                tile_img.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True)
+            end_pos = buffer.tell()
+            buffer.seek(header_pos)
+            buffer.write(TILE_HEADER.pack(x, y, w, h, end_pos - header_pos - TILE_HEADER.size))
+            buffer.seek(end_pos)
+        
+        self.last_sent_pixels = pixels
+        return buffer.getbuffer()[:end_pos]
+
+
+class DeltaZlibEncoder:
+    """
+    Codec inter-frame: keyframe là pixel RGB thô nén zlib, các frame sau là
+    XOR với frame trước rồi nén zlib (vùng không đổi thành byte 0, nén rất tốt).
+    Lossless; delta phụ thuộc chuỗi frame nên controller phải xin keyframe khi mất gói.
+    """
+    codec_id = CODEC_DELTA
+    
+    def __init__(self, keyframe_interval=150, compress_level=1):
+        self.keyframe_interval = keyframe_interval  # Số frame giữa 2 keyframe
+        self.compress_level = compress_level
+        self.reference = None  # Frame đã gửi gần nhất (numpy), decoder giữ bản giống hệt
+        self.delta = None  # Buffer XOR dùng lại giữa các frame
+        self.sequence = 0
+        self.frames_since_keyframe = 0
+        self.force_keyframe = True
+    
+    def request_keyframe(self):
+        """Frame tiếp theo sẽ là keyframe"""
+        self.force_keyframe = True
+    
+    def encode(self, img, buffer, quality):
+        """
+        Encode frame thành keyframe hoặc delta so với frame trước (quality không dùng - lossless).
+        Returns: memoryview của payload, hoặc None nếu frame không đổi
+        """
+        pixels = np.asarray(img)
+        
+        keyframe = (self.force_keyframe or self.reference is None
+                    or self.reference.shape != pixels.shape
+                    or self.frames_since_keyframe >= self.keyframe_interval)
+        if keyframe:
+            data = pixels
+            if self.delta is None or self.delta.shape != pixels.shape:
+                self.delta = np.empty_like(pixels)
+            self.frames_since_keyframe = 0
+            self.force_keyframe = False
+        else:
+            data = np.bitwise_xor(pixels, self.reference, out=self.delta)
+            if not data.any():
+                return None
+            self.frames_since_keyframe += 1
+        
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        buffer.write(DELTA_FRAME_HEADER.pack(
+            DELTA_KEYFRAME if keyframe else DELTA_INTERFRAME, self.sequence))
+        buffer.write(zlib.compress(data, self.compress_level))
+        end_pos = buffer.tell()
+        
+        self.reference = pixels
+        return buffer.getbuffer()[:end_pos]
+
+
+ENCODERS = {
+    'jpeg': TileJpegEncoder,
+    'delta': DeltaZlibEncoder,
+}
+
+
+class RateController:
+    """
+    AIMD rate control theo feedback của Controller (frame đã nhận, loss, jitter).
+    Bitrate mục tiêu giảm theo cấp số nhân khi mất gói hoặc queueing delay tăng,
+    tăng tuyến tính khi mạng ổn; quality, scale và fps được chỉnh để bitrate thực tế bám mục tiêu.
+    """
+    def __init__(self):
+        self.target_bitrate = 4_000_000  # bit/s
+        self.initial_bitrate = 4_000_000
+        self.min_bitrate = 200_000
+        self.max_bitrate = 50_000_000
+        self.additive_step = 200_000  # Tăng mỗi lần feedback không nghẽn
+        self.decrease_factor = 0.85
+        self.loss_threshold = 0.02  # Quá 2% frame mất thì coi là nghẽn
+        self.heavy_loss_threshold = 0.1
+        self.delay_threshold = 0.1  # Queueing delay quá 100ms thì coi là nghẽn
+        self.idle_fraction = 0.3  # Gửi dưới 30% mục tiêu là màn hình gần tĩnh, không đủ căn cứ để tăng
+        self.delay_window = 10.0  # Base delay = min one-way delay trong 10s gần nhất
+        self.delays = deque()  # (time, delay)
+        self.feedback_timeout = 3.0  # Không có feedback quá 3s thì tắt rate control
+        
+        self.quality_range = (40, 85)
+        self.scale_range = (0.5, 1.0)
+        self.fps_range = (10, 30)
+        self.quality = 70
+        self.scale = 1.0
+        self.fps = 30
+        
+        self.last_feedback = 0
+        self.last_bytes_sent = 0
+        self.send_rate = 0  # bit/s đo được giữa 2 lần feedback
+        self.loss = 0.0
+        self.jitter = 0.0
+        self.queue_delay = 0.0
+    
+    @property
+    def active(self):
+        return time.monotonic() - self.last_feedback < self.feedback_timeout
+    
+    def measure_delay(self, frames, send_times, now):
+        """
+        Queueing delay từ (frame_id, arrival_ms) của Controller và thời điểm gửi của Streamer.
+        Hai đồng hồ lệch nhau một hằng số nên chỉ dùng độ tăng so với base delay.
+        """
+        latest = None
+        for frame_id, arrival_ms in frames:
+            send_time = send_times.get(frame_id)
+            if send_time is None:
+                continue
+            latest = arrival_ms / 1000.0 - send_time
+            self.delays.append((now, latest))
+        while self.delays and now - self.delays[0][0] > self.delay_window:
+            self.delays.popleft()
+        if latest is None or not self.delays:
+            return self.queue_delay
+        return latest - min(delay for _, delay in self.delays)
+    
+    def on_feedback(self, report, send_times, bytes_sent):
+        """Cập nhật bitrate mục tiêu và các tham số stream. Returns: True nếu tham số thay đổi"""
+        now = time.monotonic()
+        elapsed = now - self.last_feedback if self.last_feedback else 0
+        sent = bytes_sent - self.last_bytes_sent
+        self.last_feedback = now
+        self.last_bytes_sent = bytes_sent
+        if elapsed <= 0 or elapsed > self.feedback_timeout:
+            return False
+        self.send_rate = sent * 8 / elapsed
+        
+        # Packet loss theo seq là tín hiệu nghẽn chính xác hơn frame loss (frame lớn mất nhiều hơn)
+        self.loss = float(report.get('packet_loss', report.get('loss', 0.0)))
+        if report.get('received', 0) == 0 and sent > 0:
+            self.loss = 1.0  # Đã gửi nhưng Controller không nhận được frame nào
+        self.jitter = float(report.get('jitter', 0.0))
+        self.queue_delay = self.measure_delay(report.get('frames', []), send_times, now)
+        
+        congested = self.loss > self.loss_threshold or self.queue_delay > self.delay_threshold
+        if congested:
+            # Multiplicative decrease: về dưới mức đang thực sự đi qua được
+            self.target_bitrate = max(self.min_bitrate,
+                                      min(self.target_bitrate, self.send_rate) * self.decrease_factor)
+        else:
+            # Additive increase, không tăng quá xa khi stream đang ít dữ liệu (màn hình tĩnh)
+            ceiling = max(self.send_rate * 2, self.initial_bitrate)
+            self.target_bitrate = min(self.max_bitrate, ceiling,
+                                      self.target_bitrate + self.additive_step)
+        
+        settings = (self.quality, self.scale, self.fps)
+        if self.send_rate > self.target_bitrate:
+            self.step_down()
+            if self.loss > self.heavy_loss_threshold:
+                self.step_down()
+        elif (not congested and self.target_bitrate * self.idle_fraction
+              <= self.send_rate < self.target_bitrate * 0.7):
+            # Chỉ tăng khi link thực sự đang được dùng: lúc tĩnh send_rate ~ 0 không chứng minh
+            # link chịu được mức cao hơn, chuyển động đầu tiên sẽ gây nghẽn rồi lại giảm
+            self.step_up()
+        return settings != (self.quality, self.scale, self.fps)
+    
+    def step_down(self):
+        """Giảm bitrate: quality trước, rồi resolution, rồi fps"""
+        if self.quality > 60:
+            self.quality -= 5
+        elif self.scale > self.scale_range[0]:
+            self.scale = max(self.scale_range[0], self.scale - 0.125)
+        elif self.fps > self.fps_range[0]:
+            self.fps = max(self.fps_range[0], self.fps - 5)
+        elif self.quality > self.quality_range[0]:
+            self.quality -= 5
+    
+    def step_up(self):
+        """Tăng bitrate theo thứ tự ngược lại"""
+        if self.quality < 60:
+            self.quality += 5
+        elif self.fps < self.fps_range[1]:
+            self.fps = min(self.fps_range[1], self.fps + 5)
+        elif self.scale < self.scale_range[1]:
+            self.scale = min(self.scale_range[1], self.scale + 0.125)
+        elif self.quality < self.quality_range[1]:
+            self.quality += 5
+
+
+class PathSelector:
+    """
+    Chọn đường gửi frame tới Controller: trực tiếp (UDP hole punching) hoặc relay qua server.
+    RTT trực tiếp đo bằng probe tới Controller; RTT relay ước lượng bằng RTT Streamer-server
+    cộng RTT Controller-server (Controller báo trong probe). Dùng đường trực tiếp khi Controller
+    trả lời probe và RTT không tệ hơn relay quá nhiều; quay về relay khi hết trả lời.
+    """
+    def __init__(self):
+        self.peer_address = None  # Địa chỉ UDP của Controller do server báo trong PEER_INFO
+        self.direct = False
+        self.direct_rtt = None  # giây, làm mượt
+        self.server_rtt = None
+        self.peer_server_rtt = None
+        self.last_peer_reply = 0
+        self.direct_timeout = 3.0  # Không có trả lời từ Controller quá 3s thì quay về relay
+        self.enter_ratio = 1.2  # Vào direct khi direct_rtt <= relay_rtt * 1.2
+        self.leave_ratio = 1.5  # Rời direct khi direct_rtt > relay_rtt * 1.5 (trễ để không dao động)
+        self.smoothing = 0.25
+    
+    @property
+    def relay_rtt(self):
+        if self.server_rtt is None or self.peer_server_rtt is None:
+            return None
+        return self.server_rtt + self.peer_server_rtt
+    
+    def set_peer(self, address):
+        """Địa chỉ mới của Controller: đo lại từ đầu"""
+        if address != self.peer_address:
+            self.peer_address = address
+            self.direct_rtt = None
+            self.last_peer_reply = 0
+    
+    def smooth(self, current, sample):
+        return sample if current is None else current + (sample - current) * self.smoothing
+    
+    def on_server_reply(self, rtt):
+        self.server_rtt = self.smooth(self.server_rtt, rtt)
+    
+    def on_peer_reply(self, rtt, peer_server_rtt, now):
+        self.direct_rtt = self.smooth(self.direct_rtt, rtt)
+        if peer_server_rtt:
+            self.peer_server_rtt = peer_server_rtt
+        self.last_peer_reply = now
+    
+    def evaluate(self, now):
+        """Chọn lại đường theo kết quả probe. Returns: True nếu đổi đường"""
+        reachable = (self.peer_address is not None and self.direct_rtt is not None
+                     and now - self.last_peer_reply < self.direct_timeout)
+        relay_rtt = self.relay_rtt
+        if not reachable:
+            direct = False
+        elif relay_rtt is None:
+            direct = True  # Chưa đo được relay: đường trực tiếp đã thông thì dùng luôn
+        elif self.direct:
+            direct = self.direct_rtt <= relay_rtt * self.leave_ratio
+        else:
+            direct = self.direct_rtt <= relay_rtt * self.enter_ratio
+        changed = direct != self.direct
+        self.direct = direct
+        return changed
+
+
+# Region of interest: stream theo cửa sổ đang focus thay vì một hình chữ nhật cố định
+ROI_WINDOW = 'window'
+MIN_REGION_SIZE = 64  # Vùng nhỏ hơn thì capture cả monitor
+
+
+def clip_rect(rect, bounds):
+    """Giao của rect với bounds (left, top, width, height). Returns: rect hoặc None nếu quá nhỏ"""
+    left = max(rect[0], bounds[0])
+    top = max(rect[1], bounds[1])
+    right = min(rect[0] + rect[2], bounds[0] + bounds[2])
+    bottom = min(rect[1] + rect[3], bounds[1] + bounds[3])
+    if right - left < MIN_REGION_SIZE or bottom - top < MIN_REGION_SIZE:
+        return None
+    return (left, top, right - left, bottom - top)
+
+
+def foreground_window_rect():
+    """
+    Vùng cửa sổ đang focus (left, top, width, height) trên desktop ảo.
+    Windows: user32; X11: xdotool. Returns: None nếu không xác định được
+    """
+    try:
+        if sys.platform == 'win32':
+            from ctypes import wintypes
+            user32 = ctypes.windll.user32
+            hwnd = user32.GetForegroundWindow()
+            rect = wintypes.RECT()
+            if not hwnd or not user32.GetWindowRect(hwnd, ctypes.byref(rect)):
+                return None
+            return (rect.left, rect.top, rect.right - rect.left, rect.bottom - rect.top)
+        
+        if shutil.which('xdotool'):
+            output = subprocess.run(['xdotool', 'getactivewindow', 'getwindowgeometry', '--shell'],
+                                    capture_output=True, text=True, timeout=1).stdout
+            values = dict(line.split('=', 1) for line in output.splitlines() if '=' in line)
+            return (int(values['X']), int(values['Y']), int(values['WIDTH']), int(values['HEIGHT']))
+    except Exception:
+        pass
+    return None
+
+
+class MonitorStream:
+    """
+    Một stream độc lập cho một monitor: geometry, motion state và encoder riêng.
+    stream_id là chỉ số monitor của mss (0 = toàn bộ desktop ảo).
+    """
+    def __init__(self, stream_id, geometry, sample_size=(160, 120), regions=(8, 6),
+                 pixel_threshold=30, threshold=5.0):
+        self.stream_id = stream_id
+        self.geometry = geometry  # (left, top, width, height) trên desktop ảo
+        self.stream_size = (800, 600)  # Kích thước frame đang stream (để map tọa độ chuột)
+        
+        # Region of interest: None = cả monitor, (left, top, width, height) tương đối với monitor,
+        # hoặc ROI_WINDOW = theo cửa sổ đang focus. ROI được encode ở độ phân giải gốc
+        self.region = None
+        self.window_rect = None  # ROI_WINDOW: vùng cửa sổ gần nhất (tuyệt đối, đã cắt theo monitor)
+        self.window_poll_time = 0
+        self.frame_rect = geometry  # Vùng tuyệt đối của frame gửi gần nhất (để map tọa độ chuột)
+        self.encoder = None  # Tạo trên encode thread ở frame đầu tiên
+        self.frames_since_last_send = 0
+        
+        # Motion detection chạy trên raw capture (lấy mẫu theo stride),
+        # buffer cấp phát một lần theo kích thước màn hình
+        self.motion_threshold = threshold  # % change threshold (trên vùng thay đổi nhiều nhất)
+        self.motion_sample_size = sample_size  # Lưới mẫu xấp xỉ
+        self.motion_regions = regions  # Số vùng (cột, hàng) của change map
+        self.motion_pixel_threshold = pixel_threshold  # Pixel lệch hơn mức này thì tính là thay đổi
+        self.motion_reference = None  # Mẫu của frame tham chiếu (uint8)
+        self.motion_high = None
+        self.motion_low = None
+        self.motion_mask = None
+        self.motion_region_rows = None
+        self.motion_region_cols = None
+        self.motion_region_sizes = None
+    
+    def capture_rect(self):
+        """Vùng capture tuyệt đối (left, top, width, height) trên desktop ảo"""
+        region = self.region
+        if region is None:
+            return self.geometry
+        if region == ROI_WINDOW:
+            return self.window_rect or self.geometry
+        left, top, width, height = region
+        return clip_rect((self.geometry[0] + left, self.geometry[1] + top, width, height),
+                         self.geometry) or self.geometry
+    
+    def sample_motion_grid(self, screenshot):
+        """
+        View lấy mẫu theo stride trên raw BGRA của mss (không copy).
+        Dùng kênh G làm độ sáng xấp xỉ để chỉ tính toán trên số nguyên.
+        """
+        width, height = screenshot.size
+        raw = np.frombuffer(screenshot.raw, dtype=np.uint8).reshape(height, width, 4)
+        step_x = max(1, width // self.motion_sample_size[0])
+        step_y = max(1, height // self.motion_sample_size[1])
+        return raw[::step_y, ::step_x, 1]
+    
+    def allocate_motion_buffers(self, sample):
+        """Cấp phát buffer của motion detection theo kích thước lưới mẫu"""
+        rows, cols = sample.shape
+        self.motion_reference = sample.copy()
+        self.motion_high = np.empty_like(self.motion_reference)
+        self.motion_low = np.empty_like(self.motion_reference)
+        self.motion_mask = np.empty(sample.shape, dtype=bool)
+        
+        region_cols, region_rows = self.motion_regions
+        self.motion_region_rows = np.unique(np.linspace(0, rows, region_rows, endpoint=False).astype(np.intp))
+        self.motion_region_cols = np.unique(np.linspace(0, cols, region_cols, endpoint=False).astype(np.intp))
+        ones = np.ones(sample.shape, dtype=np.int32)
+        self.motion_region_sizes = self.reduce_regions(ones)
+    
+    def reduce_regions(self, values):
+        """Cộng giá trị theo từng vùng của change map"""
+        sums = np.add.reduceat(values, self.motion_region_rows, axis=0, dtype=np.int32)
+        return np.add.reduceat(sums, self.motion_region_cols, axis=1, dtype=np.int32)
+    
+    def detect_motion(self, screenshot):
+        """
+        LEVEL 2: Detect if there's significant motion between frames
+        So sánh lưới mẫu của raw capture với frame tham chiếu, chỉ dùng uint8 và buffer có sẵn.
+        Returns: (has_motion, change_percentage, region_change_map)
+                 region_change_map: % pixel thay đổi của từng vùng, shape (hàng, cột)
+        """
+        sample = self.sample_motion_grid(screenshot)
+        
+        if self.motion_reference is None or self.motion_reference.shape != sample.shape:
+            self.allocate_motion_buffers(sample)
+            return True, 100.0, None  # First frame always send
+        
+        # |a - b| không tràn uint8: max(a, b) - min(a, b)
+        np.maximum(sample, self.motion_reference, out=self.motion_high)
+        np.minimum(sample, self.motion_reference, out=self.motion_low)
+        np.subtract(self.motion_high, self.motion_low, out=self.motion_high)
+        np.greater(self.motion_high, self.motion_pixel_threshold, out=self.motion_mask)
+        
+        change_percent = np.count_nonzero(self.motion_mask) * 100.0 / self.motion_mask.size
+        region_map = self.reduce_regions(self.motion_mask) * 100.0 / self.motion_region_sizes
+        
+        # Thay đổi cục bộ (gõ phím, con trỏ) cũng tính là motion dù % toàn màn hình nhỏ
+        has_motion = bool(region_map.max() > self.motion_threshold)
+        
+        # Update last frame if motion detected
+        if has_motion:
+            np.copyto(self.motion_reference, sample)
+        
+        return has_motion, change_percent, region_map
+
+
 class StreamerClient:
-    def __init__(self, server_ip, tcp_port=5555, udp_port=5556):
+    def __init__(self, server_ip, tcp_port=5555, udp_port=5556, encoder_processes=0, codec='jpeg'):
         self.server_ip = server_ip
         self.tcp_port = tcp_port
         self.udp_port = udp_port
@@ -70,6 +747,18 @@ class StreamerClient:
         # Don't create mss here, create in thread
         self.screen_capturer = None
         
+        # Geometry các monitor (left, top, width, height) theo chỉ số mss, cache từ mss:
+        # index 0 là toàn bộ desktop ảo. Dùng chung cho capture và đổi tọa độ input;
+        # capture thread làm mới định kỳ, khi grab lỗi hoặc khi Controller chọn monitor khác
+        self.monitors = []
+        self.screen_geometry_time = 0
+        self.screen_geometry_interval = 5.0
+        self.window_poll_interval = 0.5  # ROI theo cửa sổ: tần suất đọc lại vị trí cửa sổ
+        
+        # Multi-monitor: mỗi monitor được chọn là một stream độc lập (encoder, motion state riêng)
+        self.selected_monitors = [1]  # Mặc định monitor chính
+        self.streams = {}  # stream_id -> MonitorStream, capture thread thay cả dict khi đổi
+        
         # Statistics
         self.frames_sent = 0
         self.commands_received = 0
@@ -80,17 +769,72 @@ class StreamerClient:
         self.frame_times = []  # Track timing for adaptive adjustment
         self.max_frame_time_samples = 10
         
-        # LEVEL 2 UPGRADE: Motion detection
-        self.last_frame = None
-        self.motion_threshold = 5.0  # % change threshold
-        self.frames_since_last_send = 0
+        # LEVEL 2 UPGRADE: Motion detection (state riêng của từng MonitorStream)
+        self.motion_threshold = 5.0  # % change threshold (trên vùng thay đổi nhiều nhất)
+        self.motion_sample_size = (160, 120)  # Lưới mẫu xấp xỉ
+        self.motion_regions = (8, 6)  # Số vùng (cột, hàng) của change map
+        self.motion_pixel_threshold = 30  # Pixel lệch hơn 30 mức thì tính là thay đổi
+        self.last_motion_percent = 100.0
         self.max_skip_frames = 5  # Don't skip more than 5 frames even if no motion
         
-        # P2P UPGRADE: Peer-to-peer connection
-        self.p2p_enabled = False
-        self.controller_ip = None
-        self.controller_udp_port = None
-        self.p2p_tested = False
+        # Fragmented frame transport
+        self.frame_id = 0
+        
+        # Buffer dùng lại giữa các frame: output của encoder và packet UDP
+        self.packet_buffer = bytearray(PACKET_HEADER.size + CHUNK_HEADER.size + CHUNK_PAYLOAD_SIZE)
+        self.packet_seq = 0  # Sequence của frame chunk, Controller dùng để đo loss và reorder
+        
+        # Pipeline capture -> encode -> send chạy trên 3 thread riêng
+        # capture_queue: giữ frame mới nhất, frame cũ bị bỏ nếu encode chưa kịp lấy
+        # send_queue: chặn encode khi send chậm (frame tile là delta, không được bỏ sau khi encode)
+        self.capture_queue = queue.Queue(maxsize=1)
+        self.send_queue = queue.Queue(maxsize=1)
+        # 3 output buffer: một đang gửi, một đang chờ gửi, một đang encode
+        self.free_buffers = queue.Queue()
+        for _ in range(3):
+            self.free_buffers.put(io.BytesIO())
+        self.frames_dropped = 0
+        
+        # Multi-process JPEG encoding (0 = encode trên encode thread)
+        self.encoder_processes = encoder_processes
+        self.encoder_pool = None
+        
+        # Congestion control theo feedback của Controller
+        self.rate_controller = RateController()
+        self.stream_scale = 1.0  # Tỉ lệ so với độ phân giải đã thỏa thuận
+        
+        # Độ phân giải stream: khung tối đa do Controller yêu cầu (SET_RESOLUTION),
+        # frame giữ nguyên tỉ lệ màn hình gốc và không phóng to quá độ phân giải gốc
+        self.requested_resolution = (800, 600)
+        self.min_resolution = (160, 120)
+        self.max_resolution = (3840, 2160)
+        self.frame_send_times = {}  # frame_id -> thời điểm gửi (monotonic)
+        self.bytes_sent = 0
+        
+        # Đo input-to-photon: frame mang input_seq của input cuối cùng đã thực thi
+        self.input_seq = 0
+        
+        # Mouse move gộp: chỉ giữ vị trí mới nhất, mover thread thực thi tối đa mỗi tick
+        # để hàng move không bao giờ làm chậm click/phím trên command thread
+        self.pending_move = None  # payload {'x', 'y', 'width', 'height'}
+        self.move_condition = threading.Condition()
+        self.move_interval = 1.0 / 60
+        self.moves_received = 0
+        self.moves_executed = 0
+        
+        # Codec của stream ('jpeg' hoặc 'delta'), mỗi MonitorStream tạo encoder riêng trên encode thread
+        self.codec = codec
+        
+        # UDP registration keepalive để server route frame theo session
+        self.udp_register_interval = 5.0
+        self.last_udp_register = 0
+        self.udp_token = None  # Server cấp qua TCP (UDP_TOKEN), bắt buộc trong gói điều khiển UDP
+        
+        # P2P: hole punching tới địa chỉ UDP Controller do server gửi (PEER_INFO),
+        # probe định kỳ server và Controller để chọn đường trực tiếp hay relay
+        self.path = PathSelector()
+        self.probe_interval = 0.5
+        self.peer_nonce = None  # Nonce của server trong PEER_INFO, probe peer phải mang đúng nonce này
     
     def generate_session_id(self):
         """Generate unique session ID (9 digits)"""
@@ -113,18 +857,26 @@ class StreamerClient:
             self.tcp_socket.connect((self.server_ip, self.tcp_port))
             
             # Gửi thông tin client type với credentials
-            client_info = json.dumps({
+            client_info = {
                 'type': 'streamer',
                 'session_id': self.session_id,
                 'password': self.password
-            })
-            self.tcp_socket.send(client_info.encode('utf-8'))
+            }
+            self.tcp_socket.sendall(encode_message(client_info))
             
             # UDP socket để gửi màn hình
             self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # Buffer lớn để chứa burst chunk của một frame
+            self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2 * 1024 * 1024)
+            self.udp_socket.settimeout(1.0)
+            # Bind trước để probe thread nhận được ngay; đăng ký UDP khi server cấp token (UDP_TOKEN)
+            self.udp_socket.bind(('0.0.0.0', 0))
             
             self.connected = True
             self.running = True
+            # Probe/hole punching chạy suốt kết nối, dùng chung UDP socket với frame
+            threading.Thread(target=self.receive_udp, daemon=True).start()
+            threading.Thread(target=self.probe_loop, daemon=True).start()
             self.log(f"Connected to server at {self.server_ip}")
             self.log(f"TCP port: {self.tcp_port}, UDP port: {self.udp_port}")
             self.log(f"🔑 Session ID: {self.session_id}")
@@ -136,6 +888,111 @@ class StreamerClient:
             self.log(f"Connection failed: {e}")
             return False
     
+    def register_udp(self):
+        """Gửi registration packet để server biết địa chỉ UDP của session này (kèm đường đang dùng)"""
+        if self.udp_token is None:
+            return  # Server chưa cấp token, gói đăng ký sẽ bị bỏ
+        register_msg = encode_packet(PACKET_CONTROL, json.dumps({
+            'type': 'streamer_udp', 'session_id': self.session_id,
+            'token': self.udp_token, 'p2p': self.path.direct
+        }).encode('utf-8'))
+        self.udp_socket.sendto(register_msg, (self.server_ip, self.udp_port))
+        self.last_udp_register = time.time()
+    
+    def send_probe(self, kind, target, address, probe_id=0, sent_us=None):
+        """Gửi probe (đo RTT / đục lỗ NAT) kèm RTT tới server hiện tại của Streamer; probe peer mang nonce"""
+        if sent_us is None:
+            sent_us = int(time.monotonic() * 1e6)
+        server_rtt_us = int((self.path.server_rtt or 0) * 1e6)
+        nonce = self.peer_nonce if target == PROBE_TARGET_PEER else b''
+        payload = PROBE_MESSAGE.pack(kind, target, min(server_rtt_us, 0xFFFFFFFF)) + nonce
+        self.udp_socket.sendto(encode_packet(PACKET_PROBE, payload, seq=probe_id, capture_us=sent_us), address)
+    
+    def probe_loop(self):
+        """
+        Probe thread: định kỳ probe server (RTT relay) và Controller (hole punching + RTT trực tiếp),
+        rồi chọn đường gửi frame. Probe tới Controller giữ mapping NAT luôn mở.
+        """
+        probe_id = 0
+        while self.running:
+            probe_id = (probe_id + 1) & 0xFFFFFFFF
+            try:
+                self.send_probe(PROBE_REQUEST, PROBE_TARGET_SERVER, (self.server_ip, self.udp_port), probe_id)
+                peer_address = self.path.peer_address
+                if peer_address:
+                    self.send_probe(PROBE_REQUEST, PROBE_TARGET_PEER, peer_address, probe_id)
+            except OSError:
+                pass
+            
+            self.select_path()
+            time.sleep(self.probe_interval)
+    
+    def select_path(self):
+        """Chọn lại đường gửi frame; đổi đường thì báo server bật/tắt relay cho session"""
+        path = self.path
+        if not path.evaluate(time.monotonic()):
+            return
+        
+        relay_rtt = f"{path.relay_rtt * 1000:.1f}ms" if path.relay_rtt is not None else "?"
+        if path.direct:
+            self.log(f"✅ P2P MODE ACTIVE: Sending directly to Controller {path.peer_address[0]}:{path.peer_address[1]} "
+                     f"(RTT {path.direct_rtt * 1000:.1f}ms, relay {relay_rtt})")
+        else:
+            self.log(f"⚠️  P2P path lost or slower than relay - falling back to RELAY (relay {relay_rtt})")
+            # Chunk gửi trong lúc server chưa bật lại relay bị mất: gửi lại frame đầy đủ
+            for stream in list(self.streams.values()):
+                if stream.encoder:
+                    stream.encoder.request_keyframe()
+        
+        message = {'type': 'p2p_active' if path.direct else 'p2p_inactive',
+                   'session_id': self.session_id, 'token': self.udp_token}
+        try:
+            self.udp_socket.sendto(encode_packet(PACKET_CONTROL, json.dumps(message).encode('utf-8')),
+                                   (self.server_ip, self.udp_port))
+        except OSError:
+            pass
+    
+    def receive_udp(self):
+        """Nhận probe trên UDP socket gửi frame: trả lời probe của Controller, đo RTT từ các reply"""
+        buffer = bytearray(2048)
+        probe_size = PACKET_HEADER.size + PROBE_MESSAGE.size
+        while self.running:
+            try:
+                nbytes, address = self.udp_socket.recvfrom_into(buffer)
+            except socket.timeout:
+                continue
+            except OSError:
+                # Windows báo ICMP port unreachable của probe trước qua recvfrom
+                if not self.running:
+                    break
+                continue
+            
+            if nbytes < probe_size:
+                continue
+            magic, version, packet_type, probe_id, sent_us, length = PACKET_HEADER.unpack_from(buffer)
+            if (magic != PACKET_MAGIC or version != PACKET_VERSION or packet_type != PACKET_PROBE
+                    or length != nbytes - PACKET_HEADER.size):
+                continue
+            kind, target, peer_server_rtt_us = PROBE_MESSAGE.unpack_from(buffer, PACKET_HEADER.size)
+            
+            if target == PROBE_TARGET_SERVER:
+                if kind == PROBE_REPLY:
+                    self.path.on_server_reply(time.monotonic() - sent_us / 1e6)
+                continue
+            # Chỉ nhận probe từ đúng địa chỉ Controller server đã báo, mang đúng nonce của PEER_INFO
+            nonce = self.peer_nonce
+            if (address != self.path.peer_address or nonce is None
+                    or not hmac.compare_digest(bytes(buffer[probe_size:nbytes]), nonce)):
+                continue
+            if kind == PROBE_REQUEST:
+                try:
+                    self.send_probe(PROBE_REPLY, PROBE_TARGET_PEER, address, probe_id, sent_us)
+                except OSError:
+                    pass
+            elif kind == PROBE_REPLY:
+                self.path.on_peer_reply(time.monotonic() - sent_us / 1e6,
+                                        peer_server_rtt_us / 1e6, time.monotonic())
+    
     def disconnect(self):
         """Ngắt kết nối khỏi server"""
         try:
@@ -154,6 +1011,10 @@ class StreamerClient:
                 self.screen_capturer.close()
                 self.screen_capturer = None
             
+            if self.encoder_pool:
+                self.encoder_pool.close()
+                self.encoder_pool = None
+            
             self.log("Disconnected from server")
             return True
             
@@ -161,217 +1022,356 @@ class StreamerClient:
             self.log(f"Error disconnecting: {e}")
             return False
     
-    def detect_motion(self, current_img):
-        """
-        LEVEL 2: Detect if there's significant motion between frames
-        Returns: (has_motion, change_percentage)
-        """
+    def detect_motion(self, stream, screenshot):
+        """LEVEL 2: Motion detection trên state riêng của stream"""
         try:
-            # Convert to grayscale numpy array for comparison
-            current_gray = np.array(current_img.convert('L').resize((160, 120)))  # Small size for speed
-            
-            if self.last_frame is None:
-                self.last_frame = current_gray
-                return True, 100.0  # First frame always send
-            
-            # Calculate difference
-            diff = np.abs(current_gray.astype(float) - self.last_frame.astype(float))
-            change_percent = (np.sum(diff > 30) / diff.size) * 100  # Count pixels with >30 difference
-            
-            has_motion = change_percent > self.motion_threshold
-            
-            # Update last frame if motion detected
-            if has_motion:
-                self.last_frame = current_gray
-            
-            return has_motion, change_percent
-            
+            return stream.detect_motion(screenshot)
         except Exception as e:
             self.log(f"Motion detection error: {e}")
-            return True, 100.0  # On error, send frame
-            
-    def capture_screen(self):
-        """Capture màn hình và nén thành JPEG"""
+            return True, 100.0, None  # On error, send frame
+    
+    def grab_screen(self, rect):
+        """Capture vùng rect (left, top, width, height), trả về raw screenshot của mss"""
         try:
-            # Create mss instance in this thread if not exists
-            if self.screen_capturer is None:
-                self.screen_capturer = mss.mss()
-            
-            # Capture toàn bộ màn hình
-            monitor = self.screen_capturer.monitors[1]  # Monitor chính
-            screenshot = self.screen_capturer.grab(monitor)
-            
-            # Convert sang PIL Image
-            img = Image.frombytes('RGB', screenshot.size, screenshot.rgb)
-            
-            # Lưu kích thước gốc để tính tỷ lệ chính xác
-            original_width = screenshot.size[0]
-            original_height = screenshot.size[1]
-            
-            # Resize 800x600 với quality cao hơn cho hình ảnh sắc nét
-            resized_img = img.resize((800, 600), Image.Resampling.LANCZOS)
-            
-            # LEVEL 1: Use adaptive quality
-            buffer = io.BytesIO()
-            resized_img.save(buffer, format='JPEG', quality=self.jpeg_quality, optimize=True, progressive=True)
-            jpeg_data = buffer.getvalue()
-            
-            # Log warning nếu frame quá lớn
-            if len(jpeg_data) > 65000:
-                self.log(f"⚠️ Frame too large: {len(jpeg_data)} bytes - may drop!")
-            
-            return jpeg_data, resized_img  # Return both JPEG and PIL image for motion detection
+            left, top, width, height = rect
+            return self.screen_capturer.grab({'left': left, 'top': top, 'width': width, 'height': height})
             
         except Exception as e:
             self.log(f"Error capturing screen: {e}")
+            # Có thể độ phân giải vừa đổi: lần capture sau đọc lại geometry
+            self.invalidate_screen_geometry()
             return None
+    
+    def refresh_screen_geometry(self):
+        """
+        Đọc lại geometry các monitor và dựng lại danh sách stream theo monitor được chọn
+        (chỉ gọi từ capture thread, mss không dùng chung giữa các thread).
+        """
+        # mss cache danh sách monitor theo instance nên phải tạo instance mới để thấy thay đổi
+        if self.screen_capturer is not None:
+            self.screen_capturer.close()
+        self.screen_capturer = mss.mss()
+        
+        monitors = [(m['left'], m['top'], m['width'], m['height']) for m in self.screen_capturer.monitors]
+        if monitors != self.monitors:
+            for index, (left, top, width, height) in enumerate(monitors[1:], 1):
+                self.log(f"🖥️  Monitor {index}: {width}x{height} at ({left}, {top})")
+        self.monitors = monitors
+        
+        # Giữ stream cũ (encoder, motion state) cho monitor vẫn được chọn
+        selected = [index for index in self.selected_monitors if index < len(monitors)] or [1]
+        streams = {}
+        for index in selected:
+            stream = self.streams.get(index)
+            if stream is None:
+                stream = MonitorStream(index, monitors[index], self.motion_sample_size, self.motion_regions,
+                                       self.motion_pixel_threshold, self.motion_threshold)
+            elif stream.geometry != monitors[index]:
+                # Độ phân giải đổi: frame sau tự gửi đầy đủ vì kích thước khác
+                stream.geometry = monitors[index]
+            streams[index] = stream
+        self.streams = streams
+        self.screen_geometry_time = time.monotonic()
+    
+    def invalidate_screen_geometry(self):
+        """Bỏ geometry đã cache, capture thread đọc lại ở lần capture tiếp theo"""
+        self.screen_geometry_time = 0
+    
+    def update_window_region(self, stream):
+        """ROI_WINDOW: đọc lại vị trí cửa sổ đang focus (tối đa mỗi window_poll_interval)"""
+        now = time.monotonic()
+        if now - stream.window_poll_time < self.window_poll_interval:
+            return
+        stream.window_poll_time = now
+        
+        rect = foreground_window_rect()
+        rect = rect and clip_rect(rect, stream.geometry)
+        # Cửa sổ ở monitor khác hoặc bị thu nhỏ: giữ vùng cũ
+        if rect and rect != stream.window_rect:
+            stream.window_rect = rect
+            self.log(f"🎯 Following window: {rect[2]}x{rect[3]} at ({rect[0]}, {rect[1]})")
+    
+    def compute_stream_size(self, source_size, native=False):
+        """
+        Kích thước frame: vừa khung requested_resolution, giữ tỉ lệ gốc, nhân scale của rate control.
+        native: ROI giữ độ phân giải gốc (chỉ giới hạn bởi max_resolution) để chữ sắc nét.
+        """
+        source_width, source_height = source_size
+        box_width, box_height = self.max_resolution if native else self.requested_resolution
+        scale = min(box_width / source_width, box_height / source_height, 1.0) * self.stream_scale
+        # Kích thước chẵn (thuận lợi cho encoder)
+        return (max(2, int(source_width * scale) // 2 * 2),
+                max(2, int(source_height * scale) // 2 * 2))
+    
+    def to_stream_image(self, stream, screenshot):
+        """Resize raw screenshot về kích thước stream (RGB)"""
+        # Bọc trực tiếp raw buffer BGRA của mss (không copy, không qua screenshot.rgb)
+        # Ảnh mang nhãn RGBX nhưng kênh thực tế là B, G, R, X
+        raw_img = Image.frombuffer('RGBX', screenshot.size, screenshot.raw, 'raw', 'RGBX', 0, 1)
+        
+        # Resize theo độ phân giải đã thỏa thuận:
+        # reduce() nguyên lần trước rồi LANCZOS phần còn lại
+        size = self.compute_stream_size(screenshot.size, native=stream.region is not None)
+        if size != raw_img.size:
+            raw_img = raw_img.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        stream.stream_size = size
+        
+        # Đổi BGR -> RGB trên ảnh đã thu nhỏ (rẻ hơn nhiều so với trên ảnh gốc)
+        blue, green, red, _ = raw_img.split()
+        return Image.merge('RGB', (red, green, blue))
+    
+    def send_frame(self, frame_data, address):
+        """
+        Cắt frame thành các chunk <= CHUNK_PAYLOAD_SIZE và gửi qua UDP.
+        Mỗi chunk mang packet header (seq, capture timestamp) và chunk header
+        (frame_id, chunk_index, chunk_count) để Controller ghép lại.
+        """
+        chunk_count = (len(frame_data) + CHUNK_PAYLOAD_SIZE - 1) // CHUNK_PAYLOAD_SIZE
+        if chunk_count > 0xFFFF:
+            raise ValueError(f"Frame too large to fragment: {len(frame_data)} bytes")
+        
+        frame_id = self.frame_id
+        self.frame_id = (self.frame_id + 1) & 0xFFFFFFFF
+        
+        # Thời điểm gửi để đo queueing delay từ feedback (chỉ giữ 256 frame gần nhất)
+        self.frame_send_times[frame_id] = time.monotonic()
+        self.frame_send_times.pop((frame_id - 256) & 0xFFFFFFFF, None)
+        self.bytes_sent += len(frame_data) + chunk_count * (PACKET_HEADER.size + CHUNK_HEADER.size)
+        capture_us = FRAME_HEADER.unpack_from(frame_data)[6]
+        
+        # Dựng từng packet trong packet_buffer cấp phát sẵn, không tạo bytes mới mỗi chunk
+        view = memoryview(frame_data)
+        packet = self.packet_buffer
+        packet_view = memoryview(packet)
+        data_start = PACKET_HEADER.size + CHUNK_HEADER.size
+        for chunk_index in range(chunk_count):
+            start = chunk_index * CHUNK_PAYLOAD_SIZE
+            chunk = view[start:start + CHUNK_PAYLOAD_SIZE]
+            PACKET_HEADER.pack_into(packet, 0, PACKET_MAGIC, PACKET_VERSION, PACKET_FRAME, self.packet_seq,
+                                    capture_us, CHUNK_HEADER.size + len(chunk))
+            CHUNK_HEADER.pack_into(packet, PACKET_HEADER.size, frame_id, chunk_index, chunk_count)
+            packet[data_start:data_start + len(chunk)] = chunk
+            self.packet_seq = (self.packet_seq + 1) & 0xFFFFFFFF
+            self.udp_socket.sendto(packet_view[:data_start + len(chunk)], address)
             
+    def offer_latest(self, frame_queue, item):
+        """Đưa item vào queue; nếu đầy thì bỏ item cũ nhất thay vì chờ"""
+        while True:
+            try:
+                frame_queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    frame_queue.get_nowait()
+                    self.frames_dropped += 1
+                except queue.Empty:
+                    pass
+    
     def stream_screen(self):
-        """Stream màn hình liên tục qua UDP"""
-        frame_count = 0
+        """Stream màn hình liên tục qua UDP: capture + motion detection trên thread này, encode và send trên 2 thread riêng"""
         self.log("Stream thread started, waiting for streaming to be enabled...")
         
+        threading.Thread(target=self.encode_frames, daemon=True).start()
+        threading.Thread(target=self.send_frames, daemon=True).start()
+        
+        started = False
+        next_deadline = time.perf_counter()
         while self.running:
             try:
                 if not self.streaming:
                     time.sleep(0.1)
+                    next_deadline = time.perf_counter()
                     continue
                 
                 # Log lần đầu streaming
-                if frame_count == 0:
+                if not started:
                     self.log(f"🎬 Starting UDP streaming to {self.server_ip}:{self.udp_port}")
+                    started = True
                 
-                # LEVEL 1: Track timing for adaptive quality
-                frame_start = time.time()
-                
-                # Capture màn hình
-                result = self.capture_screen()
+                # Create mss instance in this thread if not exists; làm mới geometry định kỳ
+                if (self.screen_capturer is None
+                        or time.monotonic() - self.screen_geometry_time > self.screen_geometry_interval):
+                    self.refresh_screen_geometry()
                 
-                if result:
-                    # Unpack result based on return type
-                    if isinstance(result, tuple):
-                        jpeg_data, pil_img = result
-                    else:
-                        # Backward compatibility if no tuple returned
-                        jpeg_data = result
-                        pil_img = None
-                    
-                    # LEVEL 2: Motion detection - skip if no motion
-                    should_send = True
-                    motion_percent = 0.0
+                # Capture từng monitor được chọn, mỗi stream có motion state riêng
+                capture_time = time.monotonic()
+                input_seq = self.input_seq
+                frames = []
+                for stream in list(self.streams.values()):
+                    if stream.region == ROI_WINDOW:
+                        self.update_window_region(stream)
+                    rect = stream.capture_rect()
+                    screenshot = self.grab_screen(rect)
+                    if screenshot is None:
+                        continue
                     
-                    if pil_img is not None:
-                        has_motion, motion_percent = self.detect_motion(pil_img)
-                        self.frames_since_last_send += 1
-                        
-                        # Don't send if no motion, unless too many frames skipped
-                        if not has_motion and self.frames_since_last_send < self.max_skip_frames:
-                            should_send = False
-                        else:
-                            self.frames_since_last_send = 0
-                    
-                    if should_send:
-                        # P2P UPGRADE: Gửi qua UDP - thử P2P trước, fallback relay
-                        try:
-                            # Try P2P if enabled and controller info available
-                            if self.p2p_enabled and self.controller_ip and self.controller_udp_port:
-                                try:
-                                    # Send directly to Controller via P2P
-                                    self.udp_socket.sendto(jpeg_data, (self.controller_ip, self.controller_udp_port))
-                                    if frame_count % 100 == 0 and not self.p2p_tested:
-                                        self.log(f"✅ P2P MODE ACTIVE: Sending directly to Controller {self.controller_ip}:{self.controller_udp_port}")
-                                        self.p2p_tested = True
-                                except Exception as p2p_error:
-                                    # P2P failed, fallback to relay
-                                    if self.p2p_enabled:
-                                        self.log(f"⚠️  P2P failed, falling back to RELAY: {p2p_error}")
-                                        self.p2p_enabled = False
-                                    self.udp_socket.sendto(jpeg_data, (self.server_ip, self.udp_port))
-                            else:
-                                # No P2P, use relay through server
-                                self.udp_socket.sendto(jpeg_data, (self.server_ip, self.udp_port))
-                        
-                            frame_count += 1
-                            self.frames_sent += 1
-                        
-                            # LEVEL 1: Adaptive quality adjustment
-                            frame_time = time.time() - frame_start
-                            self.frame_times.append(frame_time)
-                            if len(self.frame_times) > self.max_frame_time_samples:
-                                self.frame_times.pop(0)
-                        
-                            # Adjust quality every 30 frames
-                            if frame_count % 30 == 0:
-                                avg_time = sum(self.frame_times) / len(self.frame_times)
-                                target_time = 1.0 / self.target_fps
-                            
-                                # If too slow, reduce quality
-                                if avg_time > target_time * 1.2 and self.jpeg_quality > 50:
-                                    self.jpeg_quality = max(50, self.jpeg_quality - 5)
-                                    self.log(f"📉 Reducing quality to {self.jpeg_quality} (avg time: {avg_time:.3f}s)")
-                                # If fast enough, increase quality
-                                elif avg_time < target_time * 0.8 and self.jpeg_quality < 85:
-                                    self.jpeg_quality = min(85, self.jpeg_quality + 5)
-                                    self.log(f"📈 Increasing quality to {self.jpeg_quality} (avg time: {avg_time:.3f}s)")
-                            
-                                self.log(f"📊 Frames: {frame_count}, Size: {len(jpeg_data)}B, Q: {self.jpeg_quality}, Motion: {motion_percent:.1f}%")
-                        except Exception as e:
-                            self.log(f"❌ Error sending UDP packet: {e}")
+                    # LEVEL 2: Motion detection trên raw capture - skip resize/encode if no motion
+                    has_motion, motion_percent, _ = self.detect_motion(stream, screenshot)
+                    stream.frames_since_last_send += 1
                     
-                    # FPS control: ~30 FPS cho mượt mà hơn
-                    time.sleep(0.033)  # 1/30 = 0.033s - Level 1 upgrade
+                    # Don't send if no motion, unless too many frames skipped
+                    if has_motion or stream.frames_since_last_send >= self.max_skip_frames:
+                        stream.frames_since_last_send = 0
+                        stream.frame_rect = rect
+                        self.last_motion_percent = motion_percent
+                        frames.append((stream, self.to_stream_image(stream, screenshot), screenshot.size))
+                
+                if frames:
+                    self.offer_latest(self.capture_queue, (frames, capture_time, input_seq))
+                
+                # FPS control theo deadline: bù thời gian capture thay vì sleep cố định
+                next_deadline += 1.0 / self.target_fps
+                delay = next_deadline - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Trễ hạn thì bắt đầu chu kỳ mới, không cố capture dồn để đuổi kịp
+                    next_deadline = time.perf_counter()
                     
             except Exception as e:
                 self.log(f"Stream error: {e}")
                 break
-                
+        
         self.log("Screen streaming stopped")
+    
+    def create_encoder(self):
+        """Tạo encoder theo codec đã chọn"""
+        if self.codec == 'jpeg':
+            if self.encoder_processes > 1 and self.encoder_pool is None:
+                self.encoder_pool = ProcessPoolEncoder(self.encoder_processes)
+                self.log(f"🧵 Multi-process JPEG encoding: {self.encoder_processes} workers")
+            return TileJpegEncoder(self.encoder_pool)
+        return ENCODERS[self.codec]()
+    
+    def encode_frames(self):
+        """Encode stage: encode frame của từng stream bằng encoder riêng, chuyển payload sang send stage"""
+        encoded_count = 0
+        self.log(f"🎞️  Codec: {self.codec}")
+        
+        while self.running:
+            try:
+                frames, capture_time, input_seq = self.capture_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            
+            for stream, pil_img, source_size in frames:
+                try:
+                    encode_start = time.time()
+                    if stream.encoder is None:
+                        stream.encoder = self.create_encoder()
+                    
+                    # Encoder chỉ gửi phần thay đổi so với frame đã gửi của cùng stream
+                    buffer = self.free_buffers.get()
+                    buffer.seek(0)
+                    buffer.write(FRAME_HEADER.pack(stream.encoder.codec_id, stream.stream_id, *pil_img.size,
+                                                   *source_size, int(capture_time * 1_000_000), input_seq))
+                    frame_data = stream.encoder.encode(pil_img, buffer, self.jpeg_quality)
+                    if frame_data is None:
+                        self.free_buffers.put(buffer)
+                        continue
+                    
+                    # LEVEL 1: Track encode time for adaptive quality
+                    self.frame_times.append(time.time() - encode_start)
+                    if len(self.frame_times) > self.max_frame_time_samples:
+                        self.frame_times.pop(0)
+                    
+                    encoded_count += 1
+                    if encoded_count % 30 == 0:
+                        self.adjust_quality()
+                        self.log(f"📊 Frames: {encoded_count}, Size: {len(frame_data)}B, Q: {self.jpeg_quality}, "
+                                 f"Motion: {self.last_motion_percent:.1f}%, Dropped: {self.frames_dropped}")
+                    
+                    # Chờ send stage (backpressure) - payload đã encode là delta nên không bỏ
+                    while self.running:
+                        try:
+                            self.send_queue.put((buffer, frame_data), timeout=0.5)
+                            break
+                        except queue.Full:
+                            continue
+                    else:
+                        frame_data.release()
+                        self.free_buffers.put(buffer)
+                        
+                except Exception as e:
+                    self.log(f"Encode error: {e}")
+        
+    def adjust_quality(self):
+        """LEVEL 1: Adaptive quality adjustment theo thời gian encode trung bình"""
+        # Khi Controller gửi feedback, rate controller quyết định quality
+        if self.rate_controller.active:
+            return
+        
+        avg_time = sum(self.frame_times) / len(self.frame_times)
+        target_time = 1.0 / self.target_fps
+        
+        # If too slow, reduce quality
+        if avg_time > target_time * 1.2 and self.jpeg_quality > 50:
+            self.jpeg_quality = max(50, self.jpeg_quality - 5)
+            self.log(f"📉 Reducing quality to {self.jpeg_quality} (avg time: {avg_time:.3f}s)")
+        # If fast enough, increase quality
+        elif avg_time < target_time * 0.8 and self.jpeg_quality < 85:
+            self.jpeg_quality = min(85, self.jpeg_quality + 5)
+            self.log(f"📈 Increasing quality to {self.jpeg_quality} (avg time: {avg_time:.3f}s)")
+    
+    def send_frames(self):
+        """Send stage: gửi payload đã encode qua UDP rồi trả buffer về pool"""
+        while self.running:
+            try:
+                buffer, frame_data = self.send_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            
+            try:
+                # Registration keepalive (UDP có thể mất gói đăng ký)
+                if time.time() - self.last_udp_register >= self.udp_register_interval:
+                    self.register_udp()
+                
+                self.send_to_peer(frame_data)
+                self.frames_sent += 1
+            except Exception as e:
+                self.log(f"❌ Error sending UDP packet: {e}")
+            finally:
+                # Trả buffer cho encode stage
+                frame_data.release()
+                self.free_buffers.put(buffer)
+    
+    def send_to_peer(self, frame_data):
+        """Gửi frame theo đường PathSelector đã chọn: trực tiếp tới Controller hoặc relay qua server"""
+        peer_address = self.path.peer_address
+        if self.path.direct and peer_address:
+            try:
+                self.send_frame(frame_data, peer_address)
+                return
+            except OSError as e:
+                # Lỗi gửi trực tiếp: coi như mất đường P2P, probe thread sẽ báo server
+                self.log(f"⚠️  P2P send failed: {e}")
+                self.path.last_peer_reply = 0
+        self.send_frame(frame_data, (self.server_ip, self.udp_port))
         
     def handle_commands(self):
         """Nhận và xử lý lệnh từ server"""
+        decoder = MessageDecoder()
+        threading.Thread(target=self.move_mouse_loop, daemon=True).start()
         while self.running:
             try:
-                data = self.tcp_socket.recv(4096)
+                data = self.tcp_socket.recv(65536)
                 if not data:
                     break
-                    
-                command = json.loads(data.decode('utf-8'))
-                cmd_type = command.get('command', 'unknown')
-                payload = command.get('payload', {})
                 
-                self.commands_received += 1
-                self.log(f"Received command: {cmd_type}")
-                
-                # Xử lý các lệnh
-                if cmd_type == 'PEER_INFO':
-                    # P2P: Nhận thông tin Controller để kết nối trực tiếp
-                    self.controller_ip = payload.get('peer_ip')
-                    self.controller_udp_port = self.udp_port  # Assume same port
-                    self.p2p_enabled = True
-                    self.log(f"🔗 P2P: Received Controller info - {self.controller_ip}:{self.controller_udp_port}")
-                    self.log(f"✅ P2P MODE ENABLED - Will send directly to Controller")
-                    
-                elif cmd_type == 'MOUSE_CLICK':
-                    self.handle_mouse_click(payload)
-                    
-                elif cmd_type == 'MOUSE_MOVE':
-                    self.handle_mouse_move(payload)
-                    
-                elif cmd_type == 'KEY_PRESS':
-                    self.handle_key_press(payload)
-                    
-                elif cmd_type == 'PAUSE':
-                    self.streaming = False
-                    self.log("Stream paused")
+                # Một lần recv có thể chứa nhiều lệnh hoặc một phần lệnh
+                for message in decoder.feed(data):
+                    if message[:1] != b'{':
+                        self.handle_binary_message(message)
+                        continue
                     
-                elif cmd_type == 'CONTINUE':
-                    self.streaming = True
-                    self.log("Stream resumed")
+                    try:
+                        command = json.loads(message.decode('utf-8'))
+                    except ValueError as e:
+                        self.log(f"Invalid command message: {e}")
+                        continue
                     
-                elif cmd_type == 'DISCONNECT':
-                    self.log("Disconnect requested")
-                    self.running = False
-                    break
+                    if not self.execute_command(command):
+                        break
                     
             except Exception as e:
                 if self.running:
@@ -379,21 +1379,247 @@ class StreamerClient:
                 break
                 
         self.log("Command handler stopped")
+        with self.move_condition:
+            self.move_condition.notify_all()
+    
+    def handle_binary_message(self, message):
+        """Xử lý message nhị phân (hiện chỉ có mouse move)"""
+        if message[0] == MSG_MOUSE_MOVE and len(message) == MOUSE_MOVE_MESSAGE.size:
+            _, stream_id, x, y, width, height = MOUSE_MOVE_MESSAGE.unpack(message)
+            self.handle_mouse_move({'stream_id': stream_id, 'x': x, 'y': y, 'width': width, 'height': height})
+        else:
+            self.log(f"Unknown binary message type: {message[0]}")
+    
+    def execute_command(self, command):
+        """Thực thi một lệnh. Returns: False nếu nhận lệnh DISCONNECT"""
+        cmd_type = command.get('command', 'unknown')
+        payload = command.get('payload', {})
+        
+        self.commands_received += 1
+        if cmd_type not in ('FEEDBACK', 'PING', 'MOUSE_MOVE'):
+            self.log(f"Received command: {cmd_type}")
+        
+        # Xử lý các lệnh
+        if cmd_type == 'FEEDBACK':
+            self.handle_feedback(payload)
+            
+        elif cmd_type == 'PING':
+            self.send_pong(payload)
+            
+        elif cmd_type == 'PEER_INFO':
+            # P2P: địa chỉ UDP ngoài NAT của Controller do server quan sát, bắt đầu probe trực tiếp
+            peer_address = (payload.get('peer_ip'), payload.get('peer_port'))
+            if peer_address[0] and peer_address[1] and payload.get('nonce'):
+                self.peer_nonce = payload['nonce'].encode('utf-8')
+                self.path.set_peer(peer_address)
+                self.log(f"🔗 P2P: Controller UDP address {peer_address[0]}:{peer_address[1]} - hole punching")
+            
+        elif cmd_type == 'MOUSE_CLICK':
+            self.handle_mouse_click(payload)
+            self.input_seq = payload.get('input_seq', self.input_seq)
+            
+        elif cmd_type == 'MOUSE_MOVE':
+            self.handle_mouse_move(payload)
+            
+        elif cmd_type == 'KEY_PRESS':
+            self.handle_key_press(payload)
+            self.input_seq = payload.get('input_seq', self.input_seq)
+            
+        elif cmd_type == 'SET_RESOLUTION':
+            self.set_resolution(payload)
+            
+        elif cmd_type == 'REQUEST_KEYFRAME':
+            # Controller mất frame tham chiếu (UDP loss) - gửi lại frame đầy đủ
+            # của stream được chỉ định (không có stream_id thì mọi stream)
+            for stream in list(self.streams.values()):
+                if stream.encoder and payload.get('stream_id', stream.stream_id) == stream.stream_id:
+                    stream.encoder.request_keyframe()
+            
+        elif cmd_type == 'SET_REGION':
+            self.set_region(payload)
+            
+        elif cmd_type == 'LIST_MONITORS':
+            self.send_monitors()
+            
+        elif cmd_type == 'SELECT_MONITOR':
+            self.select_monitors(payload)
+            
+        elif cmd_type == 'PAUSE':
+            self.streaming = False
+            self.log("Stream paused")
+            
+        elif cmd_type == 'CONTINUE':
+            self.streaming = True
+            self.log("Stream resumed")
+            
+        elif cmd_type == 'UDP_TOKEN':
+            self.udp_token = payload.get('token')
+            self.register_udp()
+            
+        elif cmd_type == 'DISCONNECT':
+            self.log(f"Disconnect requested{': ' + payload['message'] if payload.get('message') else ''}")
+            self.running = False
+            return False
+        
+        return True
+        
+    def list_monitors(self):
+        """Geometry các monitor (cache của capture thread; chưa capture thì hỏi mss trực tiếp)"""
+        if self.monitors:
+            return self.monitors
+        with mss.mss() as capturer:
+            return [(m['left'], m['top'], m['width'], m['height']) for m in capturer.monitors]
+    
+    def send_monitors(self):
+        """Gửi danh sách monitor và các stream đang chạy cho Controller (qua server)"""
+        try:
+            monitors = self.list_monitors()
+        except Exception as e:
+            self.log(f"Error listing monitors: {e}")
+            return
+        
+        message = {
+            'command': 'MONITORS',
+            'payload': {
+                'monitors': [{'id': index, 'left': left, 'top': top, 'width': width, 'height': height}
+                             for index, (left, top, width, height) in enumerate(monitors)],
+                'streams': list(self.selected_monitors)
+            }
+        }
+        try:
+            self.tcp_socket.sendall(encode_message(message))
+        except Exception as e:
+            self.log(f"Error sending MONITORS: {e}")
+    
+    def select_monitors(self, payload):
+        """
+        Chọn monitor để stream: {"monitors": [1, 2]} stream từng monitor độc lập,
+        {"monitors": [0]} stream toàn bộ desktop ảo thành một stream.
+        """
+        try:
+            count = len(self.list_monitors())
+            selected = []
+            for index in payload.get('monitors', []):
+                index = int(index)
+                if 0 <= index < count and index not in selected:
+                    selected.append(index)
+        except Exception as e:
+            self.log(f"Invalid monitor selection {payload}: {e}")
+            return
+        
+        if selected:
+            self.selected_monitors = selected
+            # Capture thread dựng lại danh sách stream ở lần capture tiếp theo
+            self.invalidate_screen_geometry()
+            self.log(f"🖥️  Streaming monitor(s): {', '.join(map(str, selected))}")
+        self.send_monitors()
+    
+    def set_region(self, payload):
+        """
+        Region of interest cho stream: {"left", "top", "width", "height"} tương đối với monitor,
+        {"window": true} theo cửa sổ đang focus, {} để capture lại cả monitor.
+        """
+        streams = self.streams
+        stream = streams.get(payload.get('stream_id')) or next(iter(streams.values()), None)
+        if stream is None:
+            self.log("No stream to set region on")
+            return
+        
+        if payload.get('window'):
+            stream.window_rect = None
+            stream.window_poll_time = 0
+            stream.region = ROI_WINDOW
+            self.log(f"🎯 Stream {stream.stream_id}: following foreground window")
+        elif 'width' in payload:
+            try:
+                region = tuple(int(payload.get(key, 0)) for key in ('left', 'top', 'width', 'height'))
+            except (TypeError, ValueError):
+                self.log(f"Invalid region: {payload}")
+                return
+            stream.region = region
+            self.log(f"🎯 Stream {stream.stream_id}: region {region[2]}x{region[3]} at ({region[0]}, {region[1]})")
+        else:
+            stream.region = None
+            self.log(f"🖥️  Stream {stream.stream_id}: full monitor")
+        
+        # Vùng đổi kích thước: encoder tự gửi frame đầy đủ, gửi ngay thay vì chờ motion
+        stream.frames_since_last_send = self.max_skip_frames
+    
+    def send_pong(self, payload):
+        """Trả lời PING qua TCP (server chuyển về Controller) để đo round-trip"""
+        pong = {
+            'command': 'PONG',
+            'payload': {
+                'ping_id': payload.get('ping_id'),
+                'sent': payload.get('sent'),
+                'streamer_time': time.monotonic()
+            }
+        }
+        try:
+            self.tcp_socket.sendall(encode_message(pong))
+        except Exception as e:
+            self.log(f"Error sending PONG: {e}")
+    
+    def handle_feedback(self, payload):
+        """Đưa feedback của Controller vào rate controller và áp dụng quality/scale/fps mới"""
+        rc = self.rate_controller
+        if not rc.on_feedback(payload, self.frame_send_times, self.bytes_sent):
+            return
+        
+        self.jpeg_quality = rc.quality
+        self.stream_scale = rc.scale
+        self.target_fps = rc.fps
+        self.log(f"🚦 Rate control: target {rc.target_bitrate / 1e6:.2f} Mbps, "
+                 f"sending {rc.send_rate / 1e6:.2f} Mbps, loss {rc.loss * 100:.1f}%, "
+                 f"delay +{rc.queue_delay * 1000:.0f}ms -> Q: {rc.quality}, "
+                 f"scale: {rc.scale:.3f}, FPS: {rc.fps}")
+    
+    def set_resolution(self, payload):
+        """Đặt khung độ phân giải tối đa theo yêu cầu của Controller (thường là kích thước canvas)"""
+        try:
+            width = min(max(int(payload.get('width', 800)), self.min_resolution[0]), self.max_resolution[0])
+            height = min(max(int(payload.get('height', 600)), self.min_resolution[1]), self.max_resolution[1])
+        except (TypeError, ValueError):
+            self.log(f"Invalid resolution: {payload}")
+            return
         
+        self.requested_resolution = (width, height)
+        self.log(f"🖥️  Stream resolution up to {width}x{height} (aspect ratio preserved)")
+    
+    def stream_to_screen(self, payload):
+        """
+        Đổi tọa độ trên frame sang tọa độ màn hình thật.
+        Controller gửi kèm kích thước frame nó đang hiển thị vì độ phân giải có thể vừa đổi.
+        """
+        # Geometry cache từ monitor của stream (tính cả offset khi có nhiều màn hình);
+        # chưa capture lần nào thì hỏi pyautogui
+        streams = self.streams
+        stream = streams.get(payload.get('stream_id')) or next(iter(streams.values()), None)
+        if stream is None:
+            left, top, screen_width, screen_height = 0, 0, *pyautogui.size()
+            stream_size = (screen_width, screen_height)
+        else:
+            left, top, screen_width, screen_height = stream.frame_rect
+            stream_size = stream.stream_size
+        
+        x = payload.get('x', 0)
+        y = payload.get('y', 0)
+        stream_width = payload.get('width') or stream_size[0]
+        stream_height = payload.get('height') or stream_size[1]
+        
+        return (left + int(x * screen_width / stream_width),
+                top + int(y * screen_height / stream_height))
+    
     def handle_mouse_click(self, payload):
         """Xử lý lệnh click chuột"""
         if not pyautogui:
             return
             
         try:
-            x = payload.get('x', 0)
-            y = payload.get('y', 0)
             button = payload.get('button', 'left')
             
-            # Scale coordinates từ 800x600 (stream size) về resolution thực
-            screen_width, screen_height = pyautogui.size()
-            real_x = int(x * screen_width / 800)
-            real_y = int(y * screen_height / 600)
+            # Scale coordinates từ stream size về resolution thực
+            real_x, real_y = self.stream_to_screen(payload)
             
             # Click tại vị trí thực
             pyautogui.click(real_x, real_y, button=button)
@@ -403,24 +1629,33 @@ class StreamerClient:
             self.log(f"Error handling mouse click: {e}")
             
     def handle_mouse_move(self, payload):
-        """Xử lý lệnh di chuyển chuột"""
-        if not pyautogui:
-            return
-            
-        try:
-            x = payload.get('x', 0)
-            y = payload.get('y', 0)
+        """Xử lý lệnh di chuyển chuột: ghi đè vị trí chờ, mover thread thực thi"""
+        with self.move_condition:
+            self.pending_move = payload
+            self.moves_received += 1
+            self.move_condition.notify()
+    
+    def move_mouse_loop(self):
+        """Mover thread: di chuyển chuột tới vị trí mới nhất, tối đa một lần mỗi move_interval"""
+        while self.running:
+            with self.move_condition:
+                self.move_condition.wait_for(lambda: self.pending_move is not None or not self.running, 0.5)
+                payload = self.pending_move
+                self.pending_move = None
+            if payload is None or not pyautogui:
+                continue
             
-            # Scale coordinates từ 800x600 về resolution thực
-            screen_width, screen_height = pyautogui.size()
-            real_x = int(x * screen_width / 800)
-            real_y = int(y * screen_height / 600)
+            try:
+                # Scale coordinates từ stream size về resolution thực
+                real_x, real_y = self.stream_to_screen(payload)
+                # _pause=False: bỏ khoảng nghỉ 0.1s mặc định của pyautogui sau mỗi lệnh
+                pyautogui.moveTo(real_x, real_y, _pause=False)
+                self.moves_executed += 1
+            except Exception as e:
+                self.log(f"Error handling mouse move: {e}")
             
-            pyautogui.moveTo(real_x, real_y)
-            self.log(f"✅ Moved mouse to ({real_x}, {real_y})")
-            
-        except Exception as e:
-            self.log(f"Error handling mouse move: {e}")
+            # Các move đến trong lúc chờ chỉ còn lại vị trí cuối cùng
+            time.sleep(self.move_interval)
             
     def handle_key_press(self, payload):
         """Xử lý lệnh nhấn phím"""
@@ -476,6 +1711,10 @@ class StreamerClient:
                 self.udp_socket.close()
             except:
                 pass
+        
+        if self.encoder_pool:
+            self.encoder_pool.close()
+            self.encoder_pool = None
                 
         self.log("Streamer client stopped")
 
@@ -487,16 +1726,35 @@ def main():
     print("="*60)
     print()
     
+    # --encoder-processes N: encode JPEG trên N process
+    args = sys.argv[1:]
+    encoder_processes = 0
+    if '--encoder-processes' in args:
+        index = args.index('--encoder-processes')
+        encoder_processes = int(args[index + 1])
+        del args[index:index + 2]
+    
+    # --codec jpeg|delta: chọn codec của stream
+    codec = 'jpeg'
+    if '--codec' in args:
+        index = args.index('--codec')
+        codec = args[index + 1]
+        del args[index:index + 2]
+        if codec not in ENCODERS:
+            print(f"Unknown codec: {codec} (available: {', '.join(ENCODERS)})")
+            sys.exit(1)
+    
     # Nhập IP server
-    if len(sys.argv) > 1:
-        server_ip = sys.argv[1]
+    if args:
+        server_ip = args[0]
     else:
         server_ip = input("Enter server IP address [localhost]: ").strip()
         if not server_ip:
             server_ip = 'localhost'
     
     # Khởi tạo client
-    client = StreamerClient(server_ip, tcp_port=5555, udp_port=5556)
+    client = StreamerClient(server_ip, tcp_port=5555, udp_port=5556,
+                            encoder_processes=encoder_processes, codec=codec)
     
     # Chạy
     client.start()
@@ -0,0 +1,206 @@
+"""
+Remote Desktop Control - Benchmark UDP relay
+
+Đo chi phí relay mỗi packet của RemoteDesktopServer:
+1. Dispatch: gọi thẳng relay_datagram với sendto giả (chi phí phân loại + tra route, ns/packet)
+2. End-to-end trên localhost: Streamer giả (process riêng) bắn frame chunk vào server,
+   Controller giả (process riêng) đếm packet nhận được; server relay trên một thread
+3. --batch: chạy end-to-end hai lần, I/O từng packet và batch I/O (recvmmsg/sendmmsg), để so sánh
+4. --workers N: relay bằng N worker process bind chung port (SO_REUSEPORT)
+
+Chạy: python bench_relay.py [--seconds 5] [--size 1400] [--senders 2] [--async | --batch] [--workers N]
+"""
+
+import socket
+import threading
+import json
+import time
+import sys
+import multiprocessing
+
+from server import (RemoteDesktopServer, Session, BatchUdpSocket, PACKET_HEADER, PACKET_MAGIC, PACKET_VERSION,
+                    PACKET_FRAME, PACKET_CONTROL)
+
+CHUNK_HEADER_SIZE = 8  # frame_id, chunk_index, chunk_count của StreamerClient
+
+
+def frame_packet(payload_size):
+    """Một frame chunk đúng format StreamerClient gửi"""
+    payload = bytes(CHUNK_HEADER_SIZE + payload_size)
+    return PACKET_HEADER.pack(PACKET_MAGIC, PACKET_VERSION, PACKET_FRAME, 0, 0, len(payload)) + payload
+
+
+def control_packet(message):
+    """Gói điều khiển (đăng ký địa chỉ UDP)"""
+    payload = json.dumps(message).encode('utf-8')
+    return PACKET_HEADER.pack(PACKET_MAGIC, PACKET_VERSION, PACKET_CONTROL, 0, 0, len(payload)) + payload
+
+
+def free_port():
+    """Port UDP/TCP còn trống trên localhost"""
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def bench_dispatch(payload_size, count=1_000_000):
+    """Chi phí relay_datagram mỗi packet (không tính syscall). Returns: ns/packet"""
+    server = RemoteDesktopServer(tcp_port=0, udp_port=0)
+    streamer_addr = ('10.0.0.1', 40000)
+    server.relay_routes[streamer_addr] = ('10.0.0.2', 40001)
+    server.udp_sendto = lambda data, address: None
+
+    packet = frame_packet(payload_size)
+    relay = server.relay_datagram
+    start = time.perf_counter()
+    for _ in range(count):
+        relay(packet, streamer_addr)
+    return (time.perf_counter() - start) * 1e9 / count
+
+
+def send_worker(server_port, streamer_port, payload_size, seconds, sent_counter):
+    """Streamer giả: bắn frame chunk liên tục vào server"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+    sock.bind(('127.0.0.1', streamer_port))
+    packet = frame_packet(payload_size)
+    address = ('127.0.0.1', server_port)
+    sent = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(256):
+            try:
+                sock.sendto(packet, address)
+                sent += 1
+            except OSError:
+                pass  # ENOBUFS khi buffer gửi đầy
+    with sent_counter.get_lock():
+        sent_counter.value += sent
+    sock.close()
+
+
+def receive_worker(controller_port, seconds, ready, result):
+    """Controller giả: đếm packet nhận được trong thời gian đo"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    sock.bind(('127.0.0.1', controller_port))
+    sock.settimeout(0.5)
+    ready.set()
+    buffer = bytearray(65535)
+    received = 0
+    deadline = time.perf_counter() + seconds + 1.0
+    while time.perf_counter() < deadline:
+        try:
+            sock.recv_into(buffer)
+            received += 1
+        except socket.timeout:
+            continue
+    result.value = received
+    sock.close()
+
+
+def bench_end_to_end(payload_size, seconds, senders, use_async, batch_io=False, workers=0):
+    """Relay thật qua socket localhost. Returns: (sent, received, relayed)"""
+    udp_port = free_port()
+    server = RemoteDesktopServer(tcp_port=free_port(), udp_port=udp_port, batch_io=batch_io, workers=workers)
+    target = server.start_async if use_async else server.start
+    threading.Thread(target=target, daemon=True).start()
+    time.sleep(0.5)
+
+    # Mỗi Streamer giả là một session riêng, cùng relay về một Controller giả
+    controller = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    controller.bind(('127.0.0.1', 0))
+    controller_port = controller.getsockname()[1]
+    streamer_ports = []
+    for index in range(senders):
+        session_id = f"BENCH{index}"
+        session = Session(session_id, '', None, ('127.0.0.1', 0))
+        session.controller_token = 'bench'  # Thay cho token server cấp khi Controller đăng nhập TCP
+        server.sessions[session_id] = session
+        controller.sendto(control_packet({'type': 'controller_udp', 'session_id': session_id,
+                                          'token': session.controller_token}),
+                          ('127.0.0.1', udp_port))
+        streamer_port = free_port()
+        registrar = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        registrar.bind(('127.0.0.1', streamer_port))
+        registrar.sendto(control_packet({'type': 'streamer_udp', 'session_id': session_id,
+                                         'token': session.streamer_token}),
+                         ('127.0.0.1', udp_port))
+        registrar.close()
+        streamer_ports.append(streamer_port)
+    time.sleep(0.3)
+    controller.close()  # Process nhận bind lại đúng port đã đăng ký
+
+    sent_counter = multiprocessing.Value('q', 0)
+    received = multiprocessing.Value('q', 0)
+    ready = multiprocessing.Event()
+    receiver = multiprocessing.Process(target=receive_worker, args=(controller_port, seconds, ready, received))
+    receiver.start()
+    ready.wait(5)
+    sender_processes = [multiprocessing.Process(target=send_worker,
+                                                args=(udp_port, port, payload_size, seconds, sent_counter))
+                        for port in streamer_ports]
+    relayed_before = server.total_relayed_packets()
+    for sender in sender_processes:
+        sender.start()
+    for sender in sender_processes:
+        sender.join()
+    receiver.join()
+    time.sleep(0.6 if workers else 0)  # Worker báo số packet đã relay mỗi 0.5s
+    relayed = server.total_relayed_packets() - relayed_before
+    server.stop()
+    time.sleep(0.3)  # Chờ thread relay / event loop thoát
+    return sent_counter.value, received.value, relayed
+
+
+def main():
+    seconds = 5.0
+    payload_size = 1400
+    senders = 2
+    workers = 0
+    use_async = '--async' in sys.argv
+    use_batch = '--batch' in sys.argv and not use_async
+    args = sys.argv[1:]
+    for index, arg in enumerate(args[:-1]):
+        if arg == '--seconds':
+            seconds = float(args[index + 1])
+        elif arg == '--size':
+            payload_size = int(args[index + 1])
+        elif arg == '--senders':
+            senders = int(args[index + 1])
+        elif arg == '--workers':
+            workers = int(args[index + 1])
+
+    packet_size = PACKET_HEADER.size + CHUNK_HEADER_SIZE + payload_size
+    print("="*60)
+    print(f"UDP RELAY BENCHMARK - packet {packet_size} bytes, {'asyncio' if use_async else 'thread'} mode"
+          f"{f', {workers} worker(s)' if workers else ''}")
+    print("="*60)
+
+    ns = bench_dispatch(payload_size)
+    print(f"Dispatch:    {ns:.0f} ns/packet -> {1e9 / ns / 1e6:.2f} Mpps, "
+          f"{packet_size * 8 / ns:.1f} Gbit/s (không tính syscall)")
+
+    modes = [("End-to-end:", False)]
+    if use_batch:
+        if BatchUdpSocket.supported():
+            modes = [("Per-packet:", False), ("Batch I/O:", True)]
+        else:
+            print("Batch I/O (recvmmsg/sendmmsg) không hỗ trợ trên hệ điều hành này - chỉ đo I/O từng packet")
+    rates = []
+    for label, batch_io in modes:
+        sent, received, relayed = bench_end_to_end(payload_size, seconds, senders, use_async, batch_io, workers)
+        rate = relayed / seconds
+        rates.append(rate)
+        print(f"{label:<13}sent {sent}, relayed {relayed}, received {received} in {seconds:.0f}s")
+        print(f"             {rate / 1000:.0f} kpps, {rate * packet_size * 8 / 1e9:.2f} Gbit/s relay, "
+              f"loss {max(0.0, 1 - received / sent) * 100 if sent else 0:.1f}%")
+    if len(rates) == 2 and rates[0]:
+        print(f"Batch / per-packet: x{rates[1] / rates[0]:.2f}")
+    print("="*60)
+
+
+if __name__ == "__main__":
+    main()
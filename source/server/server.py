@@ -7,43 +7,355 @@ Chức năng:
 - Relay fallback: Chuyển tiếp dữ liệu nếu P2P không thành công
 - Nhận lệnh điều khiển từ Client A qua TCP (port 5555)
 - Nhận dữ liệu màn hình từ Client B qua UDP (port 5556)
-- Chuyển tiếp dữ liệu giữa 2 clients
+- Chuyển tiếp dữ liệu giữa các cặp clients (nhiều session đồng thời, theo session_id)
 - Log thông tin kết nối (IP, port, client ID)
+- Hai chế độ chạy: thread-per-connection (mặc định) hoặc asyncio event loop (--async)
 """
 
 import socket
 import threading
+import multiprocessing
+import queue
+import asyncio
 import json
 import time
+import sys
+import os
+import struct
+import secrets
+import hmac
+import weakref
+import ctypes
+import ctypes.util
 from datetime import datetime
 
+
+# UDP packet header cho mọi datagram (frame chunk và gói điều khiển):
+# magic (uint16), version (uint8), type (uint8), seq (uint32, đếm theo từng frame chunk gửi đi),
+# capture_us (uint64, thời điểm capture của frame; 0 với gói điều khiển), payload_len (uint16)
+# Server phân loại gói bằng struct, chỉ parse JSON với gói điều khiển
+PACKET_HEADER = struct.Struct('!HBBIQH')
+PACKET_MAGIC = 0x5244  # 'RD'
+PACKET_VERSION = 1
+PACKET_FRAME = 1  # Payload: CHUNK_HEADER + dữ liệu frame
+PACKET_CONTROL = 2  # Payload: JSON (đăng ký địa chỉ UDP, báo P2P)
+PACKET_PROBE = 3  # Payload: PROBE_MESSAGE + session_id - đo RTT / đục lỗ NAT
+
+# Probe: kind, target (server hoặc peer), server_rtt_us (RTT tới server của bên gửi, 0 = chưa biết)
+# seq/capture_us của header là id và thời điểm gửi probe, bên trả lời giữ nguyên
+PROBE_MESSAGE = struct.Struct('!BBI')
+PROBE_REQUEST = 1
+PROBE_REPLY = 2
+
+# Relay fast path: nhận dạng gói bằng 4 byte đầu (magic, version, type), không unpack header
+FRAME_PREFIX = PACKET_HEADER.pack(PACKET_MAGIC, PACKET_VERSION, PACKET_FRAME, 0, 0, 0)[:4]
+CONTROL_PREFIX = PACKET_HEADER.pack(PACKET_MAGIC, PACKET_VERSION, PACKET_CONTROL, 0, 0, 0)[:4]
+PROBE_PREFIX = PACKET_HEADER.pack(PACKET_MAGIC, PACKET_VERSION, PACKET_PROBE, 0, 0, 0)[:4]
+MAX_DATAGRAM_SIZE = 65535
+
+# TCP command channel: mỗi message = length (uint32, big-endian) + payload
+MESSAGE_HEADER = struct.Struct('!I')
+MAX_MESSAGE_SIZE = 1024 * 1024
+
+
+def encode_message(message):
+    """Đóng gói một dict thành message JSON có length prefix"""
+    payload = json.dumps(message).encode('utf-8')
+    return MESSAGE_HEADER.pack(len(payload)) + payload
+
+
+def recv_exact(sock, size):
+    """Nhận đúng size byte từ TCP socket (None nếu kết nối đóng)"""
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def read_message(sock):
+    """Đọc một message có length prefix từ TCP socket (blocking)"""
+    header = recv_exact(sock, MESSAGE_HEADER.size)
+    if header is None:
+        return None
+    (length,) = MESSAGE_HEADER.unpack(header)
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message too large: {length} bytes")
+    return recv_exact(sock, length)
+
+
+class MessageDecoder:
+    """Streaming decoder: ghép các đoạn byte TCP thành từng message hoàn chỉnh"""
+    def __init__(self):
+        self.buffer = bytearray()
+    
+    def feed(self, data):
+        """Thêm dữ liệu vừa nhận, trả về list payload của các message đã đủ"""
+        self.buffer += data
+        messages = []
+        offset = 0
+        while len(self.buffer) - offset >= MESSAGE_HEADER.size:
+            (length,) = MESSAGE_HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_MESSAGE_SIZE:
+                raise ValueError(f"Message too large: {length} bytes")
+            end = offset + MESSAGE_HEADER.size + length
+            if end > len(self.buffer):
+                break
+            messages.append(bytes(self.buffer[offset + MESSAGE_HEADER.size:end]))
+            offset = end
+        del self.buffer[:offset]
+        return messages
+
+class Session:
+    """Một cặp Streamer/Controller, định danh bởi session_id"""
+    def __init__(self, session_id, password, streamer_socket, streamer_address):
+        self.session_id = session_id
+        self.password = password
+        
+        # TCP connections
+        self.streamer_socket = streamer_socket    # Client B (Streamer)
+        self.controller_socket = None             # Client A (Controller)
+        
+        # Client info for logging
+        self.streamer_info = {
+            'ip': streamer_address[0], 'port': streamer_address[1], 'id': 'ClientB',
+            'connected_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'udp_addr': None
+        }
+        self.controller_info = {
+            'ip': None, 'port': None, 'id': 'ClientA', 'connected_at': None,
+            'udp_port': None, 'udp_addr': None, 'external_udp_port': None
+        }
+        
+        # Token ngẫu nhiên cấp qua TCP sau khi đăng ký/xác thực, bắt buộc trong mọi gói điều khiển UDP
+        # để host khác biết session_id cũng không đổi được route relay của session
+        self.streamer_token = secrets.token_hex(16)
+        self.controller_token = None  # Cấp lại mỗi lần Controller đăng nhập
+        
+        # P2P mode: Streamer gửi frame trực tiếp cho Controller, server không relay session này
+        self.p2p_mode = False
+
+
+class RelayProtocol(asyncio.DatagramProtocol):
+    """UDP relay cho asyncio mode - dùng chung logic relay với thread mode"""
+    def __init__(self, server):
+        self.server = server
+    
+    def datagram_received(self, data, addr):
+        self.server.relay_datagram(data, addr)
+    
+    def error_received(self, exc):
+        # Không log UDP errors vì Windows UDP có thể gây spam
+        pass
+
+
+# Batch UDP I/O (Linux): recvmmsg/sendmmsg qua ctypes
+class Iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class Msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(Iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class Mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', Msghdr), ('msg_len', ctypes.c_uint)]
+
+
+SOCKADDR_IN_SIZE = 16
+MSG_TRUNC = 0x20
+MSG_WAITFORONE = 0x10000
+
+
+def sockaddr_in(address):
+    """Địa chỉ (ip, port) thành struct sockaddr_in"""
+    return (struct.pack('=H', socket.AF_INET) + struct.pack('!H', address[1])
+            + socket.inet_aton(address[0]) + bytes(8))
+
+
+class BatchUdpSocket:
+    """
+    Nhận/gửi nhiều datagram mỗi syscall bằng recvmmsg/sendmmsg (Linux, qua ctypes).
+    Mỗi datagram nhận vào một slot cố định của buffer; gửi đi trỏ thẳng vào slot đó (không copy).
+    """
+    libc = None
+    
+    @classmethod
+    def supported(cls):
+        """recvmmsg/sendmmsg có dùng được không (Linux, libc có symbol)"""
+        if cls.libc is not None:
+            return True
+        if not sys.platform.startswith('linux'):
+            return False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+            libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+            libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        except (OSError, AttributeError):
+            return False
+        cls.libc = libc
+        return True
+    
+    def __init__(self, sock, batch_size=64, slot_size=2048):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.slot_size = slot_size
+        
+        self.buffer = (ctypes.c_char * (batch_size * slot_size))()
+        self.view = memoryview(self.buffer).cast('B')
+        self.names = (ctypes.c_char * (batch_size * SOCKADDR_IN_SIZE))()
+        self.names_view = memoryview(self.names).cast('B')
+        self.recv_iov = (Iovec * batch_size)()
+        self.recv_msgs = (Mmsghdr * batch_size)()
+        self.send_iov = (Iovec * batch_size)()
+        self.send_msgs = (Mmsghdr * batch_size)()
+        
+        buffer_base = ctypes.addressof(self.buffer)
+        names_base = ctypes.addressof(self.names)
+        recv_iov_base = ctypes.addressof(self.recv_iov)
+        send_iov_base = ctypes.addressof(self.send_iov)
+        for index in range(batch_size):
+            self.recv_iov[index].iov_base = buffer_base + index * slot_size
+            self.recv_iov[index].iov_len = slot_size
+            header = self.recv_msgs[index].msg_hdr
+            header.msg_name = names_base + index * SOCKADDR_IN_SIZE
+            header.msg_namelen = SOCKADDR_IN_SIZE
+            header.msg_iov = ctypes.cast(recv_iov_base + index * ctypes.sizeof(Iovec), ctypes.POINTER(Iovec))
+            header.msg_iovlen = 1
+            header = self.send_msgs[index].msg_hdr
+            header.msg_namelen = SOCKADDR_IN_SIZE
+            header.msg_iov = ctypes.cast(send_iov_base + index * ctypes.sizeof(Iovec), ctypes.POINTER(Iovec))
+            header.msg_iovlen = 1
+        
+        # View số nguyên trên các mảng header để đọc/ghi từng trường không tạo object ctypes.
+        # Trường con trỏ / size_t dùng view cỡ con trỏ ('P'), offset tính theo cỡ đó (32 và 64-bit)
+        mmsg_words = ctypes.sizeof(Mmsghdr) // 4
+        self.recv_words = memoryview(self.recv_msgs).cast('B').cast('I')
+        self.len_index = [index * mmsg_words + Mmsghdr.msg_len.offset // 4 for index in range(batch_size)]
+        self.flags_index = [index * mmsg_words + Msghdr.msg_flags.offset // 4 for index in range(batch_size)]
+        word = ctypes.sizeof(ctypes.c_void_p)
+        mmsg_pointers = ctypes.sizeof(Mmsghdr) // word
+        self.send_pointers = memoryview(self.send_msgs).cast('B').cast('P')
+        self.send_name_index = [index * mmsg_pointers + Msghdr.msg_name.offset // word for index in range(batch_size)]
+        iov_words = ctypes.sizeof(Iovec) // word
+        self.send_iov_words = memoryview(self.send_iov).cast('B').cast('P')
+        self.send_base_index = [index * iov_words + Iovec.iov_base.offset // word for index in range(batch_size)]
+        self.send_len_index = [index * iov_words + Iovec.iov_len.offset // word for index in range(batch_size)]
+        self.slot_address = [buffer_base + index * slot_size for index in range(batch_size)]
+    
+    def recv(self):
+        """Chờ ít nhất một datagram rồi lấy thêm những datagram đang có. Returns: số datagram"""
+        count = self.libc.recvmmsg(self.sock.fileno(), ctypes.addressof(self.recv_msgs),
+                                   self.batch_size, MSG_WAITFORONE, None)
+        if count < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return count
+    
+    def source_address(self, index):
+        """Địa chỉ nguồn dạng (ip, port)"""
+        offset = index * SOCKADDR_IN_SIZE
+        port = (self.names_view[offset + 2] << 8) | self.names_view[offset + 3]
+        return socket.inet_ntoa(self.names_view[offset + 4:offset + 8].tobytes()), port
+    
+    def send(self, count):
+        """Gửi count datagram đã xếp hàng. Returns: số datagram đã gửi"""
+        sent = 0
+        base = ctypes.addressof(self.send_msgs)
+        while sent < count:
+            result = self.libc.sendmmsg(self.sock.fileno(), base + sent * ctypes.sizeof(Mmsghdr),
+                                        count - sent, 0)
+            if result < 0:
+                # Lỗi của một datagram (vd. ICMP unreachable trước đó): bỏ datagram đó, gửi tiếp
+                sent += 1
+                continue
+            sent += result
+        return sent
+
+
+def run_relay_worker(index, tcp_port, udp_port, batch_io, route_queue, control_queue, stats):
+    """
+    Process relay UDP của multi-worker mode. Mọi worker bind chung port UDP bằng SO_REUSEPORT;
+    kernel chọn worker theo hash địa chỉ nguồn nên datagram của một Streamer luôn về cùng worker.
+    Route relay nhận từ process chính qua route_queue, gói điều khiển chuyển về qua control_queue.
+    """
+    server = RemoteDesktopServer(tcp_port=tcp_port, udp_port=udp_port, batch_io=batch_io)
+    server.running = True
+    server.forward_control_queue = control_queue
+    server.udp_socket = server.create_udp_socket(reuse_port=True)
+    server.udp_sendto = server.udp_socket.sendto
+    use_batch = batch_io and BatchUdpSocket.supported()
+    handler = server.handle_udp_data_batch if use_batch else server.handle_udp_data
+    threading.Thread(target=handler, daemon=True).start()
+    
+    try:
+        while True:
+            try:
+                update = route_queue.get(timeout=0.5)
+            except queue.Empty:
+                update = ()
+            stats[index] = server.relayed_packets
+            if update is None:
+                break
+            if update:
+                server.set_relay_route(*update)
+    except KeyboardInterrupt:
+        pass
+    server.running = False
+    server.udp_socket.close()
+
+
 class RemoteDesktopServer:
-    def __init__(self, tcp_port=5555, udp_port=5556):
+    def __init__(self, tcp_port=5555, udp_port=5556, batch_io=False, workers=0):
         self.tcp_port = tcp_port
         self.udp_port = udp_port
         
+        # Batch UDP I/O (recvmmsg/sendmmsg) cho relay, chỉ có trên Linux
+        self.batch_io = batch_io
+        
+        # Multi-worker mode: số process relay UDP bind chung port (SO_REUSEPORT), 0 = relay trong process này
+        self.workers = workers
+        self.worker_processes = []
+        self.worker_route_queues = []   # Process chính -> worker: (streamer_addr, controller_addr | None)
+        self.worker_control_queue = None  # Worker -> process chính: (gói điều khiển, địa chỉ nguồn)
+        self.worker_stats = None        # Số packet đã relay của từng worker
+        # Trong worker process: gói điều khiển không xử lý tại chỗ mà chuyển về process chính
+        self.forward_control_queue = None
+        
         # Socket servers
         self.tcp_socket = None
         self.udp_socket = None
         
-        # Client connections
-        self.controller_client = None  # Client A (Controller)
-        self.streamer_client = None    # Client B (Streamer)
+        # Session registry: session_id -> Session
+        self.sessions = {}
+        # UDP routing: địa chỉ UDP nguồn -> Session (cả Streamer và Controller)
+        self.udp_routes = {}
+        # Relay fast path: địa chỉ UDP Streamer -> địa chỉ UDP Controller, tính trước khi đăng ký
+        self.relay_routes = {}
+        self.relayed_packets = 0
+        # Lock chỉ dùng khi thêm/xóa session, không dùng trên relay hot path
+        self.registry_lock = threading.Lock()
+        # Thread mode: mỗi socket TCP một lock gửi để message từ nhiều thread không xen vào nhau
+        self.send_locks = weakref.WeakKeyDictionary()
         
-        # Authentication - store streamer credentials
-        self.streamer_credentials = {
-            'session_id': None,
-            'password': None
-        }
+        # Handshake phải hoàn tất trong thời gian này, tránh client im lặng chiếm kết nối
+        self.handshake_timeout = 5.0
         
-        # Client info for logging
-        self.client_info = {
-            'controller': {'ip': None, 'port': None, 'udp_port': None, 'udp_addr': None, 'socket': None, 'id': 'ClientA', 'connected_at': None, 'external_udp_port': None},
-            'streamer': {'ip': None, 'port': None, 'id': 'ClientB', 'connected_at': None, 'udp_addr': None}
-        }
+        # Hàm gửi UDP của chế độ đang chạy (socket.sendto hoặc DatagramTransport.sendto)
+        self.udp_sendto = None
         
-        # P2P mode tracking
-        self.p2p_mode = False  # Track if clients are using P2P
+        # asyncio mode
+        self.loop = None
+        self.loop_thread = None
+        self.tcp_server = None
+        self.udp_transport = None
+        self.client_tasks = set()  # Task của từng kết nối TCP, huỷ khi server dừng
+        self.shutdown_event = None  # asyncio.Event: serve_async dọn dẹp trên event loop rồi thoát
+        self.async_stopped = threading.Event()  # start_async đã dọn dẹp xong
         
         self.running = False
         
@@ -55,28 +367,35 @@ class RemoteDesktopServer:
     def start(self):
         """Khởi động server"""
         self.running = True
+        # Fork worker trước khi mở TCP socket / start thread để worker không giữ chúng
+        use_workers = self.workers > 0 and self.start_udp_workers()
         
         # Khởi tạo TCP socket
         self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.tcp_socket.bind(('0.0.0.0', self.tcp_port))
-        self.tcp_socket.listen(5)
+        self.tcp_socket.listen(128)
         self.log(f"TCP Server started on port {self.tcp_port}")
         
-        # Khởi tạo UDP socket
-        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        # Tăng buffer size cho UDP
-        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2 * 1024 * 1024)  # 2MB recv buffer
-        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2 * 1024 * 1024)  # 2MB send buffer
-        self.udp_socket.bind(('0.0.0.0', self.udp_port))
-        self.log(f"UDP Server started on port {self.udp_port}")
-        
         # Start threads
         tcp_thread = threading.Thread(target=self.handle_tcp_connections, daemon=True)
-        udp_thread = threading.Thread(target=self.handle_udp_data, daemon=True)
-        
         tcp_thread.start()
-        udp_thread.start()
+        
+        if not use_workers:
+            # Khởi tạo UDP socket
+            self.udp_socket = self.create_udp_socket()
+            self.udp_sendto = self.udp_socket.sendto
+            self.log(f"UDP Server started on port {self.udp_port}")
+            
+            udp_handler = self.handle_udp_data
+            if self.batch_io:
+                if BatchUdpSocket.supported():
+                    udp_handler = self.handle_udp_data_batch
+                    self.log("📦 UDP relay dùng batch I/O (recvmmsg/sendmmsg)")
+                else:
+                    self.log("⚠️ Batch I/O chỉ hỗ trợ Linux - dùng I/O từng packet")
+            udp_thread = threading.Thread(target=udp_handler, daemon=True)
+            udp_thread.start()
         
         self.log("Server is ready to accept connections")
         
@@ -87,218 +406,815 @@ class RemoteDesktopServer:
             self.log("Server shutting down...")
             self.stop()
             
+    def create_udp_socket(self, reuse_port=False):
+        """Tạo UDP socket cho relay với buffer lớn"""
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            # Multi-worker: nhiều process bind cùng port, kernel chia datagram theo hash địa chỉ
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # Tăng buffer size cho UDP
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2 * 1024 * 1024)  # 2MB recv buffer
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2 * 1024 * 1024)  # 2MB send buffer
+        udp_socket.bind(('0.0.0.0', self.udp_port))
+        return udp_socket
+    
+    def start_udp_workers(self):
+        """Multi-worker mode: khởi động các process relay UDP. Returns: False nếu hệ điều hành không hỗ trợ"""
+        # SO_REUSEPORT chỉ chia tải datagram giữa các socket trên Linux
+        if not sys.platform.startswith('linux') or not hasattr(socket, 'SO_REUSEPORT'):
+            self.log("⚠️ Multi-worker relay cần SO_REUSEPORT (Linux) - relay trong process chính")
+            return False
+        
+        self.worker_control_queue = multiprocessing.Queue()
+        self.worker_stats = multiprocessing.Array('q', self.workers, lock=False)
+        for index in range(self.workers):
+            route_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=run_relay_worker,
+                args=(index, self.tcp_port, self.udp_port, self.batch_io, route_queue,
+                      self.worker_control_queue, self.worker_stats),
+                daemon=True
+            )
+            process.start()
+            self.worker_route_queues.append(route_queue)
+            self.worker_processes.append(process)
+        
+        threading.Thread(target=self.handle_worker_control, daemon=True).start()
+        self.log(f"UDP Server started on port {self.udp_port} ({self.workers} relay worker process, SO_REUSEPORT)")
+        return True
+    
+    def handle_worker_control(self):
+        """Xử lý gói điều khiển UDP do các worker chuyển về (đăng ký địa chỉ, báo P2P)"""
+        while self.running:
+            try:
+                item = self.worker_control_queue.get()
+            except (EOFError, OSError):
+                break
+            if item is None:
+                break
+            if self.loop:
+                # asyncio mode: session state và StreamWriter thuộc event loop
+                self.loop.call_soon_threadsafe(self.handle_control_packet, *item)
+            else:
+                self.handle_control_packet(*item)
+    
+    def total_relayed_packets(self):
+        """Tổng số packet đã relay (process này + các worker)"""
+        if self.worker_stats is None:
+            return self.relayed_packets
+        return self.relayed_packets + sum(self.worker_stats)
+    
+    def send_tcp(self, conn, data):
+        """Gửi dữ liệu TCP - conn là socket (thread mode) hoặc StreamWriter (asyncio mode)"""
+        if isinstance(conn, asyncio.StreamWriter):
+            # StreamWriter chỉ được ghi trên thread của event loop
+            if threading.current_thread() is self.loop_thread:
+                conn.write(data)
+            else:
+                self.loop.call_soon_threadsafe(conn.write, data)
+            return
+        
+        with self.registry_lock:
+            send_lock = self.send_locks.get(conn)
+            if send_lock is None:
+                send_lock = self.send_locks[conn] = threading.Lock()
+        with send_lock:
+            conn.sendall(data)
+            
     def handle_tcp_connections(self):
         """Xử lý kết nối TCP từ clients"""
         while self.running:
             try:
                 client_socket, client_address = self.tcp_socket.accept()
                 
-                # Nhận thông tin client type (controller hoặc streamer)
-                client_type_data = client_socket.recv(1024).decode('utf-8')
-                client_info_json = json.loads(client_type_data)
-                client_type = client_info_json.get('type', 'unknown')
-                
-                if client_type == 'controller':
-                    # Verify credentials for controller
-                    session_id = client_info_json.get('session_id', '')
-                    password = client_info_json.get('password', '')
-                    
-                    if self.verify_credentials(session_id, password):
-                        self.controller_client = client_socket
-                        self.client_info['controller']['ip'] = client_address[0]
-                        self.client_info['controller']['port'] = client_address[1]
-                        self.client_info['controller']['connected_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        
-                        self.log(f"✅ TCP Client A (Controller) authenticated and connected: {client_address[0]}:{client_address[1]}")
-                        
-                        # Send success response with P2P peer info
-                        response = {
-                            'status': 'success',
-                            'message': 'Authentication successful',
-                            'peer_info': self.get_streamer_peer_info()
-                        }
-                        client_socket.send(json.dumps(response).encode('utf-8'))
-                        
-                        # Send Controller's info to Streamer for P2P
-                        self.send_controller_info_to_streamer(client_address)
-                        
-                        # Start thread để nhận lệnh từ controller
-                        threading.Thread(target=self.handle_controller_commands, 
-                                       args=(client_socket,), daemon=True).start()
-                    else:
-                        self.log(f"❌ Authentication failed for {client_address[0]}:{client_address[1]}")
-                        # Send failure response
-                        response = json.dumps({'status': 'error', 'message': 'Invalid Session ID or Password'})
-                        client_socket.send(response.encode('utf-8'))
-                        client_socket.close()
-                    
-                elif client_type == 'streamer':
-                    # Store streamer credentials
-                    session_id = client_info_json.get('session_id', '')
-                    password = client_info_json.get('password', '')
-                    
-                    self.streamer_credentials['session_id'] = session_id
-                    self.streamer_credentials['password'] = password
-                    
-                    self.streamer_client = client_socket
-                    self.client_info['streamer']['ip'] = client_address[0]
-                    self.client_info['streamer']['port'] = client_address[1]
-                    self.client_info['streamer']['connected_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    
-                    self.log(f"TCP Client B (Streamer) connected: {client_address[0]}:{client_address[1]}")
-                    self.log(f"🔑 Session ID: {session_id}, Password: {password}")
+                # Handshake chạy trên thread riêng để client chậm không chặn accept
+                threading.Thread(target=self.handle_tcp_handshake,
+                                 args=(client_socket, client_address), daemon=True).start()
                     
             except Exception as e:
                 if self.running:
                     self.log(f"Error accepting TCP connection: {e}")
     
+    def handle_tcp_handshake(self, client_socket, client_address):
+        """Handshake có timeout rồi chuyển sang Controller/Streamer (thread mode)"""
+        try:
+            # Nhận thông tin client type (controller hoặc streamer)
+            client_socket.settimeout(self.handshake_timeout)
+            client_type_data = read_message(client_socket)
+            client_socket.settimeout(None)
+            if client_type_data is None:
+                client_socket.close()
+                return
+            client_info_json = json.loads(client_type_data.decode('utf-8'))
+            client_type = client_info_json.get('type', 'unknown')
+        except socket.timeout:
+            self.log(f"⏱️  Handshake timeout from {client_address[0]}:{client_address[1]}")
+            client_socket.close()
+            return
+        except Exception as e:
+            self.log(f"Invalid handshake from {client_address[0]}:{client_address[1]}: {e}")
+            client_socket.close()
+            return
+        
+        try:
+            if client_type == 'controller':
+                self.handle_controller_login(client_socket, client_address, client_info_json)
+            elif client_type == 'streamer':
+                self.handle_streamer_login(client_socket, client_address, client_info_json)
+            else:
+                self.log(f"Unknown client type from {client_address[0]}:{client_address[1]}")
+                client_socket.close()
+        except Exception as e:
+            if self.running:
+                self.log(f"Error handling TCP connection from {client_address[0]}:{client_address[1]}: {e}")
+            client_socket.close()
+    
+    def handle_controller_login(self, client_socket, client_address, client_info_json):
+        """Xác thực Controller và start thread nhận lệnh (thread mode)"""
+        session = self.register_controller(client_socket, client_address, client_info_json)
+        if session is None:
+            return
+        
+        # Start thread để nhận lệnh từ controller
+        threading.Thread(target=self.handle_controller_commands,
+                         args=(session, client_socket), daemon=True).start()
+    
+    def handle_streamer_login(self, client_socket, client_address, client_info_json):
+        """Đăng ký Streamer và start thread theo dõi kết nối (thread mode)"""
+        session = self.register_streamer(client_socket, client_address, client_info_json)
+        if session is None:
+            return
+        
+        # Theo dõi TCP của Streamer để dọn session khi Streamer ngắt kết nối
+        threading.Thread(target=self.handle_streamer_messages,
+                         args=(session,), daemon=True).start()
+    
+    def register_controller(self, conn, client_address, client_info_json):
+        """Xác thực Controller và gắn vào session tương ứng
+        Returns: Session nếu thành công, None nếu xác thực thất bại"""
+        # Verify credentials for controller
+        session_id = client_info_json.get('session_id', '')
+        password = client_info_json.get('password', '')
+        
+        session = self.verify_credentials(session_id, password)
+        if session is None:
+            self.log(f"❌ Authentication failed for {client_address[0]}:{client_address[1]}")
+            # Send failure response
+            response = {'status': 'error', 'message': 'Invalid Session ID or Password'}
+            self.send_tcp(conn, encode_message(response))
+            conn.close()
+            return None
+        
+        # Controller mới thay thế Controller cũ của cùng session
+        if session.controller_socket:
+            self.close_controller(session)
+        
+        session.controller_socket = conn
+        session.controller_token = secrets.token_hex(16)
+        session.controller_info['ip'] = client_address[0]
+        session.controller_info['port'] = client_address[1]
+        session.controller_info['connected_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        
+        self.log(f"✅ TCP Client A (Controller) authenticated and connected: {client_address[0]}:{client_address[1]} [session {session_id}]")
+        
+        # Send success response with P2P peer info
+        response = {
+            'status': 'success',
+            'message': 'Authentication successful',
+            'udp_token': session.controller_token,
+            'peer_info': self.get_streamer_peer_info(session)
+        }
+        self.send_tcp(conn, encode_message(response))
+        # Địa chỉ UDP cho hole punching được gửi khi cả hai bên đã đăng ký UDP (send_peer_info)
+        return session
+    
+    def register_streamer(self, conn, client_address, client_info_json):
+        """Đăng ký Streamer như một session mới"""
+        # Store streamer credentials
+        session_id = client_info_json.get('session_id', '')
+        password = client_info_json.get('password', '')
+        
+        session = Session(session_id, password, conn, client_address)
+        with self.registry_lock:
+            old_session = self.sessions.get(session_id)
+            # Session còn sống chỉ được thay thế bởi Streamer có đúng password
+            refused = (old_session is not None and old_session.streamer_socket is not None
+                       and not hmac.compare_digest(password.encode('utf-8'), old_session.password.encode('utf-8')))
+            if not refused:
+                self.sessions[session_id] = session
+        
+        if refused:
+            self.log(f"❌ Session {session_id} already active - refused Streamer {client_address[0]}:{client_address[1]}")
+            try:
+                self.send_tcp(conn, encode_message({
+                    'command': 'DISCONNECT',
+                    'payload': {'message': 'Session ID already in use'}
+                }))
+            except Exception:
+                pass
+            conn.close()
+            return None
+        
+        # Streamer kết nối lại với cùng session_id thay thế session cũ
+        if old_session:
+            self.log(f"⚠️  Session {session_id} re-registered, replacing previous Streamer")
+            self.close_session(old_session)
+        
+        self.log(f"TCP Client B (Streamer) connected: {client_address[0]}:{client_address[1]}")
+        self.log(f"🔑 Session ID: {session_id}, Password: {password}")
+        
+        # Token cho gói đăng ký UDP của Streamer
+        self.send_tcp(conn, encode_message({'command': 'UDP_TOKEN', 'payload': {'token': session.streamer_token}}))
+        return session
+    
     def verify_credentials(self, session_id, password):
-        """Verify controller credentials against streamer credentials"""
-        if not self.streamer_credentials['session_id']:
-            self.log("⚠️  No streamer connected yet")
-            return False
+        """Verify controller credentials against streamer credentials
+        Returns: Session nếu hợp lệ, None nếu không"""
+        session = self.sessions.get(session_id)
+        if session is None:
+            self.log(f"⚠️  No streamer connected with session {session_id}")
+            return None
         
-        is_valid = (session_id == self.streamer_credentials['session_id'] and 
-                   password == self.streamer_credentials['password'])
+        # So sánh thời gian hằng như token UDP và kiểm tra takeover trong register_streamer
+        if not hmac.compare_digest(str(password).encode('utf-8'), session.password.encode('utf-8')):
+            return None
         
-        return is_valid
+        return session
     
-    def get_streamer_peer_info(self):
+    def get_streamer_peer_info(self, session):
         """Get Streamer's connection info for P2P"""
-        if not self.client_info['streamer']['ip']:
+        if not session.streamer_info['ip']:
             return None
         
         return {
-            'ip': self.client_info['streamer']['ip'],
-            'udp_addr': self.client_info['streamer'].get('udp_addr'),
-            'connected': self.streamer_client is not None
+            'ip': session.streamer_info['ip'],
+            'udp_addr': session.streamer_info.get('udp_addr'),
+            'connected': session.streamer_socket is not None
         }
     
-    def send_controller_info_to_streamer(self, controller_addr):
-        """Send Controller's info to Streamer for P2P connection"""
-        if not self.streamer_client:
+    def send_peer_info(self, session):
+        """
+        Hole punching: gửi cho mỗi bên địa chỉ UDP bên kia như server quan sát được (địa chỉ ngoài NAT).
+        Hai bên probe nhau bằng địa chỉ này; Streamer chọn đường trực tiếp hoặc relay theo kết quả.
+        """
+        streamer_addr = session.streamer_info['udp_addr']
+        controller_addr = session.controller_info['udp_addr']
+        if not streamer_addr or not controller_addr:
             return
         
-        try:
+        # Nonce mới cho mỗi lần báo địa chỉ: probe giữa hai client phải mang nonce này,
+        # datagram từ host khác (dù biết session_id) không chiếm được đường P2P
+        nonce = secrets.token_hex(16)
+        for conn, peer_addr in ((session.streamer_socket, controller_addr),
+                                (session.controller_socket, streamer_addr)):
+            if not conn:
+                continue
             peer_info = {
                 'command': 'PEER_INFO',
-                'payload': {
-                    'peer_ip': controller_addr[0],
-                    'peer_port': controller_addr[1],
-                    'message': 'Controller connected, you can try P2P'
-                }
+                'payload': {'peer_ip': peer_addr[0], 'peer_port': peer_addr[1], 'nonce': nonce}
             }
-            self.streamer_client.send(json.dumps(peer_info).encode('utf-8'))
-            self.log(f"📡 Sent Controller info to Streamer for P2P attempt")
+            try:
+                self.send_tcp(conn, encode_message(peer_info))
+            except Exception as e:
+                self.log(f"Error sending peer info: {e}")
+        self.log(f"📡 Sent peer UDP addresses for hole punching [session {session.session_id}]: "
+                 f"{streamer_addr[0]}:{streamer_addr[1]} <-> {controller_addr[0]}:{controller_addr[1]}")
+    
+    def forward_controller_data(self, session, decoder, data):
+        """Tách message từ dữ liệu Controller và chuyển đến Streamer trong một lần ghi"""
+        messages = decoder.feed(data)
+        if not messages:
+            return
+        
+        for message in messages:
+            # Message nhị phân (mouse move) chuyển tiếp nguyên vẹn, không parse
+            if message[:1] != b'{':
+                continue
+            # Parse command
+            try:
+                command = json.loads(message.decode('utf-8')).get('command', 'unknown')
+            except ValueError:
+                command = 'unknown'
+            # FEEDBACK/PING gửi định kỳ, không ghi log
+            if command not in ('FEEDBACK', 'PING'):
+                self.log(f"Received command from Controller: {command} [session {session.session_id}]")
+        
+        # Chuyển tiếp lệnh đến Streamer
+        if session.streamer_socket:
+            try:
+                self.send_tcp(session.streamer_socket, b''.join(
+                    MESSAGE_HEADER.pack(len(message)) + message for message in messages))
+            except Exception as e:
+                self.log(f"Error forwarding to Streamer: {e}")
+        else:
+            self.log("Warning: No Streamer connected to receive command")
+    
+    def forward_streamer_data(self, session, decoder, data):
+        """Tách message từ dữ liệu Streamer và chuyển nguyên vẹn đến Controller trong một lần ghi"""
+        messages = decoder.feed(data)
+        if not messages or not session.controller_socket:
+            return
+        
+        # Chỉ gửi message đủ: PEER_INFO do server gửi không chen vào giữa một message dang dở
+        try:
+            self.send_tcp(session.controller_socket, b''.join(
+                MESSAGE_HEADER.pack(len(message)) + message for message in messages))
         except Exception as e:
-            self.log(f"Error sending peer info to Streamer: {e}")
-                    
-    def handle_controller_commands(self, client_socket):
-        """Nhận lệnh từ Controller và chuyển đến Streamer"""
+            self.log(f"Error forwarding to Controller: {e}")
+    
+    def handle_controller_commands(self, session, client_socket):
+        """Nhận lệnh từ Controller và chuyển đến Streamer của cùng session"""
+        decoder = MessageDecoder()
         while self.running:
             try:
-                data = client_socket.recv(4096)
+                data = client_socket.recv(65536)
                 if not data:
                     break
-                    
-                # Parse command
-                command = json.loads(data.decode('utf-8'))
-                self.log(f"Received command from Controller: {command.get('command', 'unknown')}")
                 
-                # Chuyển tiếp lệnh đến Streamer
-                if self.streamer_client:
-                    try:
-                        self.streamer_client.send(data)
-                        self.log(f"Command forwarded to Streamer")
-                    except Exception as e:
-                        self.log(f"Error forwarding to Streamer: {e}")
-                else:
-                    self.log("Warning: No Streamer connected to receive command")
+                self.forward_controller_data(session, decoder, data)
                     
             except Exception as e:
                 self.log(f"Error handling controller command: {e}")
                 break
+        
+        self.log(f"Controller disconnected [session {session.session_id}]")
+        # Chỉ dọn nếu socket này vẫn là Controller hiện tại của session
+        if session.controller_socket is client_socket:
+            self.close_controller(session)
+    
+    def handle_streamer_messages(self, session):
+        """Nhận dữ liệu TCP từ Streamer và chuyển đến Controller; dọn session khi Streamer ngắt"""
+        streamer_socket = session.streamer_socket
+        decoder = MessageDecoder()
+        while self.running:
+            try:
+                data = streamer_socket.recv(65536)
+                if not data:
+                    break
                 
-        self.log("Controller disconnected")
-        self.controller_client = None
+                self.forward_streamer_data(session, decoder, data)
+            except Exception:
+                break
+        
+        self.unregister_streamer(session)
+    
+    def unregister_streamer(self, session):
+        """Gỡ session khi Streamer ngắt kết nối"""
+        self.log(f"Streamer disconnected [session {session.session_id}]")
+        # Streamer có thể đã được thay thế bởi kết nối mới cùng session_id
+        with self.registry_lock:
+            if self.sessions.get(session.session_id) is session:
+                del self.sessions[session.session_id]
+        self.close_session(session)
+    
+    def close_controller(self, session):
+        """Ngắt Controller khỏi session và gỡ route UDP của nó"""
+        controller_socket = session.controller_socket
+        session.controller_socket = None
+        session.controller_token = None
+        
+        udp_addr = session.controller_info['udp_addr']
+        session.controller_info['udp_addr'] = None
+        session.p2p_mode = False
+        with self.registry_lock:
+            if udp_addr and self.udp_routes.get(udp_addr) is session:
+                del self.udp_routes[udp_addr]
+        self.update_relay_route(session)
+        
+        if controller_socket:
+            try:
+                controller_socket.close()
+            except Exception:
+                pass
+    
+    def close_session(self, session):
+        """Đóng toàn bộ kết nối của session"""
+        self.close_controller(session)
+        
+        udp_addr = session.streamer_info['udp_addr']
+        with self.registry_lock:
+            if udp_addr and self.udp_routes.get(udp_addr) is session:
+                del self.udp_routes[udp_addr]
+            if udp_addr:
+                self.set_relay_route(udp_addr, None)
+        
+        if session.streamer_socket:
+            try:
+                session.streamer_socket.close()
+            except Exception:
+                pass
+            session.streamer_socket = None
+    
+    def update_relay_route(self, session, old_streamer_addr=None):
+        """Tính trước đích relay của session: địa chỉ UDP Streamer -> địa chỉ UDP Controller"""
+        streamer_addr = session.streamer_info['udp_addr']
+        controller_addr = session.controller_info['udp_addr']
+        with self.registry_lock:
+            if old_streamer_addr and old_streamer_addr != streamer_addr:
+                self.set_relay_route(old_streamer_addr, None)
+            if streamer_addr:
+                # Session P2P: frame đi thẳng giữa hai client, bỏ route để server không relay
+                self.set_relay_route(streamer_addr, None if session.p2p_mode else controller_addr)
+    
+    def set_relay_route(self, streamer_addr, controller_addr):
+        """Đặt (hoặc gỡ nếu controller_addr là None) một route relay; multi-worker: gửi cho mọi worker"""
+        if controller_addr:
+            self.relay_routes[streamer_addr] = controller_addr
+        else:
+            self.relay_routes.pop(streamer_addr, None)
+        for route_queue in self.worker_route_queues:
+            route_queue.put((streamer_addr, controller_addr))
+    
+    def handle_udp_control(self, msg, address):
+        """Xử lý gói điều khiển UDP (đăng ký địa chỉ, báo P2P)"""
+        msg_type = msg.get('type')
+        session = self.sessions.get(msg.get('session_id'))
+        if session is None:
+            session = self.udp_routes.get(address)
+        if session is None:
+            return
+        
+        # Gói điều khiển phải mang token đã cấp qua TCP cho đúng vai trò
+        if msg_type == 'controller_udp':
+            expected_token = session.controller_token
+        else:
+            expected_token = session.streamer_token
+        token = msg.get('token')
+        if (not expected_token or not isinstance(token, str)
+                or not hmac.compare_digest(token.encode('utf-8'), expected_token.encode('utf-8'))):
+            return
+        
+        if msg_type == 'controller_udp':
+            # Lưu địa chỉ UDP của Controller
+            if session.controller_info['udp_addr'] != address:
+                session.controller_info['udp_port'] = address[1]
+                session.controller_info['udp_addr'] = address
+                session.controller_info['external_udp_port'] = address[1]
+                with self.registry_lock:
+                    self.udp_routes[address] = session
+                self.update_relay_route(session)
+                self.log(f"📡 Controller UDP registered: {address} [session {session.session_id}]")
+                self.send_peer_info(session)
+        elif msg_type == 'streamer_udp':
+            # Lưu địa chỉ UDP của Streamer
+            if session.streamer_info['udp_addr'] != address:
+                old_addr = session.streamer_info['udp_addr']
+                session.streamer_info['udp_addr'] = address
+                with self.registry_lock:
+                    self.udp_routes[address] = session
+                self.update_relay_route(session, old_addr)
+                self.log(f"📡 UDP Client B (Streamer) sending from: {address[0]}:{address[1]} [session {session.session_id}]")
+                self.send_peer_info(session)
+            # Keepalive mang đường Streamer đang dùng, sửa lại nếu gói p2p_active/p2p_inactive bị mất
+            if 'p2p' in msg:
+                self.set_p2p_mode(session, bool(msg['p2p']))
+        elif msg_type in ('p2p_active', 'p2p_inactive'):
+            # Streamer báo đã chuyển sang đường trực tiếp / quay về relay
+            if address == session.streamer_info['udp_addr']:
+                self.set_p2p_mode(session, msg_type == 'p2p_active')
+    
+    def set_p2p_mode(self, session, p2p_mode):
+        """Bật/tắt P2P cho session: P2P thì gỡ route relay, quay về relay thì đặt lại"""
+        if session.p2p_mode == p2p_mode:
+            return
+        session.p2p_mode = p2p_mode
+        self.update_relay_route(session)
+        if p2p_mode:
+            self.log(f"✅ P2P mode activated for session {session.session_id} - relay stopped")
+        else:
+            self.log(f"🔁 Session {session.session_id} fell back to RELAY")
         
     def handle_udp_data(self):
-        """Nhận dữ liệu màn hình từ Streamer qua UDP và forward qua UDP (Relay mode)"""
-        relay_packet_count = 0
+        """
+        Nhận dữ liệu màn hình từ Streamer qua UDP và forward đến Controller cùng session (Relay mode).
+        Fast path: recvfrom_into buffer cấp phát một lần, nhận dạng frame chunk bằng prefix,
+        tra đích relay đã tính trước rồi sendto - không decode, không parse.
+        """
+        buffer = bytearray(MAX_DATAGRAM_SIZE)
+        view = memoryview(buffer)
+        recvfrom_into = self.udp_socket.recvfrom_into
+        sendto = self.udp_socket.sendto
+        routes = self.relay_routes
+        header_size = PACKET_HEADER.size
+        while self.running:
+            try:
+                nbytes, address = recvfrom_into(buffer)
+                if nbytes >= header_size and buffer.startswith(FRAME_PREFIX):
+                    destination = routes.get(address)
+                    if destination is not None:
+                        sendto(view[:nbytes], destination)
+                        self.relayed_packets += 1
+                    continue
+                self.handle_control_packet(bytes(view[:nbytes]), address)
+            except Exception as e:
+                if self.running:
+                    # Không log UDP errors vì Windows UDP có thể gây spam
+                    pass
+    
+    def handle_udp_data_batch(self):
+        """
+        Relay mode với batch I/O (Linux): một recvmmsg nhận tới cả batch datagram,
+        frame chunk được forward bằng một sendmmsg trỏ thẳng vào buffer nhận.
+        Gói điều khiển xử lý như handle_udp_data.
+        """
+        io = BatchUdpSocket(self.udp_socket)
+        routes = self.relay_routes
+        source_addresses = {}   # sockaddr nguồn (bytes) -> (ip, port)
+        destination_names = {}  # (ip, port) đích -> sockaddr_in dựng sẵn
+        # Hot loop đọc/ghi thẳng các view số nguyên của BatchUdpSocket (tránh gọi method mỗi datagram)
+        view = io.view
+        names_view = io.names_view
+        recv_words, len_index, flags_index = io.recv_words, io.len_index, io.flags_index
+        send_iov_words, send_pointers, send_name_index = io.send_iov_words, io.send_pointers, io.send_name_index
+        send_base_index, send_len_index = io.send_base_index, io.send_len_index
+        slot_address = io.slot_address
+        slot_size = io.slot_size
+        header_size = PACKET_HEADER.size
         while self.running:
             try:
-                data, address = self.udp_socket.recvfrom(65535)
+                count = io.recv()
+            except InterruptedError:
+                continue
+            except OSError:
+                break  # Socket đã đóng khi stop()
+            
+            queued = 0
+            for index in range(count):
+                nbytes = recv_words[len_index[index]]
+                if nbytes < header_size or recv_words[flags_index[index]] & MSG_TRUNC:
+                    continue
+                name_offset = index * SOCKADDR_IN_SIZE
+                key = names_view[name_offset:name_offset + 8].tobytes()
+                address = source_addresses.get(key)
+                if address is None:
+                    if len(source_addresses) > 4096:
+                        source_addresses.clear()
+                    address = source_addresses[key] = io.source_address(index)
                 
-                # Kiểm tra nếu là registration packet từ Controller
+                offset = index * slot_size
+                if view[offset:offset + 4] == FRAME_PREFIX:
+                    destination = routes.get(address)
+                    if destination is not None:
+                        name = destination_names.get(destination)
+                        if name is None:
+                            if len(destination_names) > 4096:
+                                destination_names.clear()
+                            buffer = ctypes.create_string_buffer(sockaddr_in(destination), SOCKADDR_IN_SIZE)
+                            name = destination_names[destination] = (buffer, ctypes.addressof(buffer))
+                        send_iov_words[send_base_index[queued]] = slot_address[index]
+                        send_iov_words[send_len_index[queued]] = nbytes
+                        send_pointers[send_name_index[queued]] = name[1]
+                        queued += 1
+                    continue
                 try:
-                    msg = json.loads(data.decode('utf-8'))
-                    if msg.get('type') == 'controller_udp':
-                        # Lưu địa chỉ UDP của Controller
-                        self.client_info['controller']['udp_port'] = address[1]
-                        self.client_info['controller']['udp_addr'] = address
-                        self.client_info['controller']['external_udp_port'] = address[1]
-                        print(f"📡 Controller UDP registered: {address}")
-                        continue
-                    elif msg.get('type') == 'p2p_active':
-                        # Client báo đang dùng P2P
-                        self.p2p_mode = True
-                        self.log(f"✅ P2P mode activated! Server will reduce relay load.")
-                        continue
-                except:
+                    self.handle_control_packet(view[offset:offset + nbytes].tobytes(), address)
+                except Exception:
                     pass
+            
+            if queued:
+                self.relayed_packets += io.send(queued)
+    
+    def relay_datagram(self, data, address):
+        """Xử lý một datagram (asyncio mode): frame chunk relay theo fast path, còn lại là gói điều khiển"""
+        if data.startswith(FRAME_PREFIX) and len(data) >= PACKET_HEADER.size:
+            destination = self.relay_routes.get(address)
+            if destination is not None:
+                self.udp_sendto(data, destination)
+                self.relayed_packets += 1
+            return
+        self.handle_control_packet(data, address)
+    
+    def handle_control_packet(self, data, address):
+        """Gói điều khiển (ngoài hot path): kiểm tra đầy đủ header rồi parse JSON"""
+        if data.startswith(PROBE_PREFIX):
+            self.echo_probe(data, address)
+            return
+        if not data.startswith(CONTROL_PREFIX) or len(data) < PACKET_HEADER.size:
+            return
+        length = PACKET_HEADER.unpack_from(data)[5]
+        if length != len(data) - PACKET_HEADER.size:
+            return
+        if self.forward_control_queue is not None:
+            # Worker process: session state nằm ở process chính
+            self.forward_control_queue.put((data, address))
+            return
+        try:
+            self.handle_udp_control(json.loads(data[PACKET_HEADER.size:].decode('utf-8')), address)
+        except Exception:
+            pass
+    
+    def echo_probe(self, data, address):
+        """Trả lời probe đo RTT tới server: giữ nguyên gói, chỉ đổi kind (không khuếch đại kích thước)"""
+        if len(data) < PACKET_HEADER.size + PROBE_MESSAGE.size or data[PACKET_HEADER.size] != PROBE_REQUEST:
+            return
+        reply = bytearray(data)
+        reply[PACKET_HEADER.size] = PROBE_REPLY
+        try:
+            self.udp_sendto(reply, address)
+        except Exception:
+            pass
+    
+    # ==================== ASYNCIO MODE ====================
+    
+    def start_async(self):
+        """Khởi động server ở chế độ asyncio (một event loop cho toàn bộ kết nối)"""
+        try:
+            asyncio.run(self.serve_async())
+        except KeyboardInterrupt:
+            self.log("Server shutting down...")
+        except asyncio.CancelledError:
+            pass
+        # Event loop đã đóng: phần còn lại (worker, socket) dọn như thread mode
+        self.loop = None
+        self.stop()
+        self.async_stopped.set()
+    
+    async def serve_async(self):
+        """asyncio.start_server cho TCP, DatagramProtocol cho UDP relay"""
+        self.running = True
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.current_thread()
+        self.shutdown_event = asyncio.Event()
+        self.async_stopped.clear()
+        use_workers = self.workers > 0 and self.start_udp_workers()
+        
+        self.tcp_server = await asyncio.start_server(
+            self.handle_tcp_client_async, '0.0.0.0', self.tcp_port,
+            reuse_address=True, backlog=1024
+        )
+        self.log(f"TCP Server started on port {self.tcp_port} (asyncio)")
+        
+        if not use_workers:
+            if self.batch_io:
+                # DatagramProtocol nhận từng datagram qua event loop, recvmmsg chỉ chạy trong relay worker
+                self.log("⚠️ Batch I/O không dùng được với asyncio UDP - thêm --workers N để relay bằng batch I/O")
+            self.udp_socket = self.create_udp_socket()
+            self.udp_transport, _ = await self.loop.create_datagram_endpoint(
+                lambda: RelayProtocol(self), sock=self.udp_socket
+            )
+            self.udp_sendto = self.udp_transport.sendto
+            self.log(f"UDP Server started on port {self.udp_port} (asyncio)")
+        
+        self.log("Server is ready to accept connections")
+        try:
+            await self.shutdown_event.wait()
+        finally:
+            # Đóng trên thread của event loop: TCP server, UDP transport và StreamWriter của các session
+            self.tcp_server.close()
+            if self.udp_transport:
+                self.udp_transport.close()
+            for session in list(self.sessions.values()):
+                self.close_session(session)
+            # Huỷ và chờ các task kết nối trước khi event loop đóng
+            tasks = list(self.client_tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def handle_tcp_client_async(self, reader, writer):
+        """Callback của asyncio.start_server: theo dõi task của kết nối để serve_async huỷ khi dừng"""
+        task = asyncio.current_task()
+        self.client_tasks.add(task)
+        try:
+            await self.serve_tcp_client_async(reader, writer)
+        except asyncio.CancelledError:
+            # Server đang dừng: kết thúc bình thường để start_server không in traceback
+            writer.close()
+        finally:
+            self.client_tasks.discard(task)
+    
+    async def serve_tcp_client_async(self, reader, writer):
+        """Handshake có timeout rồi chuyển sang relay cho Controller/Streamer"""
+        client_address = writer.get_extra_info('peername')
+        try:
+            client_type_data = await asyncio.wait_for(self.read_message_async(reader), self.handshake_timeout)
+            client_info_json = json.loads(client_type_data.decode('utf-8'))
+            client_type = client_info_json.get('type', 'unknown')
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            self.log(f"⏱️  Handshake timeout from {client_address[0]}:{client_address[1]}")
+            writer.close()
+            return
+        except Exception as e:
+            self.log(f"Invalid handshake from {client_address[0]}:{client_address[1]}: {e}")
+            writer.close()
+            return
+        
+        if client_type == 'controller':
+            session = self.register_controller(writer, client_address, client_info_json)
+            if session is not None:
+                await self.relay_controller_async(session, reader, writer)
+        elif client_type == 'streamer':
+            session = self.register_streamer(writer, client_address, client_info_json)
+            if session is not None:
+                await self.relay_streamer_async(session, reader)
+        else:
+            self.log(f"Unknown client type from {client_address[0]}:{client_address[1]}")
+            writer.close()
+    
+    async def read_message_async(self, reader):
+        """Đọc một message có length prefix từ StreamReader"""
+        header = await reader.readexactly(MESSAGE_HEADER.size)
+        (length,) = MESSAGE_HEADER.unpack(header)
+        if length > MAX_MESSAGE_SIZE:
+            raise ValueError(f"Message too large: {length} bytes")
+        return await reader.readexactly(length)
+    
+    async def relay_controller_async(self, session, reader, writer):
+        """Nhận lệnh từ Controller và chuyển đến Streamer của cùng session"""
+        decoder = MessageDecoder()
+        while self.running:
+            try:
+                data = await reader.read(65536)
+                if not data:
+                    break
                 
-                # Log lần đầu nhận từ Streamer
-                if not self.client_info['streamer']['udp_addr']:
-                    self.client_info['streamer']['udp_addr'] = address
-                    self.log(f"📡 UDP Client B (Streamer) sending from: {address[0]}:{address[1]}")
-                
-                # Forward screen data qua UDP đến Controller (Relay mode)
-                if not self.p2p_mode and self.client_info['controller']['udp_addr']:
-                    relay_packet_count += 1
-                    if relay_packet_count % 100 == 0:
-                        self.log(f"🔄 RELAY MODE: Forwarded {relay_packet_count} packets (fallback active)")
-                        
-                # Forward screen data qua UDP đến Controller
-                if self.client_info['controller']['udp_addr']:
-                    try:
-                        self.udp_socket.sendto(data, self.client_info['controller']['udp_addr'])
-                    except Exception as e:
-                        # Không log error UDP vì sẽ spam console
-                        pass
-                        
+                self.forward_controller_data(session, decoder, data)
+                await self.drain_async(session.streamer_socket)
             except Exception as e:
-                if self.running:
-                    # Không log UDP errors vì Windows UDP có thể gây spam
-                    pass
-                    
+                self.log(f"Error handling controller command: {e}")
+                break
+        
+        self.log(f"Controller disconnected [session {session.session_id}]")
+        if session.controller_socket is writer:
+            self.close_controller(session)
+    
+    async def relay_streamer_async(self, session, reader):
+        """Nhận dữ liệu TCP từ Streamer và chuyển đến Controller; dọn session khi Streamer ngắt"""
+        decoder = MessageDecoder()
+        while self.running:
+            try:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                
+                self.forward_streamer_data(session, decoder, data)
+                await self.drain_async(session.controller_socket)
+            except Exception:
+                break
+        
+        self.unregister_streamer(session)
+    
+    async def drain_async(self, writer):
+        """
+        Backpressure: chờ buffer gửi của writer xuống dưới high-water mark trước khi đọc tiếp,
+        peer đọc chậm làm chậm bên gửi thay vì để buffer phình vô hạn
+        """
+        if writer is None:
+            return
+        try:
+            await writer.drain()
+        except (ConnectionError, RuntimeError):
+            # Peer đã đóng - vòng nhận của peer đó tự dọn session
+            pass
+    
     def stop(self):
         """Dừng server"""
         self.running = False
         
+        # asyncio mode: asyncio objects phải được đóng trên thread của event loop,
+        # báo serve_async dọn dẹp rồi chờ start_async chạy nốt phần còn lại
+        loop = self.loop
+        if loop is not None and loop.is_running() and threading.current_thread() is not self.loop_thread:
+            loop.call_soon_threadsafe(self.shutdown_event.set)
+            self.async_stopped.wait(timeout=5)
+            return
         if self.tcp_socket:
             self.tcp_socket.close()
         if self.udp_socket:
             self.udp_socket.close()
-        if self.controller_client:
-            self.controller_client.close()
-        if self.streamer_client:
-            self.streamer_client.close()
+        
+        # Multi-worker: báo các worker dừng, worker không thoát kịp thì terminate
+        for route_queue in self.worker_route_queues:
+            route_queue.put(None)
+        if self.worker_control_queue is not None:
+            self.worker_control_queue.put(None)
+        for process in self.worker_processes:
+            process.join(timeout=2)
+            if process.is_alive():
+                process.terminate()
+        self.worker_processes = []
+        self.worker_route_queues = []
+        
+        for session in list(self.sessions.values()):
+            self.close_session(session)
             
         self.log("Server stopped")
         
     def print_status(self):
         """In ra trạng thái kết nối"""
+        sessions = list(self.sessions.values())
         print("\n" + "="*60)
-        print("SERVER STATUS")
+        print(f"SERVER STATUS - {len(sessions)} session(s), {self.total_relayed_packets()} packet(s) relayed")
         print("="*60)
-        print(f"Controller (Client A): {self.client_info['controller']['ip'] or 'Not connected'}")
-        if self.client_info['controller']['ip']:
-            print(f"  - Port: {self.client_info['controller']['port']}")
-            print(f"  - Connected at: {self.client_info['controller']['connected_at']}")
-        print(f"\nStreamer (Client B): {self.client_info['streamer']['ip'] or 'Not connected'}")
-        if self.client_info['streamer']['ip']:
-            print(f"  - Port: {self.client_info['streamer']['port']}")
-            print(f"  - Connected at: {self.client_info['streamer']['connected_at']}")
+        for session in sessions:
+            streamer = session.streamer_info
+            controller = session.controller_info
+            print(f"Session {session.session_id} ({'P2P' if session.p2p_mode else 'RELAY'})")
+            print(f"  Streamer (Client B): {streamer['ip']}:{streamer['port']} - connected at {streamer['connected_at']}")
+            if controller['ip']:
+                print(f"  Controller (Client A): {controller['ip']}:{controller['port']} - connected at {controller['connected_at']}")
+            else:
+                print("  Controller (Client A): Not connected")
         print("="*60 + "\n")
 
 
@@ -309,7 +1225,16 @@ if __name__ == "__main__":
     print("="*60)
     print()
     
-    server = RemoteDesktopServer(tcp_port=5555, udp_port=5556)
+    # python server.py --async : chạy trên asyncio event loop
+    use_asyncio = '--async' in sys.argv
+    # python server.py --batch : relay UDP bằng recvmmsg/sendmmsg (Linux, thread mode hoặc relay worker)
+    batch_io = '--batch' in sys.argv
+    # python server.py --workers N : N process relay UDP bind chung port (SO_REUSEPORT, Linux)
+    workers = 0
+    if '--workers' in sys.argv[:-1]:
+        workers = int(sys.argv[sys.argv.index('--workers') + 1])
+    
+    server = RemoteDesktopServer(tcp_port=5555, udp_port=5556, batch_io=batch_io, workers=workers)
     
     # Print status every 10 seconds
     def status_printer():
@@ -320,4 +1245,7 @@ if __name__ == "__main__":
     status_thread = threading.Thread(target=status_printer, daemon=True)
     status_thread.start()
     
-    server.start()
+    if use_asyncio:
+        server.start_async()
+    else:
+        server.start()